@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""Bulk generator of synthetic fleets in the database, for the benchmarks.
+
+The rows are written with COPY (or executemany when the driver has no COPY)
+instead of one factory object at a time, with the server counters and the
+plan prices computed here, so thousands of servers are created in seconds.
+"""
+
+import csv
+import datetime
+import io
+import random
+from collections import namedtuple
+
+from sqlalchemy import func, select, text
+
+from cloud_computing.model.database import db
+from cloud_computing.model.fleet_index import fleet_index
+from cloud_computing.model.models import Os, Cpu, Gpu, Ram, Hd, Server, ServerRam, ServerHd, ServerGpu, Plan, \
+    PlanRam, PlanHd, PlanGpu, User, CreditCard, update_plan_demand, update_plan_config_hash, \
+    update_plan_search_vector, update_plan_availability
+
+OS_NAMES = ['Linux', 'Windows', 'FreeBSD']
+# (model, price, cores, frequency)
+CPUS = [('Xeon 8', 40.0, 8, 2.4), ('Xeon 16', 70.0, 16, 2.6), ('Xeon 32', 120.0, 32, 2.8), ('Epyc 64', 200.0, 64, 2.2)]
+# (model, price, frequency, ram)
+GPUS = [('GTX 4GB', 30.0, 1.5, 4), ('GTX 8GB', 50.0, 2.0, 8), ('Tesla 16GB', 110.0, 2.0, 16)]
+# (model, price, capacity)
+RAMS = [('DDR4 8GB', 8.0, 8), ('DDR4 16GB', 14.0, 16), ('DDR4 32GB', 26.0, 32)]
+# (model, price, capacity, is_ssd)
+HDS = [('HD 500GB', 5.0, 500, False), ('HD 2TB', 15.0, 2000, False), ('SSD 250GB', 12.0, 250, True),
+       ('SSD 1TB', 40.0, 1000, True)]
+
+RAM_SLOTS, GPU_SLOTS, HD_SLOTS = 8, 4, 8
+
+Fleet = namedtuple('Fleet', ['servers', 'plans', 'users'])
+"""Ids of the rows created by populate."""
+
+
+def populate(session=None, servers=100, plans=50, users=100, seed=0):
+    """Creates the components, 'servers' servers with their RAM, HDs and GPUs,
+    'plans' plans (two thirds public) and 'users' users with a credit card,
+    in the current transaction.
+
+    :return: Fleet with the ids created.
+    """
+    session = session or db.session
+    connection = session.connection(mapper=Server.__mapper__)
+    rng = random.Random(seed)
+    installed = {}
+
+    server_rows, server_rams, server_hds, server_gpus = [], [], [], []
+    first_server = next_id(connection, Server)
+    for server_id in range(first_server, first_server + servers):
+        cpu_model, _, cores, _ = rng.choice(CPUS)
+        rams = [(model, capacity, rng.choice([1, 2])) for model, _, capacity in rng.sample(RAMS, 2)]
+        hds = [(model, capacity, is_ssd, rng.choice([1, 2])) for model, _, capacity, is_ssd in rng.sample(HDS, 2)]
+        gpus = [(model, ram, rng.choice([1, 2])) for model, _, _, ram in rng.sample(GPUS, rng.choice([0, 0, 1]))]
+        ram_total = sum(capacity * quantity for _, capacity, quantity in rams)
+        hd_total = sum(capacity * quantity for _, capacity, is_ssd, quantity in hds if not is_ssd)
+        ssd_total = sum(capacity * quantity for _, capacity, is_ssd, quantity in hds if is_ssd)
+        gpu_total = sum(ram * quantity for _, ram, quantity in gpus)
+        server_rows.append((server_id, cpu_model, cores, rng.choice(OS_NAMES),
+                            RAM_SLOTS, RAM_SLOTS - sum(quantity for _, _, quantity in rams), RAM_SLOTS * 32,
+                            ram_total, ram_total,
+                            GPU_SLOTS, GPU_SLOTS - sum(quantity for _, _, quantity in gpus), gpu_total, gpu_total,
+                            HD_SLOTS, HD_SLOTS - sum(quantity for _, _, _, quantity in hds), hd_total, hd_total,
+                            ssd_total, ssd_total, True))
+        count(installed, Cpu, cpu_model, 1)
+        for model, _, quantity in rams:
+            server_rams.append((server_id, model, quantity))
+            count(installed, Ram, model, quantity)
+        for model, _, _, quantity in hds:
+            server_hds.append((server_id, model, quantity))
+            count(installed, Hd, model, quantity)
+        for model, ram, quantity in gpus:
+            server_gpus.append((server_id, model, quantity, ram * quantity, ram * quantity))
+            count(installed, Gpu, model, quantity)
+
+    plan_rows, plan_rams, plan_hds, plan_gpus = [], [], [], []
+    prices = {model: price for model, price, *_ in CPUS + GPUS + RAMS + HDS}
+    first_plan = next_id(connection, Plan)
+    for plan_id in range(first_plan, first_plan + plans):
+        cpu_model = rng.choice(CPUS[:2])[0]
+        months = rng.choice([1, 3, 6, 12])
+        rams = [(rng.choice(RAMS)[0], 1)]
+        hds = [(rng.choice(HDS)[0], 1)]
+        gpus = [(rng.choice(GPUS)[0], 1)] if rng.random() < 0.2 else []
+        price = months * (prices[cpu_model] + sum(prices[model] * quantity for model, quantity in rams + hds + gpus))
+        title = 'Plano %d' % plan_id
+        plan_rows.append((plan_id, title, price, months, cpu_model, rng.choice(OS_NAMES), title,
+                          'plano-%d' % plan_id, plan_id % 3 != 0, True))
+        plan_rams += [(plan_id, model, quantity) for model, quantity in rams]
+        plan_hds += [(plan_id, model, quantity) for model, quantity in hds]
+        plan_gpus += [(plan_id, model, quantity) for model, quantity in gpus]
+
+    first_user = next_id(connection, User)
+    user_rows = [(user_id, 'Usuário', str(user_id), 'usuario%d@example.com' % user_id, 'password')
+                 for user_id in range(first_user, first_user + users)]
+    first_card = next_id(connection, CreditCard)
+    expires = datetime.datetime(2030, 1, 1)
+    card_rows = [(first_card + position, 4000000000000000 + user_id, user_id, 'Usuário', expires, 123)
+                 for position, (user_id, *_) in enumerate(user_rows)]
+
+    existing = {name for name, in connection.execute(select([Os.__table__.c.name]))}
+    copy_rows(connection, Os, ['name'], [(name,) for name in OS_NAMES if name not in existing])
+    for model, components, columns in [(Cpu, CPUS, ['model', 'price', 'cores', 'frequency']),
+                                       (Gpu, GPUS, ['model', 'price', 'frequency', 'ram']),
+                                       (Ram, RAMS, ['model', 'price', 'capacity']),
+                                       (Hd, HDS, ['model', 'price', 'capacity', 'is_ssd'])]:
+        add_components(connection, model, columns, components, installed)
+    copy_rows(connection, Server, ['id', 'cpu_model', 'cores_available', 'os_name',
+                                   'ram_slot_total', 'ram_slot_available', 'ram_max', 'ram_total', 'ram_available',
+                                   'gpu_slot_total', 'gpu_slot_available', 'gpu_total', 'gpu_available',
+                                   'hd_slot_total', 'hd_slot_available', 'hd_total', 'hd_available',
+                                   'ssd_total', 'ssd_available', 'in_service'], server_rows)
+    copy_rows(connection, ServerRam, ['server_id', 'ram_model', 'quantity'], server_rams)
+    copy_rows(connection, ServerHd, ['server_id', 'hd_model', 'quantity'], server_hds)
+    copy_rows(connection, ServerGpu, ['server_id', 'gpu_model', 'quantity', 'total_capacity',
+                                      'available_capacity'], server_gpus)
+    copy_rows(connection, Plan, ['id', 'title', 'price', 'duration_months', 'cpu_model', 'os_name',
+                                 'shop_description', 'slug_url', 'is_public', 'auto_price'], plan_rows)
+    copy_rows(connection, PlanRam, ['plan_id', 'ram_model', 'quantity'], plan_rams)
+    copy_rows(connection, PlanHd, ['plan_id', 'hd_model', 'quantity'], plan_hds)
+    copy_rows(connection, PlanGpu, ['plan_id', 'gpu_model', 'quantity'], plan_gpus)
+    copy_rows(connection, User, ['id', 'name', 'last_name', 'email', 'password'], user_rows)
+    copy_rows(connection, CreditCard, ['id', 'number', 'user_id', 'name', 'exp_date', 'cvv'], card_rows)
+    for model in (Server, Plan, User, CreditCard):
+        reset_sequence(connection, model)
+
+    plan_ids = [row[0] for row in plan_rows]
+    update_plan_demand(connection, plan_ids)
+    update_plan_config_hash(connection, plan_ids)
+    update_plan_search_vector(connection, plan_ids)
+    fleet_index.invalidate()
+    update_plan_availability(session, plan_ids)
+    return Fleet([row[0] for row in server_rows], plan_ids, [row[0] for row in user_rows])
+
+
+def count(installed, model, name, quantity):
+    key = (model, name)
+    installed[key] = installed.get(key, 0) + quantity
+
+
+def add_components(connection, model, columns, components, installed):
+    """Creates the missing components with enough units for the servers and
+    takes the installed units from the available ones."""
+    table = model.__table__
+    existing = {name for name, in connection.execute(select([table.c.model]))}
+    rows = []
+    for component in components:
+        used = installed.get((model, component[0]), 0)
+        if component[0] in existing:
+            if used:
+                connection.execute(table.update().where(table.c.model == component[0])
+                                   .values(total=table.c.total + used))
+        else:
+            rows.append(tuple(component) + (used, 0))
+    copy_rows(connection, model, columns + ['total', 'available'], rows)
+
+
+def next_id(connection, model):
+    table = model.__table__
+    return (connection.execute(select([func.max(table.c.id)])).scalar() or 0) + 1
+
+
+def reset_sequence(connection, model):
+    """Moves the id sequence past the ids written explicitly."""
+    table = model.__table__
+    connection.execute(text("SELECT setval(pg_get_serial_sequence(:table, 'id'), "
+                            "(SELECT coalesce(max(id), 0) + 1 FROM \"%s\"), false)" % table.name),
+                       table=table.name)
+
+
+def copy_rows(connection, model, columns, rows):
+    """Writes 'rows' to the table of 'model' with COPY, or with executemany
+    when the database driver has no COPY."""
+    if not rows:
+        return
+    table = model.__table__
+    cursor = connection.connection.cursor()
+    if not hasattr(cursor, 'copy_expert'):
+        connection.execute(table.insert(), [dict(zip(columns, row)) for row in rows])
+        return
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(['' if value is None else value for value in row])
+    buffer.seek(0)
+    cursor.copy_expert('COPY "%s" (%s) FROM STDIN WITH CSV' % (table.name, ', '.join(columns)), buffer)
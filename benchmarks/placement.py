@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""Replays a year of synthetic purchases against an in-memory fleet for each
+placement policy and reports the fleet utilization and the rejection rate.
+
+    python -m benchmarks.placement --servers 1000 --purchases 20000
+"""
+
+import argparse
+import datetime
+import random
+
+from cloud_computing.model.fleet_index import PlanDemand
+from cloud_computing.model.placement import PLACEMENT_POLICIES
+from cloud_computing.model.simulator import FleetSnapshot, SimulatedPurchase, simulate
+
+OS_NAMES = ['Linux', 'Linux', 'Linux', 'Windows']
+GPU_MODELS = [('GPU 4GB 1.5', 1.5, 4), ('GPU 8GB 2.0', 2.0, 8), ('GPU 16GB 2.0', 2.0, 16)]
+
+
+def generate_fleet(servers, seed=0):
+    """Returns the (server_rows, gpu_rows) of a random fleet."""
+    rng = random.Random(seed)
+    server_rows = []
+    gpu_rows = []
+    for server_id in range(1, servers + 1):
+        server_rows.append((server_id, rng.choice(OS_NAMES), rng.choice([8, 16, 32, 64]),
+                            rng.choice([64, 128, 256]), rng.choice([500, 1000, 2000]), rng.choice([0, 500, 1000])))
+        for gpu_model, frequency, ram in rng.sample(GPU_MODELS, rng.choice([0, 0, 1, 2])):
+            gpu_rows.append((server_id, gpu_model, frequency, ram * rng.choice([1, 2, 4])))
+    return server_rows, gpu_rows
+
+
+def generate_plans(seed=0):
+    """Returns a catalogue of (os_name, PlanDemand, duration_months)."""
+    rng = random.Random(seed)
+    plans = []
+    for cores in [1, 2, 4, 8, 16]:
+        for ram in [2, 8, 32]:
+            gpus = []
+            if rng.random() < 0.2:
+                _, frequency, gpu_ram = rng.choice(GPU_MODELS)
+                gpus = [(frequency, gpu_ram * rng.choice([1, 2]))]
+            demand = PlanDemand(cores, ram * cores // 2 or ram, rng.choice([0, 100, 200]),
+                                rng.choice([0, 0, 100]), gpus)
+            plans.append((rng.choice(OS_NAMES), demand, rng.choice([1, 2, 6, 12])))
+    return plans
+
+
+def generate_purchases(plans, purchases, users=50, seed=0, start=datetime.date(2018, 1, 1)):
+    """Returns a year of purchases as SimulatedPurchase, with the smaller plans
+    bought more often."""
+    rng = random.Random(seed)
+    weights = [1.0 / (1 + demand.cores) for _, demand, _ in plans]
+    days = sorted(rng.randrange(365) for _ in range(purchases))
+    return [SimulatedPurchase(start + datetime.timedelta(days=day), rng.randrange(users), os_name, demand, months,
+                              None)
+            for day, (os_name, demand, months) in zip(days, rng.choices(plans, weights, k=purchases))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--servers', type=int, default=1000)
+    parser.add_argument('--purchases', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    fleet = FleetSnapshot(*generate_fleet(args.servers, args.seed), leases=[])
+    stream = generate_purchases(generate_plans(args.seed), args.purchases, seed=args.seed)
+
+    print('%-10s %9s %7s %7s %7s %7s %7s %8s' % ('policy', 'rejected', 'cores', 'ram', 'hd', 'ssd', 'gpu', 'seconds'))
+    for policy in PLACEMENT_POLICIES.values():
+        report = simulate(fleet, stream, policy())
+        print('%-10s %8.2f%% %6.1f%% %6.1f%% %6.1f%% %6.1f%% %6.1f%% %8.2f' % (
+            policy.name, 100 * report.rejection_rate, 100 * report.utilization['cores'],
+            100 * report.utilization['ram'], 100 * report.utilization['hd'], 100 * report.utilization['ssd'],
+            100 * report.utilization['gpu'], report.seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""Times the allocation and pricing paths on synthetic fleets of growing size
+and writes the results as JSON, so they can be compared across commits.
+
+    python -m benchmarks.scenarios --sizes 100 1000 10000 --output results.json
+    python -m benchmarks.scenarios --baseline results.json
+
+The database of the config (configs/benchmark.py by default) is dropped and
+created again for each size.
+"""
+
+import argparse
+import datetime
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+from cloud_computing.app_factory import AppFactory
+from cloud_computing.controller.controller import Controller
+from cloud_computing.model.database import db
+from cloud_computing.model.fleet_index import fleet_index
+from cloud_computing.model.models import Plan, Purchase, UserPlan, CreditCard
+from benchmarks.fleet import populate
+
+DEFAULT_SIZES = [100, 1000, 10000]
+
+
+def available_servers(fleet, runs):
+    plans = public_plans(runs)
+    return [timed(plan.available_servers) for plan in plans]
+
+
+def available_servers_cold(fleet, runs):
+    """available_servers right after the fleet index is invalidated, with the full reload."""
+    timings = []
+    for plan in public_plans(runs):
+        fleet_index.invalidate()
+        timings.append(timed(plan.available_servers))
+    return timings
+
+
+def calculate_price(fleet, runs):
+    return [timed(plan.calculate_price) for plan in public_plans(runs)]
+
+
+def purchase_after_insert(fleet, runs):
+    """Inserts one purchase per run, flushing it through purchase_after_insert
+    and purchase_after_flush, which allocate the server."""
+    cards = CreditCard.query.order_by(CreditCard.id).limit(runs).all()
+    timings = []
+    for card, plan in zip(cards, public_plans(runs, available=True)):
+        def purchase():
+            db.session.add(Purchase(user_id=card.user_id, credit_card_id=card.id, plan_id=plan.id))
+            db.session.flush()
+        timings.append(timed(purchase))
+    db.session.rollback()
+    return timings
+
+
+def get_available_plans(fleet, runs):
+    return [timed(Controller.get_available_plans) for _ in range(runs)]
+
+
+def search_plan(fleet, runs):
+    """First page of the full-text search, for the title of one plan and for a GPU."""
+    terms = ['Plano %d' % fleet.plans[len(fleet.plans) // 2], 'Tesla']
+    return [timed(lambda: Controller.search_plan(terms[run % 2])) for run in range(runs)]
+
+
+def update_server(fleet, runs):
+    """Moves one UserPlan per run to another server that fits its plan."""
+    cards = CreditCard.query.order_by(CreditCard.id).limit(runs).all()
+    for card, plan in zip(cards, public_plans(runs, available=True)):
+        db.session.add(Purchase(user_id=card.user_id, credit_card_id=card.id, plan_id=plan.id))
+    db.session.flush()
+    timings = []
+    for user_plan in UserPlan.query.order_by(UserPlan.id).all():
+        targets = [server_id for server_id, _ in user_plan.plan.ranked_servers(limit=2)
+                   if server_id != user_plan.server_id]
+        if not targets:
+            continue
+
+        def move():
+            user_plan.server_id = targets[0]
+            db.session.flush()
+        timings.append(timed(move))
+    db.session.rollback()
+    return timings
+
+
+SCENARIOS = [available_servers, available_servers_cold, calculate_price, purchase_after_insert,
+             get_available_plans, search_plan, update_server]
+
+
+def public_plans(runs, available=False):
+    query = Plan.query.filter(Plan.is_public.is_(True)).order_by(Plan.id)
+    plans = query.all()
+    if available:
+        plans = [plan for plan in plans if plan.available_servers() is not None]
+    return (plans * runs)[:runs] if plans else []
+
+
+def timed(function):
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+
+def run(sizes, runs=20, seed=0, scenarios=None):
+    """Populates a fleet of each size and times the scenarios on it.
+
+    Must run inside the app context, the tables are dropped and created again.
+    :return: list of result dicts, one for each size and scenario.
+    """
+    results = []
+    for size in sizes:
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        start = time.perf_counter()
+        fleet = populate(db.session, servers=size, plans=max(50, size // 20), users=max(runs, 100), seed=seed)
+        db.session.commit()
+        results.append(summary(size, 'populate', [time.perf_counter() - start]))
+        for scenario in scenarios or SCENARIOS:
+            fleet_index.invalidate()
+            results.append(summary(size, scenario.__name__, scenario(fleet, runs)))
+    return results
+
+
+def summary(size, scenario, timings):
+    return {
+        'servers': size,
+        'scenario': scenario,
+        'runs': len(timings),
+        'min': min(timings) if timings else None,
+        'median': statistics.median(timings) if timings else None,
+        'mean': statistics.mean(timings) if timings else None,
+        'total': sum(timings),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    """Prints the median of each result against the one of the baseline run."""
+    previous = {(result['servers'], result['scenario']): result for result in baseline['results']}
+    print('%-24s %8s %12s %12s %8s' % ('scenario', 'servers', 'baseline', 'median', 'ratio'))
+    for result in results:
+        before = previous.get((result['servers'], result['scenario']))
+        if before is None or not before['median'] or result['median'] is None:
+            continue
+        print('%-24s %8d %11.2fms %11.2fms %7.2fx' % (
+            result['scenario'], result['servers'], 1000 * before['median'], 1000 * result['median'],
+            result['median'] / before['median']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--config', default='../configs/benchmark.py')
+    parser.add_argument('--output', help='JSON file written with the results.')
+    parser.add_argument('--baseline', help='JSON file of a previous run to compare with.')
+    args = parser.parse_args()
+
+    app = AppFactory(args.config).get_app()
+    with app.app_context():
+        results = run(args.sizes, args.runs, args.seed)
+    report = {
+        'commit': git_commit(),
+        'created_at': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'runs': args.runs,
+        'seed': args.seed,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            compare(results, json.load(baseline))
+
+
+if __name__ == '__main__':
+    main()
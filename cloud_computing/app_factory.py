@@ -8,8 +8,12 @@ from flask_security import Security
 from flask_security import user_registered
 from flask_babelex import Babel
 
+from cloud_computing.commands import COMMANDS
 from cloud_computing.utils.db_setup import setup_database_data
+from cloud_computing.utils.page_cache import page_cache
 from cloud_computing.model.database import db, user_datastore
+from cloud_computing.model.fleet_index import fleet_index
+from cloud_computing.model.quote import component_catalog
 from cloud_computing.model import models
 from cloud_computing.view import admin as _adm, end_user as _user, unregistered_user as _unreg_user
 from cloud_computing.view.register import ExtendedRegisterForm
@@ -30,6 +34,7 @@ class AppFactory:
         self.__config_database_and_security()
         self.__config_flask_admin()
         self.__config_blueprints()
+        self.__config_commands()
 
         @babel.localeselector
         def get_locale():
@@ -138,6 +143,9 @@ class AppFactory:
 
     def __config_database_and_security(self):
         db.init_app(self.app)
+        fleet_index.max_age = self.app.config.get('FLEET_INDEX_MAX_AGE')
+        component_catalog.max_age = self.app.config.get('QUOTE_CATALOG_MAX_AGE')
+        page_cache.configure(self.app.config)
         self.__config_flask_security()
         setup_database_data(self.app)
 
@@ -146,3 +154,7 @@ class AppFactory:
 
     def __config_blueprints(self):
         self.app.register_blueprint(default_blueprint)
+
+    def __config_commands(self):
+        for command in COMMANDS:
+            self.app.cli.add_command(command)
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+
+import click
+from flask.cli import with_appcontext
+
+from cloud_computing.model.database import db
+from cloud_computing.controller.controller import Controller
+from cloud_computing.model.consolidation import plan_consolidation, apply_consolidation
+from cloud_computing.model.placement import get_placement_policy
+from cloud_computing.model.reconcile import reconcile_fleet
+from cloud_computing.model.simulator import fleet_snapshot, purchase_stream, synthetic_stream, simulate, RESOURCES
+from cloud_computing.model.models import Plan, PlanAvailability, Cpu, Gpu, Ram, Hd, update_plan_demand, \
+    update_plan_availability, update_plan_price, plans_using_components_query, release_expired_holds, \
+    expire_user_plans, rebuild_server_availability, backfill_allocation_ledger, merge_duplicate_plans
+
+
+@click.command('backfill-plan-demand')
+@with_appcontext
+def backfill_plan_demand():
+    """Recomputes the resource demand columns of every plan."""
+    update_plan_demand(db.session.connection(mapper=Plan.__mapper__))
+    db.session.commit()
+    click.echo('%d planos atualizados.' % Plan.query.count())
+
+
+@click.command('refresh-plan-availability')
+@with_appcontext
+def refresh_plan_availability():
+    """Recomputes the availability of every plan."""
+    update_plan_availability(db.session)
+    db.session.commit()
+    click.echo('%d de %d planos disponíveis.' % (PlanAvailability.query.filter_by(available=True).count(),
+                                                  PlanAvailability.query.count()))
+
+
+@click.command('plan-server-counts')
+@with_appcontext
+def plan_server_counts():
+    """Lists the public plans with the number of servers that can host them."""
+    for plan in Controller.get_plan_server_counts():
+        click.echo('%5d  %s' % (plan.server_count, plan.title))
+
+
+@click.command('release-expired-holds')
+@click.option('--limit', type=int, default=None, help='Máximo de reservas liberadas.')
+@with_appcontext
+def release_expired_holds_command(limit):
+    """Gives back the capacity of the expired checkout holds."""
+    released = release_expired_holds(db.session, limit=limit)
+    db.session.commit()
+    click.echo('%d reservas expiradas liberadas.' % released)
+
+
+@click.command('expire-user-plans')
+@click.option('--limit', type=int, default=None, help='Máximo de planos expirados.')
+@with_appcontext
+def expire_user_plans_command(limit):
+    """Expires the UserPlans past their end date and gives back their resources."""
+    report = expire_user_plans(db.session, limit=limit)
+    db.session.commit()
+    click.echo('%d planos expirados em %d servidores.' % (report.plans, report.servers))
+    click.echo('Liberados: %d cores, %d GB de RAM, %d GB de HD, %d GB de SSD, %d GB de GPU.'
+               % (report.cores, report.ram, report.hd, report.ssd, report.gpu))
+
+
+@click.command('backfill-allocation-ledger')
+@with_appcontext
+def backfill_allocation_ledger_command():
+    """Records on the allocation ledger the plans and holds allocated before it."""
+    recorded = backfill_allocation_ledger(db.session)
+    db.session.commit()
+    click.echo('%d alocações registradas.' % recorded)
+
+
+@click.command('rebuild-server-availability')
+@with_appcontext
+def rebuild_server_availability_command():
+    """Recomputes the available resources of every server from the allocation ledger."""
+    rebuilt = rebuild_server_availability(db.session)
+    db.session.commit()
+    click.echo('%d servidores recalculados.' % rebuilt)
+
+
+@click.command('reconcile-fleet')
+@click.option('--fix', is_flag=True, help='Corrige os contadores divergentes.')
+@with_appcontext
+def reconcile_fleet_command(fix):
+    """Recomputes the counters of every server and lists the ones that drifted."""
+    drifts = reconcile_fleet(db.session, fix=fix)
+    db.session.commit()
+    for drift in drifts:
+        click.echo('Servidor %d%s: %s = %s, esperado %s' % (
+            drift.server_id, ' (%s)' % drift.gpu_model if drift.gpu_model else '', drift.column,
+            drift.stored, drift.expected))
+    click.echo('%d contadores divergentes em %d servidores%s.' % (
+        len(drifts), len({drift.server_id for drift in drifts}), ', corrigidos' if fix and drifts else ''))
+
+
+@click.command('plan-consolidation')
+@click.option('--apply', 'apply_moves', is_flag=True, help='Executa as migrações planejadas.')
+@click.option('--budget', type=float, default=None, help='Segundos de busca.')
+@click.option('--max-moves', type=int, default=None, help='Máximo de planos migrados.')
+@with_appcontext
+def plan_consolidation_command(apply_moves, budget, max_moves):
+    """Plans the migrations that free whole servers and open space for the largest plan."""
+    consolidation = plan_consolidation(time_budget=budget, max_moves=max_moves)
+    for move in consolidation.moves:
+        click.echo('Plano %d: servidor %d -> %d' % (move.user_plan.id, move.user_plan.server_id, move.server_id))
+    click.echo('%d migrações, %d servidores liberados%s.' % (
+        len(consolidation.moves), len(consolidation.freed_servers),
+        '' if consolidation.complete else ' (busca interrompida)'))
+    if consolidation.target_plan is not None:
+        click.echo('%s: %s' % (consolidation.target_plan.title,
+                               'servidor %d' % consolidation.target_server
+                               if consolidation.target_server is not None else 'sem espaço'))
+    if apply_moves and consolidation.moves:
+        if not apply_consolidation(consolidation):
+            click.echo('Os servidores mudaram durante o planejamento, nada foi migrado.')
+        db.session.commit()
+
+
+@click.command('simulate-capacity')
+@click.option('--history', is_flag=True, help='Repete as compras do último ano na frota vazia.')
+@click.option('--purchases', type=int, default=10000, help='Compras sintéticas.')
+@click.option('--days', type=int, default=365, help='Dias simulados.')
+@click.option('--policy', default=None, help='Política de alocação, por padrão a da configuração.')
+@click.option('--clone', 'clones', multiple=True, help='SERVIDOR:CÓPIAS adicionadas à frota.')
+@click.option('--seed', type=int, default=0)
+@with_appcontext
+def simulate_capacity_command(history, purchases, days, policy, clones, seed):
+    """Simulates the demand in memory over a snapshot of the fleet."""
+    clones = dict(tuple(int(value) for value in clone.split(':')) for clone in clones)
+    snapshot = fleet_snapshot(db.session, empty=history, clones=clones)
+    if history:
+        stream = purchase_stream(db.session, since=datetime.datetime.now() - datetime.timedelta(days=days))
+    else:
+        stream = synthetic_stream(db.session, purchases=purchases, days=days, seed=seed)
+    report = simulate(snapshot, stream, get_placement_policy(policy))
+    click.echo('%d compras, %d recusadas (%.2f%%), %d por fragmentação, em %.1f s.' % (
+        report.purchases, report.rejected, 100 * report.rejection_rate, report.fragmented, report.seconds))
+    for resource in RESOURCES:
+        exhausted = report.exhausted[resource]
+        click.echo('%-5s  uso médio %5.1f%%  pico %5.1f%%  %s' % (
+            resource, 100 * report.utilization[resource], 100 * report.peak_utilization[resource],
+            'esgotado em %s' % exhausted.isoformat() if exhausted else ''))
+
+
+@click.command('reprice-plans')
+@click.option('--component', 'components', multiple=True,
+              help='TIPO:MODELO=PREÇO, com TIPO cpu, gpu, ram ou hd. Sem componentes recalcula todos os planos.')
+@click.option('--dry-run', is_flag=True, help='Mostra as diferenças de preço sem gravar.')
+@with_appcontext
+def reprice_plans_command(components, dry_run):
+    """Reprices the auto_price plans using the components, after setting their new prices."""
+    component_classes = {'cpu': Cpu, 'gpu': Gpu, 'ram': Ram, 'hd': Hd}
+    connection = db.session.connection(mapper=Plan.__mapper__)
+    changed = set()
+    for component in components:
+        name, _, price = component.partition('=')
+        kind, _, model = name.partition(':')
+        component_class = component_classes.get(kind.lower())
+        # UPDATE direto, sem o recálculo do flush, para que as diferenças sejam mostradas aqui
+        if component_class is None or not connection.execute(
+                component_class.__table__.update().where(component_class.__table__.c.model == model)
+                .values(price=float(price))).rowcount:
+            raise click.BadParameter('Componente %s não encontrado.' % name, param_hint='--component')
+        changed.add((component_class, model))
+    plan_ids = plans_using_components_query(changed) if changed else None
+    changes = update_plan_price(connection, plan_ids, dry_run=dry_run)
+    for change in changes:
+        click.echo('%-40s %10.2f -> %10.2f (%+.2f)' % (change.title, change.old_price or 0, change.new_price,
+                                                       change.new_price - (change.old_price or 0)))
+    if dry_run:
+        db.session.rollback()
+    else:
+        db.session.commit()
+    click.echo('%d planos %s.' % (len(changes), 'seriam recalculados' if dry_run else 'recalculados'))
+
+
+@click.command('merge-duplicate-plans')
+@with_appcontext
+def merge_duplicate_plans_command():
+    """Merges the custom plans with the same configuration and fills the config_hash of the plans."""
+    merged = merge_duplicate_plans(db.session)
+    db.session.commit()
+    click.echo('%d planos duplicados removidos.' % merged)
+
+
+COMMANDS = [backfill_plan_demand, refresh_plan_availability, plan_server_counts, release_expired_holds_command,
+            expire_user_plans_command, backfill_allocation_ledger_command, rebuild_server_availability_command,
+            reconcile_fleet_command, plan_consolidation_command, simulate_capacity_command,
+            reprice_plans_command, merge_duplicate_plans_command]
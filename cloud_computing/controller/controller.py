@@ -1,56 +1,92 @@
 # -*- coding: utf-8 -*-
 
-from cloud_computing.model.models import Plan, Gpu, Ram, Hd, PlanGpu, PlanRam, PlanHd
+from sqlalchemy.orm import undefer
+
+from cloud_computing.model.database import db
+from cloud_computing.model.models import Plan, PlanAvailability, hold_capacity, release_expired_holds, \
+    search_plans_query, plan_suggestions, component_suggestions, plan_detail
+from cloud_computing.model.quote import quote_plan
+from cloud_computing.utils.page_cache import suggestion_cache
+
+# Expired holds released before each new hold
+RELEASE_HOLDS_BATCH = 100
+
+# Plans on each page of the search results
+SEARCH_PAGE_SIZE = 12
+
+# Shortest input completed by the search suggestions, shorter ones have no trigrams to use the index
+SUGGESTION_MIN_LENGTH = 2
 
 
 class Controller:
     """Initial implementation of the controller class."""
     @staticmethod
     def get_available_plans():
-        """Queries the objects of type Plan on the database and ."""
-        available_plans = []
-        plans = Plan.query.filter_by(is_public=True).order_by(Plan.price)
-        for plan in plans:
-            if plan.available_servers(only_one=True) is not None:
-                available_plans.append(plan)
-        return available_plans
+        """Queries the public plans that fit on at least one server."""
+        return Plan.query.join(PlanAvailability) \
+            .filter(Plan.is_public == True, PlanAvailability.available == True) \
+            .order_by(Plan.price).all()
 
     @staticmethod
-    def get_plan_by_slug_url(slug_url):
-        """Queries the database for the Plan of slug 'slug_url'."""
-        return Plan.query.filter_by(slug_url=slug_url).first()
+    def get_plan_server_counts():
+        """Queries the public plans with the number of servers that can host each
+        one on the 'server_count' attribute, with a single statement."""
+        return Plan.query.options(undefer('server_count')) \
+            .filter(Plan.is_public == True).order_by(Plan.price).all()
+
+    @staticmethod
+    def hold_plan(plan, user_id):
+        """Holds the capacity of the plan for the user checkout and commits.
+
+        :return: the CapacityHold or None when no server fits the plan.
+        """
+        release_expired_holds(db.session, limit=RELEASE_HOLDS_BATCH)
+        hold = hold_capacity(plan, user_id)
+        db.session.commit()
+        return hold
 
     @staticmethod
-    def get_plan_gpu_list(plan_id):
-        """Queries the database for the gpus related to the plan_id.
+    def suggest(search_input, limit=8):
+        """Completes the search box with the public plans and the components
+        containing 'search_input', cached in memory.
 
-        Returns a list of pairs of Gpu objects with the quantity in
-        their relationship table.
+        :return: pair of lists, of (title, slug_url) of the plans and of the component models.
         """
-        return Gpu.query.join(PlanGpu, Gpu.model == PlanGpu.gpu_model) \
-            .add_columns(PlanGpu.quantity).filter(plan_id == PlanGpu.plan_id)
+        term = ' '.join(search_input.split()).lower()
+        if len(term) < SUGGESTION_MIN_LENGTH:
+            return [], []
+        return suggestion_cache.get_or_render('%d:%s' % (limit, term), lambda: (
+            plan_suggestions(term, limit), component_suggestions(term, limit)))
 
     @staticmethod
-    def get_plan_ram_list(plan_id):
-        """Queries the database for the ram memories related to the plan_id.
+    def quote_plan(cpu_model, os_name, duration_months, rams=None, hds=None, gpus=None):
+        """Prices a hypothetical plan and counts the servers where it fits, without
+        creating the plan. The components are dicts of model -> quantity.
 
-        Returns a list of pairs of Ram objects with the quantity in
-        their relationship table.
+        :return: the Quote.
+        :raise ValueError: when a component or the OS doesn't exist.
         """
-        return Ram.query.join(PlanRam, Ram.model == PlanRam.ram_model) \
-            .add_columns(PlanRam.quantity).filter(plan_id == PlanRam.plan_id)
+        return quote_plan(cpu_model, os_name, duration_months, rams, hds, gpus)
 
     @staticmethod
-    def get_plan_hd_list(plan_id):
-        """Queries the database for the hds related to the plan_id.
+    def get_plan_by_slug_url(slug_url):
+        """Queries the database for the Plan of slug 'slug_url'."""
+        return Plan.query.filter_by(slug_url=slug_url).first()
 
-        Returns a list of pairs of Hd objects with the quantity in
-        their relationship table.
+    @staticmethod
+    def get_plan_detail(slug_url):
+        """Queries the plan of slug 'slug_url' with its CPU and components in a
+        single statement.
+
+        :return: the read-only PlanDetail, or None.
         """
-        return Hd.query.join(PlanHd, Hd.model == PlanHd.hd_model) \
-            .add_columns(PlanHd.quantity).filter(plan_id == PlanHd.plan_id)
+        return plan_detail(slug_url)
 
     @staticmethod
-    def search_plan(search_input):
-        """Searches for plans that match 'search_input' on the database."""
-        return Plan.query.filter(Plan.title.ilike("%" + search_input + "%")).filter_by(is_public=True)
+    def search_plan(search_input, page=1, per_page=SEARCH_PAGE_SIZE):
+        """Searches the public plans matching 'search_input' on the title, the
+        description and the components, the best ranked first.
+
+        :return: the Pagination of the page.
+        """
+        return search_plans_query(search_input).paginate(page, per_page, error_out=False)
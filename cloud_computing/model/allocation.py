@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+from collections import namedtuple, Counter
+
+from sqlalchemy import and_, bindparam, func
+from sqlalchemy.orm import joinedload
+from wtforms import ValidationError
+
+from cloud_computing.model.database import db
+from cloud_computing.model.fleet_index import fleet_index
+from cloud_computing.model.models import Plan, UserPlan, UserPlanGpu, Server, ServerGpu, sync_fleet_index, \
+    allocate_server, touch_server, allocation_entries, record_allocation, refresh_changed_servers, expire_servers
+from cloud_computing.model.placement import get_placement_policy
+from cloud_computing.utils.form_utils import add_months
+
+AllocationResult = namedtuple('AllocationResult', ['placed', 'rejected'])
+"""Result of allocate_purchases: 'placed' is a list of (purchase, server_id) and
+'rejected' the purchases that didn't fit on any server."""
+
+Move = namedtuple('Move', ['user_plan', 'server_id', 'demand', 'used_gpus'])
+"""A UserPlan moving to 'server_id', where it reserves 'demand' and 'used_gpus'."""
+
+DrainResult = namedtuple('DrainResult', ['moved', 'unplaced'])
+"""Result of drain_servers: 'moved' is a list of Move and 'unplaced' the
+UserPlans that didn't fit on any other server."""
+
+
+def allocate_purchases(purchases, partial=False, policy=None):
+    """Places a batch of purchases on the servers in the current transaction.
+
+    All the purchases are ranked on one snapshot of the fleet index, the
+    placements already chosen are subtracted from the snapshot, and the
+    counters of the servers and GPUs are reserved with bulk guarded updates.
+    When a bulk update finds a server changed by another transaction the
+    purchases fall back to the per purchase allocation.
+    The purchases renewing a UserPlan don't need a server and are only added
+    to the session.
+
+    :param purchases: Purchase objects not flushed yet.
+    :param partial: when False and any purchase doesn't fit raises a
+                    ValidationError, otherwise the purchases that fit are kept.
+    :param policy: the PlacementPolicy, by default the one set on the app config.
+    :return: AllocationResult, the rejected purchases are not added to the session.
+    """
+    session = db.session
+    with session.no_autoflush:
+        result = _allocate_purchases(session, purchases, partial, policy or get_placement_policy())
+    for purchase in result.rejected:
+        # a compra pode ter entrado na sessão pelo backref do plano ou do usuário
+        if purchase in session:
+            session.expunge(purchase)
+    return result
+
+
+def _allocate_purchases(session, purchases, partial, policy):
+    renewals = [purchase for purchase in purchases if purchase_user_plan(purchase) is not None]
+    new = [purchase for purchase in purchases if purchase_user_plan(purchase) is None]
+
+    plan_ids = {purchase_plan_id(purchase) for purchase in new}
+    plans = {plan.id: plan for plan in Plan.query.filter(Plan.id.in_(plan_ids))} if plan_ids else {}
+    tenants = {}
+    if policy.uses_tenants and new:
+        tenants = user_tenants(session, {purchase_user_id(purchase) for purchase in new})
+
+    snapshot = sync_fleet_index(session).copy()
+    placements = []
+    rejected = []
+    for purchase in new:
+        plan = plans[purchase_plan_id(purchase)]
+        user_id = purchase_user_id(purchase)
+        demand = plan.get_demand()
+        user_tenants = tenants.setdefault(user_id, Counter())
+        fits = snapshot.fit(demand, plan.os_name, limit=1, policy=policy, tenants=user_tenants)
+        if not fits:
+            rejected.append(purchase)
+            continue
+        server_id, used_gpus = fits[0]
+        snapshot.allocate(snapshot.rows[server_id], demand, used_gpus)
+        user_tenants[server_id] += 1
+        placements.append((purchase, plan, user_id, server_id, demand, used_gpus))
+    check_rejected(rejected, partial)
+
+    connection = session.connection(mapper=Server.__mapper__)
+    if not reserve_servers(connection, [placement[3:] for placement in placements]):
+        # outro processo alterou os servidores, cada compra procura de novo o seu servidor
+        retried = []
+        for purchase, plan, user_id, _, demand, _ in placements:
+            allocation = allocate_server(connection, plan, user_id=user_id)
+            if allocation is None:
+                rejected.append(purchase)
+                continue
+            touch_server(session, allocation[0])
+            retried.append((purchase, plan, user_id, allocation[0], demand, allocation[1]))
+        check_rejected(rejected, partial)
+        placements = retried
+
+    allocated = session.info.setdefault('allocated_purchases', set())
+    placed = []
+    for purchase, plan, user_id, server_id, demand, used_gpus in placements:
+        user_plan = UserPlan(user_id=user_id, plan_id=plan.id, server_id=server_id)
+        user_plan.end_date = add_months(datetime.datetime.now(), plan.duration_months)
+        user_plan.set_usage(demand, used_gpus)
+        purchase.user_plan = user_plan
+        allocated.add(purchase)
+        session.add(purchase)
+        touch_server(session, server_id)
+        placed.append((purchase, server_id))
+    session.add_all(renewals)
+    return AllocationResult(placed, rejected)
+
+
+def reserve_servers(connection, reservations):
+    """Bulk version of reserve_server, the demand of the reservations on the same
+    server is summed and each table gets one guarded executemany.
+
+    :param reservations: list of (server_id, demand, used_gpus).
+    :return: True when every server was reserved, otherwise nothing is changed.
+    """
+    server, server_gpu = Server.__table__, ServerGpu.__table__
+    server_params, gpu_params = reservation_params(reservations)
+    if not server_params:
+        return True
+    columns = [(server.c.cores_available, bindparam('cores')), (server.c.ram_available, bindparam('ram')),
+               (server.c.hd_available, bindparam('hd')), (server.c.ssd_available, bindparam('ssd'))]
+
+    savepoint = connection.begin_nested()
+    try:
+        result = connection.execute(server.update()
+                                    .where(and_(server.c.id == bindparam('server_id'),
+                                                *[column >= amount for column, amount in columns]))
+                                    .values({column: column - amount for column, amount in columns}),
+                                    server_params)
+        reserved = result.rowcount == len(server_params)
+        if reserved and gpu_params:
+            result = connection.execute(server_gpu.update()
+                                        .where(and_(server_gpu.c.server_id == bindparam('gpu_server_id'),
+                                                    server_gpu.c.gpu_model == bindparam('model'),
+                                                    server_gpu.c.available_capacity >= bindparam('amount')))
+                                        .values(available_capacity=server_gpu.c.available_capacity -
+                                                bindparam('amount')),
+                                        gpu_params)
+            reserved = result.rowcount == len(gpu_params)
+    except Exception:
+        savepoint.rollback()
+        raise
+    if reserved:
+        savepoint.commit()
+    else:
+        savepoint.rollback()
+    return reserved
+
+
+def release_servers(connection, releases):
+    """Bulk version of release_server, gives back the resources of the releases
+    with one executemany for each table.
+
+    :param releases: list of (server_id, demand, used_gpus).
+    """
+    server, server_gpu = Server.__table__, ServerGpu.__table__
+    server_params, gpu_params = reservation_params(releases)
+    if server_params:
+        connection.execute(server.update()
+                           .where(server.c.id == bindparam('server_id'))
+                           .values(cores_available=server.c.cores_available + bindparam('cores'),
+                                   ram_available=server.c.ram_available + bindparam('ram'),
+                                   hd_available=server.c.hd_available + bindparam('hd'),
+                                   ssd_available=server.c.ssd_available + bindparam('ssd')),
+                           server_params)
+    if gpu_params:
+        connection.execute(server_gpu.update()
+                           .where(and_(server_gpu.c.server_id == bindparam('gpu_server_id'),
+                                       server_gpu.c.gpu_model == bindparam('model')))
+                           .values(available_capacity=server_gpu.c.available_capacity + bindparam('amount')),
+                           gpu_params)
+
+
+def reservation_params(reservations):
+    """Sums the demand of the reservations per server and per server GPU, sorted
+    by server so concurrent bulk updates lock the rows in the same order."""
+    totals = {}
+    gpu_totals = {}
+    for server_id, demand, used_gpus in reservations:
+        total = totals.setdefault(server_id, [0, 0, 0, 0])
+        for position, amount in enumerate([demand.cores, demand.ram, demand.hd, demand.ssd]):
+            total[position] += amount
+        for gpu_model, amount in used_gpus.items():
+            if amount > 0:
+                gpu_totals[(server_id, gpu_model)] = gpu_totals.get((server_id, gpu_model), 0) + amount
+    server_params = [{'server_id': server_id, 'cores': cores, 'ram': ram, 'hd': hd, 'ssd': ssd}
+                     for server_id, (cores, ram, hd, ssd) in sorted(totals.items())]
+    gpu_params = [{'gpu_server_id': server_id, 'model': gpu_model, 'amount': amount}
+                  for (server_id, gpu_model), amount in sorted(gpu_totals.items())]
+    return server_params, gpu_params
+
+
+def check_rejected(rejected, partial):
+    if rejected and not partial:
+        titles = sorted({purchase.plan.title if purchase.plan is not None else str(purchase.plan_id)
+                         for purchase in rejected})
+        raise ValidationError("Não existe servidor disponível para os planos: %s. Mande um pedido "
+                              "de recurso para os administradores ou compre outros planos" % ', '.join(titles))
+
+
+def purchase_plan_id(purchase):
+    return purchase.plan.id if purchase.plan is not None else purchase.plan_id
+
+
+def purchase_user_id(purchase):
+    return purchase.user.id if purchase.user is not None else purchase.user_id
+
+
+def purchase_user_plan(purchase):
+    return purchase.user_plan if purchase.user_plan is not None else purchase.user_plan_id
+
+
+def user_tenants(session, user_ids):
+    """Counter of the active UserPlans of each user on each server, used by the
+    policies with uses_tenants."""
+    tenants = {}
+    for user_id, server_id, count in session.query(UserPlan.user_id, UserPlan.server_id, func.count(UserPlan.id)) \
+            .filter(UserPlan.user_id.in_(user_ids), UserPlan.expired.is_(False)) \
+            .group_by(UserPlan.user_id, UserPlan.server_id):
+        tenants.setdefault(user_id, Counter())[server_id] = count
+    return tenants
+
+
+def drain_servers(server_ids, policy=None):
+    """Takes the servers out of service and moves their UserPlans to the other servers.
+
+    All the plans are placed on one snapshot of the fleet index, the largest
+    first, and moved together by move_user_plans. When the bulk reservation
+    finds a server changed by another transaction the index is synced and the
+    plans are placed again, once.
+
+    :return: DrainResult, the unplaced UserPlans stay on the drained servers.
+    """
+    session = db.session
+    policy = policy or get_placement_policy()
+    server = Server.__table__
+    session.connection(mapper=Server.__mapper__).execute(server.update()
+                                                         .where(server.c.id.in_(server_ids))
+                                                         .values(in_service=False))
+    for server_id in server_ids:
+        touch_server(session, server_id)
+    user_plans = UserPlan.query.options(joinedload(UserPlan.plan), joinedload(UserPlan.gpus)) \
+        .filter(UserPlan.server_id.in_(server_ids), UserPlan.expired.is_(False)) \
+        .order_by(UserPlan.id).all()
+
+    for _ in range(2):
+        moves, unplaced = plan_moves(session, user_plans, policy)
+        if move_user_plans(session, moves):
+            break
+        fleet_index.mark_dirty(*[move.server_id for move in moves])
+    else:
+        raise ValidationError("Os servidores foram alterados durante a migração. Tente novamente.")
+    refresh_changed_servers(session, set(server_ids) | {move.server_id for move in moves})
+    return DrainResult(moves, unplaced)
+
+
+def plan_moves(session, user_plans, policy):
+    """Places the UserPlans on a snapshot of the fleet index, the largest first.
+
+    :return: (moves, unplaced)
+    """
+    snapshot = sync_fleet_index(session).copy()
+    tenants = user_tenants(session, {user_plan.user_id for user_plan in user_plans}) if policy.uses_tenants else {}
+    demands = {user_plan.id: user_plan.plan.get_demand() for user_plan in user_plans}
+    moves = []
+    unplaced = []
+    for user_plan in sorted(user_plans, key=lambda user_plan: demand_size(demands[user_plan.id]), reverse=True):
+        demand = demands[user_plan.id]
+        plan_tenants = tenants.setdefault(user_plan.user_id, Counter())
+        fits = [fit for fit in snapshot.fit(demand, user_plan.plan.os_name, policy=policy, tenants=plan_tenants)
+                if fit[0] != user_plan.server_id][:1]
+        if not fits:
+            unplaced.append(user_plan)
+            continue
+        server_id, used_gpus = fits[0]
+        snapshot.allocate(snapshot.rows[server_id], demand, used_gpus)
+        plan_tenants[server_id] += 1
+        moves.append(Move(user_plan, server_id, demand, used_gpus))
+    return moves, unplaced
+
+
+def demand_size(demand):
+    return demand.cores, demand.ram, demand.hd, demand.ssd, sum(amount for _, amount in demand.gpus)
+
+
+def move_user_plans(session, moves):
+    """Moves the UserPlans to their new servers in the current transaction, the
+    bulk version of UserPlan.update_server.
+
+    The new servers are reserved with the guarded bulk updates, the old usage
+    of each plan is given back and both are recorded on the allocation ledger.
+
+    :param moves: list of Move.
+    :return: True when every new server was reserved, otherwise nothing is changed.
+    """
+    if not moves:
+        return True
+    connection = session.connection(mapper=Server.__mapper__)
+    if not reserve_servers(connection, [(move.server_id, move.demand, move.used_gpus) for move in moves]):
+        return False
+
+    releases = []
+    entries = []
+    for move in moves:
+        user_plan = move.user_plan
+        demand, used_gpus = user_plan.get_usage()
+        releases.append((user_plan.server_id, demand, used_gpus))
+        entries += allocation_entries(user_plan.server_id, demand, used_gpus, 'moved', sign=-1,
+                                      user_plan_id=user_plan.id)
+        entries += allocation_entries(move.server_id, move.demand, move.used_gpus, 'moved',
+                                      user_plan_id=user_plan.id)
+    release_servers(connection, releases)
+    record_allocation(connection, entries)
+
+    user_plan_table, user_plan_gpu = UserPlan.__table__, UserPlanGpu.__table__
+    connection.execute(user_plan_table.update()
+                       .where(user_plan_table.c.id == bindparam('user_plan_id'))
+                       .values(server_id=bindparam('new_server_id'), cores=bindparam('new_cores'),
+                               ram=bindparam('new_ram'), hd=bindparam('new_hd'), ssd=bindparam('new_ssd')),
+                       [{'user_plan_id': move.user_plan.id, 'new_server_id': move.server_id,
+                         'new_cores': move.demand.cores, 'new_ram': move.demand.ram,
+                         'new_hd': move.demand.hd, 'new_ssd': move.demand.ssd} for move in moves])
+    connection.execute(user_plan_gpu.delete()
+                       .where(user_plan_gpu.c.user_plan_id.in_([move.user_plan.id for move in moves])))
+    gpus = [{'user_plan_id': move.user_plan.id, 'gpu_model': gpu_model, 'amount': amount}
+            for move in moves for gpu_model, amount in sorted(move.used_gpus.items()) if amount > 0]
+    if gpus:
+        connection.execute(user_plan_gpu.insert(), gpus)
+
+    server_ids = {server_id for server_id, _, _ in releases} | {move.server_id for move in moves}
+    for server_id in server_ids:
+        touch_server(session, server_id)
+    expire_servers(session, server_ids)
+    for move in moves:
+        session.expire(move.user_plan)
+    return True
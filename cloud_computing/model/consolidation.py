@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+import time
+from collections import namedtuple
+
+from flask import current_app
+from sqlalchemy.orm import joinedload
+
+from cloud_computing.model.allocation import Move, move_user_plans, demand_size
+from cloud_computing.model.database import db
+from cloud_computing.model.models import Plan, UserPlan, Server, sync_fleet_index
+from cloud_computing.model.placement import PLACEMENT_POLICIES
+
+ConsolidationPlan = namedtuple('ConsolidationPlan', ['moves', 'freed_servers', 'target_plan', 'target_server',
+                                                     'complete'])
+"""Result of plan_consolidation: the list of Move, the servers left without
+plans, the plan the space was opened for and the server where it fits now (or
+None), and False when the time budget or max_moves stopped the search."""
+
+
+def plan_consolidation(time_budget=None, max_moves=None, target_plan=None, policy=None):
+    """Plans the UserPlan migrations that consolidate the fleet, without changing it.
+
+    Works on a copy of the fleet index. When the target plan, by default the
+    largest public plan, doesn't fit on any server, the server needing the
+    fewest evictions is opened for it first. Then the servers with the
+    fewest plans are evacuated whole, each one only when all of its plans fit
+    on the other servers (first fit decreasing, ranked by 'policy', best-fit
+    by default). Each step is undone on the copy when it fails.
+
+    :param time_budget: seconds of search, by default CONSOLIDATION_TIME_BUDGET.
+    :param max_moves: maximum number of plans moved.
+    :return: ConsolidationPlan, applied by apply_consolidation.
+    """
+    if time_budget is None:
+        time_budget = current_app.config.get('CONSOLIDATION_TIME_BUDGET', 5)
+    planner = Planner(policy or PLACEMENT_POLICIES['best-fit'](), time.monotonic() + time_budget, max_moves)
+    if target_plan is None:
+        public_plans = Plan.query.filter(Plan.is_public.is_(True)).all()
+        target_plan = max(public_plans, key=lambda plan: demand_size(plan.get_demand()), default=None)
+
+    target_server = None
+    if target_plan is not None:
+        target_server = planner.open_space(target_plan)
+    freed = planner.free_servers(exclude={target_server})
+    moves = [Move(user_plan, server_id, planner.demands[user_plan.id], planner.used_gpus[user_plan.id])
+             for user_plan, server_id in planner.destinations()]
+    return ConsolidationPlan(moves, freed, target_plan, target_server, not planner.stopped)
+
+
+def apply_consolidation(consolidation):
+    """Moves the plans of the consolidation in the current transaction.
+
+    :return: False when a server changed since the planning, nothing is moved.
+    """
+    return move_user_plans(db.session, consolidation.moves)
+
+
+class Planner:
+    """The state of the consolidation search over a copy of the fleet index."""
+
+    def __init__(self, policy, deadline, max_moves):
+        self.policy = policy
+        self.deadline = deadline
+        self.max_moves = max_moves
+        self.stopped = False
+        self.index = sync_fleet_index().copy()
+        self.user_plans = [user_plan for user_plan in UserPlan.query
+                           .options(joinedload(UserPlan.plan), joinedload(UserPlan.gpus))
+                           .join(Server, Server.id == UserPlan.server_id)
+                           .filter(UserPlan.expired.is_(False), Server.in_service.is_(True))
+                           .order_by(UserPlan.id)
+                           if user_plan.server_id in self.index.rows]
+        self.demands = {user_plan.id: user_plan.plan.get_demand() for user_plan in self.user_plans}
+        self.usages = {user_plan.id: user_plan.get_usage() for user_plan in self.user_plans}
+        self.used_gpus = {}
+        # servidor atual de cada plano na cópia do índice
+        self.servers = {}
+        self.on_server = {}
+        for user_plan in self.user_plans:
+            self.servers[user_plan.id] = user_plan.server_id
+            self.on_server.setdefault(user_plan.server_id, []).append(user_plan)
+        self.moved = set()
+
+    def destinations(self):
+        return [(user_plan, self.servers[user_plan.id]) for user_plan in self.user_plans
+                if user_plan.id in self.moved and self.servers[user_plan.id] != user_plan.server_id]
+
+    def plans_on(self, server_id):
+        return list(self.on_server.get(server_id, ()))
+
+    def exceeds_max_moves(self, user_plans):
+        return self.max_moves is not None and \
+            len(self.moved | {user_plan.id for user_plan in user_plans}) > self.max_moves
+
+    def out_of_time(self):
+        if time.monotonic() > self.deadline:
+            self.stopped = True
+        return self.stopped
+
+    def open_space(self, plan):
+        """Evicts the fewest plans from one server so 'plan' fits on it.
+
+        :return: the server where the plan fits, or None.
+        """
+        demand = plan.get_demand()
+        fits = self.index.fit(demand, plan.os_name, limit=1)
+        if fits:
+            return fits[0][0]
+        os_code = self.index.os_codes.get(plan.os_name)
+        if os_code is None:
+            return None
+        candidates = [int(server_id) for server_id in self.index.server_ids[self.index.server_os == os_code]]
+        for server_id in sorted(candidates, key=lambda server_id: (len(self.on_server.get(server_id, ())),
+                                                                   server_id)):
+            if self.out_of_time():
+                return None
+            evicted = []
+            on_server = sorted(self.plans_on(server_id), key=lambda user_plan: demand_size(self.demands[user_plan.id]),
+                               reverse=True)
+            for user_plan in on_server:
+                evicted.append(user_plan)
+                self.remove(user_plan)
+                if self.index.fit(demand, plan.os_name, server_id=server_id, limit=1):
+                    break
+            else:
+                self.undo_removals(evicted)
+                continue
+            if not self.exceeds_max_moves(evicted) and self.evacuate(evicted, exclude={server_id}):
+                return server_id
+            self.undo_removals(evicted)
+        return None
+
+    def free_servers(self, exclude):
+        """Evacuates whole servers, the ones with the fewest plans first.
+
+        :return: the freed servers.
+        """
+        freed = []
+        occupied = {server_id for server_id, user_plans in self.on_server.items() if user_plans}
+        for server_id in sorted(occupied - exclude, key=lambda server_id: (len(self.on_server[server_id]),
+                                                                           server_id)):
+            if self.out_of_time():
+                break
+            on_server = self.plans_on(server_id)
+            if not on_server or self.exceeds_max_moves(on_server):
+                continue
+            for user_plan in on_server:
+                self.remove(user_plan)
+            if self.evacuate(on_server, exclude=set(freed) | exclude | {server_id}):
+                freed.append(server_id)
+            else:
+                self.undo_removals(on_server)
+        return freed
+
+    def evacuate(self, user_plans, exclude):
+        """Places the removed plans on the servers not in 'exclude', the largest
+        first. When one doesn't fit the placements are undone.
+
+        :return: True when every plan was placed.
+        """
+        excluded_rows = [self.index.rows[server_id] for server_id in exclude if server_id in self.index.rows]
+        os_codes = self.index.server_os[excluded_rows].copy()
+        self.index.server_os[excluded_rows] = -1
+        placed = []
+        try:
+            for user_plan in sorted(user_plans, key=lambda user_plan: demand_size(self.demands[user_plan.id]),
+                                    reverse=True):
+                demand = self.demands[user_plan.id]
+                fits = self.index.fit(demand, user_plan.plan.os_name, limit=1, policy=self.policy)
+                if not fits:
+                    for placed_plan, server_id, used_gpus in placed:
+                        self.index.allocate(self.index.rows[server_id], self.demands[placed_plan.id], used_gpus,
+                                            sign=-1)
+                    return False
+                server_id, used_gpus = fits[0]
+                self.index.allocate(self.index.rows[server_id], demand, used_gpus)
+                placed.append((user_plan, server_id, used_gpus))
+        finally:
+            self.index.server_os[excluded_rows] = os_codes
+        for user_plan, server_id, used_gpus in placed:
+            self.on_server[self.servers[user_plan.id]].remove(user_plan)
+            self.on_server.setdefault(server_id, []).append(user_plan)
+            self.servers[user_plan.id] = server_id
+            self.used_gpus[user_plan.id] = used_gpus
+            self.moved.add(user_plan.id)
+        return True
+
+    def remove(self, user_plan):
+        """Gives back on the index copy the resources of the plan on its current server."""
+        self.index.allocate(self.index.rows[self.servers[user_plan.id]], *self.current_usage(user_plan), sign=-1)
+
+    def undo_removals(self, user_plans):
+        for user_plan in user_plans:
+            self.index.allocate(self.index.rows[self.servers[user_plan.id]], *self.current_usage(user_plan))
+
+    def current_usage(self, user_plan):
+        if user_plan.id in self.moved:
+            return self.demands[user_plan.id], self.used_gpus[user_plan.id]
+        return self.usages[user_plan.id]
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from cloud_computing.model.gpu_matcher import match_gpus
+from cloud_computing.model.placement import sort_rows
+
+# Columns of the FleetIndex.capacity matrix
+CORES, RAM, HD, SSD = range(4)
+
+PlanDemand = namedtuple('PlanDemand', ['cores', 'ram', 'hd', 'ssd', 'gpus'])
+"""Resources requested by a plan. 'gpus' is a list of (frequency, capacity) pairs,
+one for each GPU of the plan, that must fit entirely on one GPU of the server."""
+
+
+class FleetIndex:
+    """In-process capacity index of the servers.
+
+    Keeps one row per server with the free cores, RAM, HD and SSD, and the free
+    GPU capacity of each frequency class, so the servers that fit a plan are
+    found with masked array comparisons instead of one query per server.
+    The rows are loaded from the database and refreshed only for the servers
+    marked as dirty by the Server/ServerGpu/ServerRam/ServerHd events.
+    """
+
+    def __init__(self, max_age=None):
+        self.max_age = max_age
+        self.lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        """Drops all rows, the index is loaded again on the next sync."""
+        with self.lock:
+            self.loaded = False
+            self.loaded_at = None
+            self.dirty = set()
+            self.rows = {}
+            self.os_codes = {}
+            self.gpu_classes = {}
+            self.server_ids = np.zeros(0, dtype=np.int64)
+            self.server_os = np.zeros(0, dtype=np.int32)
+            self.capacity = np.zeros((0, 4), dtype=np.int64)
+            self.gpu_free = np.zeros((0, 0), dtype=np.int64)
+            self.gpu_max = np.zeros((0, 0), dtype=np.int64)
+            self.gpus = []
+            self.scale = None
+            self.id_order = None
+
+    def copy(self):
+        """Snapshot of the index, placements can be tried on it without changing
+        the shared index."""
+        with self.lock:
+            index = FleetIndex(self.max_age)
+            index.loaded, index.loaded_at = self.loaded, self.loaded_at
+            index.rows = dict(self.rows)
+            index.os_codes = dict(self.os_codes)
+            index.gpu_classes = dict(self.gpu_classes)
+            index.server_ids = self.server_ids.copy()
+            index.server_os = self.server_os.copy()
+            index.capacity = self.capacity.copy()
+            index.gpu_free = self.gpu_free.copy()
+            index.gpu_max = self.gpu_max.copy()
+            index.gpus = [dict(gpus) for gpus in self.gpus]
+            index.scale = self.scale
+            index.id_order = self.id_order
+            return index
+
+    def invalidate(self):
+        """Forces a full reload on the next sync."""
+        with self.lock:
+            self.loaded = False
+
+    def mark_dirty(self, *server_ids):
+        """Marks servers whose rows must be reloaded on the next sync."""
+        with self.lock:
+            self.dirty.update(server_id for server_id in server_ids if server_id is not None)
+
+    def needs_reload(self):
+        if not self.loaded:
+            return True
+        return self.max_age is not None and time.time() - self.loaded_at > self.max_age
+
+    def pop_dirty(self):
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+            return dirty
+
+    def load(self, server_rows, gpu_rows):
+        """Rebuilds the whole index.
+
+        :param server_rows: (id, os_name, cores, ram, hd, ssd) of each server.
+        :param gpu_rows: (server_id, gpu_model, frequency, available_capacity)
+                         of each GPU installed on the servers.
+        """
+        with self.lock:
+            self.clear()
+            server_rows = sorted(server_rows, key=lambda row: row[0])
+            self.server_ids = np.array([row[0] for row in server_rows], dtype=np.int64)
+            self.server_os = np.array([self._os_code(row[1]) for row in server_rows], dtype=np.int32)
+            self.capacity = np.array([[value or 0 for value in row[2:6]] for row in server_rows],
+                                     dtype=np.int64).reshape(len(server_rows), 4)
+            self.rows = {row[0]: position for position, row in enumerate(server_rows)}
+            self.gpus = [{} for _ in server_rows]
+            for server_id, gpu_model, frequency, available in gpu_rows:
+                if server_id in self.rows:
+                    self.gpus[self.rows[server_id]][gpu_model] = (frequency, available or 0)
+            self.gpu_free = np.zeros((len(server_rows), 0), dtype=np.int64)
+            self.gpu_max = np.zeros((len(server_rows), 0), dtype=np.int64)
+            for row in range(len(server_rows)):
+                self._update_gpu_columns(row)
+            self.loaded = True
+            self.loaded_at = time.time()
+
+    def update(self, server_ids, server_rows, gpu_rows):
+        """Reloads the rows of 'server_ids'. Servers missing from 'server_rows'
+        were deleted and no longer fit any plan."""
+        with self.lock:
+            self.scale = None
+            found = set()
+            for server_id, os_name, cores, ram, hd, ssd in server_rows:
+                row = self._row(server_id)
+                self.server_os[row] = self._os_code(os_name)
+                self.capacity[row] = [cores or 0, ram or 0, hd or 0, ssd or 0]
+                self.gpus[row] = {}
+                found.add(server_id)
+            for server_id, gpu_model, frequency, available in gpu_rows:
+                self.gpus[self.rows[server_id]][gpu_model] = (frequency, available or 0)
+            for server_id in server_ids:
+                row = self.rows.get(server_id)
+                if row is None:
+                    continue
+                if server_id not in found:
+                    self.server_os[row] = -1
+                    self.capacity[row] = 0
+                    self.gpus[row] = {}
+                self._update_gpu_columns(row)
+
+    def fit(self, demand, os_name, server_id=None, limit=None, policy=None, tenants=None):
+        """Finds the servers with enough free resources for 'demand'.
+
+        :param policy: PlacementPolicy used to rank the servers, by default
+                       they are ordered by id.
+        :param tenants: dict of server_id -> plans of the same user, used by
+                        the policies with uses_tenants.
+        :return: ranked list of (server_id, used_gpus), where used_gpus maps
+                 the server GPU models to the capacity used.
+        """
+        with self.lock:
+            mask = self.fit_mask(demand, os_name, server_id)
+            if mask is None:
+                return []
+            rows = np.flatnonzero(mask)
+            ranked = self._rank(rows, demand, policy, tenants, limit)
+            fits = self._match_rows(ranked, demand, limit)
+            if limit is not None and len(fits) < limit and len(ranked) < len(rows):
+                # the GPUs of the preferred servers didn't match, ranks them all
+                fits = self._match_rows(self._rank(rows, demand, policy, tenants), demand, limit)
+            return fits
+
+    def fit_mask(self, demand, os_name, server_id=None):
+        """Boolean mask of the rows that may host 'demand'.
+
+        GPUs are only checked by the total and the largest free capacity of
+        each frequency class, the exact assignment is done by match_gpus.
+        Returns None when no row can fit.
+        """
+        os_code = self.os_codes.get(os_name)
+        if os_code is None:
+            return None
+        mask = self.server_os == os_code
+        if server_id is not None:
+            mask &= self.server_ids == server_id
+        enough = self.capacity >= np.array([demand.cores, demand.ram, demand.hd, demand.ssd])
+        mask &= enough[:, CORES] & enough[:, RAM] & enough[:, HD] & enough[:, SSD]
+        totals = {}
+        for frequency, amount in demand.gpus:
+            totals.setdefault(frequency, []).append(amount)
+        for frequency, amounts in totals.items():
+            column = self.gpu_classes.get(frequency)
+            if column is None:
+                return None
+            mask &= self.gpu_free[:, column] >= sum(amounts)
+            mask &= self.gpu_max[:, column] >= max(amounts)
+        return mask
+
+    def match_gpus(self, row, gpus):
+        """Assigns each plan GPU to one GPU of the server with the same frequency.
+
+        :return: the used_gpus dict or None when the GPUs don't fit.
+        """
+        return match_gpus(self.gpus[row], gpus)
+
+    def allocate(self, row, demand, used_gpus, sign=1):
+        """Subtracts (or gives back, with sign=-1) the resources of a placement."""
+        with self.lock:
+            self.capacity[row] -= sign * np.array([demand.cores, demand.ram, demand.hd, demand.ssd])
+            for gpu_model, amount in used_gpus.items():
+                frequency, available = self.gpus[row][gpu_model]
+                self.gpus[row][gpu_model] = (frequency, available - sign * amount)
+            self._update_gpu_columns(row)
+
+    def capacity_scale(self):
+        """Largest free cores, RAM, HD and SSD of a server, used to weigh the
+        resources against each other. Computed when the rows are loaded or
+        updated, the allocations don't change it."""
+        with self.lock:
+            if self.scale is None:
+                self.scale = np.maximum(self.capacity.max(axis=0), 1) if len(self.capacity) else np.ones(4)
+            return self.scale
+
+    def os_names(self, server_ids):
+        """Operating systems of the servers on the index."""
+        with self.lock:
+            names = {code: os_name for os_name, code in self.os_codes.items()}
+            return {names[self.server_os[self.rows[server_id]]] for server_id in server_ids
+                    if server_id in self.rows and self.server_os[self.rows[server_id]] in names}
+
+    def rows_of(self, server_ids):
+        """Rows of the 'server_ids' array, -1 for the servers not on the index.
+        Searched on the ids sorted once, instead of a dict lookup per server."""
+        with self.lock:
+            if not len(self.server_ids):
+                return np.full(len(server_ids), -1, dtype=np.int64)
+            if self.id_order is None:
+                order = np.argsort(self.server_ids, kind='stable')
+                self.id_order = (order, self.server_ids[order])
+            order, sorted_ids = self.id_order
+            positions = np.minimum(np.searchsorted(sorted_ids, server_ids), len(sorted_ids) - 1)
+            return np.where(sorted_ids[positions] == server_ids, order[positions], -1)
+
+    def _rank(self, rows, demand, policy, tenants, limit=None):
+        if policy is None:
+            return sort_rows(rows, [self.server_ids[rows]], limit)
+        return policy.rank(self, rows, demand, tenants, limit=limit)
+
+    def _match_rows(self, rows, demand, limit):
+        fits = []
+        for row in rows:
+            used_gpus = self.match_gpus(row, demand.gpus) if demand.gpus else {}
+            if used_gpus is None:
+                continue
+            fits.append((int(self.server_ids[row]), used_gpus))
+            if limit is not None and len(fits) >= limit:
+                break
+        return fits
+
+    def _os_code(self, os_name):
+        if os_name is None:
+            return -1
+        return self.os_codes.setdefault(os_name, len(self.os_codes))
+
+    def _gpu_column(self, frequency):
+        column = self.gpu_classes.get(frequency)
+        if column is None:
+            column = self.gpu_classes[frequency] = len(self.gpu_classes)
+            new_column = np.zeros((len(self.server_ids), 1), dtype=np.int64)
+            self.gpu_free = np.hstack([self.gpu_free, new_column])
+            self.gpu_max = np.hstack([self.gpu_max, new_column])
+        return column
+
+    def _row(self, server_id):
+        row = self.rows.get(server_id)
+        if row is None:
+            row = self.rows[server_id] = len(self.server_ids)
+            self.server_ids = np.append(self.server_ids, server_id)
+            self.id_order = None
+            self.server_os = np.append(self.server_os, -1).astype(np.int32)
+            self.capacity = np.vstack([self.capacity, np.zeros((1, 4), dtype=np.int64)])
+            self.gpu_free = np.vstack([self.gpu_free, np.zeros((1, len(self.gpu_classes)), dtype=np.int64)])
+            self.gpu_max = np.vstack([self.gpu_max, np.zeros((1, len(self.gpu_classes)), dtype=np.int64)])
+            self.gpus.append({})
+        return row
+
+    def _update_gpu_columns(self, row):
+        self.gpu_free[row] = 0
+        self.gpu_max[row] = 0
+        for frequency, available in self.gpus[row].values():
+            column = self._gpu_column(frequency)
+            self.gpu_free[row, column] += available
+            self.gpu_max[row, column] = max(self.gpu_max[row, column], available)
+
+
+fleet_index = FleetIndex()
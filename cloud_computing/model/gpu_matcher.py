@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+
+def match_gpus(server_gpus, plan_gpus):
+    """Assigns each GPU of a plan to one GPU of the server with the same frequency.
+
+    Several plan GPUs may share the capacity of one server GPU, but a plan GPU
+    can't be split between server GPUs. The demand is grouped by frequency
+    class and checked against the bucket of server GPUs of that class: a bucket
+    with one server GPU only needs the sum of the demand to fit, when several
+    GPU models share a frequency the first-fit decreasing assignment is tried
+    and, if it fails, an exact search over the assignments.
+
+    :param server_gpus: dict of gpu_model -> (frequency, capacity).
+    :param plan_gpus: list of (frequency, capacity) of each plan GPU.
+    :return: dict of gpu_model -> capacity used (the used_gpus), or None
+             when the plan GPUs don't fit.
+    """
+    buckets = {}
+    for gpu_model, (frequency, capacity) in server_gpus.items():
+        buckets.setdefault(frequency, []).append((gpu_model, capacity))
+    demand = {}
+    for frequency, amount in plan_gpus:
+        if amount > 0:
+            demand.setdefault(frequency, []).append(amount)
+
+    used_gpus = {}
+    for frequency, amounts in demand.items():
+        bucket = buckets.get(frequency)
+        if bucket is None:
+            return None
+        used = _match_bucket(sorted(bucket), sorted(amounts, reverse=True))
+        if used is None:
+            return None
+        used_gpus.update(used)
+    return used_gpus
+
+
+def _match_bucket(bucket, amounts):
+    """Matches the demand of one frequency class, 'amounts' sorted from the largest."""
+    capacities = [capacity for _, capacity in bucket]
+    if sum(amounts) > sum(capacities) or amounts[0] > max(capacities):
+        return None
+    if len(bucket) == 1:
+        return {bucket[0][0]: sum(amounts)}
+
+    assignment = _first_fit(amounts, capacities)
+    if assignment is None:
+        assignment = _exact_fit(amounts, capacities)
+        if assignment is None:
+            return None
+    used = {}
+    for amount, position in zip(amounts, assignment):
+        gpu_model = bucket[position][0]
+        used[gpu_model] = used.get(gpu_model, 0) + amount
+    return used
+
+
+def _first_fit(amounts, capacities):
+    free = list(capacities)
+    assignment = []
+    for amount in amounts:
+        for position, capacity in enumerate(free):
+            if capacity >= amount:
+                free[position] -= amount
+                assignment.append(position)
+                break
+        else:
+            return None
+    return assignment
+
+
+def _exact_fit(amounts, capacities):
+    """Depth first search over the assignments. GPUs with the same free capacity
+    are interchangeable, so only one of them is tried for each plan GPU, and
+    the states already known to fail are skipped."""
+    free = list(capacities)
+    assignment = []
+    failed = set()
+
+    def search(item):
+        if item == len(amounts):
+            return True
+        state = (item, tuple(sorted(free)))
+        if state in failed:
+            return False
+        tried = set()
+        for position, capacity in enumerate(free):
+            if capacity < amounts[item] or capacity in tried:
+                continue
+            tried.add(capacity)
+            free[position] -= amounts[item]
+            assignment.append(position)
+            if search(item + 1):
+                return True
+            assignment.pop()
+            free[position] += amounts[item]
+        failed.add(state)
+        return False
+
+    if search(0):
+        return assignment
+    return None
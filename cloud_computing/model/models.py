@@ -1,14 +1,25 @@
 # -*- coding: utf-8 -*-
 
 import datetime
+import hashlib
+import threading
+from collections import namedtuple
+from flask import current_app
 from slugify import slugify
 from wtforms import ValidationError
 from flask_security import RoleMixin, UserMixin
-from sqlalchemy import func, event
+from sqlalchemy import func, event, and_, or_, select, bindparam, inspect, exists, any_, null, union_all, union, \
+    false, literal, cast
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import aggregate_order_by
 from sqlalchemy.ext.declarative import declared_attr
-from sqlalchemy.orm import validates, Session
+from sqlalchemy.orm import validates, Session, object_session, column_property, joinedload
+from sqlalchemy.orm.util import identity_key
 
 from cloud_computing.model.database import db
+from cloud_computing.model.fleet_index import fleet_index, FleetIndex, PlanDemand
+from cloud_computing.model.gpu_matcher import match_gpus
+from cloud_computing.model.placement import get_placement_policy
 from cloud_computing.utils.form_utils import add_months
 
 # Create a table to support many-to-many relationship between Users and Roles
@@ -69,6 +80,19 @@ class Plan(db.Model):
     hero_image = db.Column(db.Text, default='http://placehold.it/900x400')
     is_public = db.Column(db.Boolean, default='false')
     auto_price = db.Column(db.Boolean, default=True)
+    # Resources used by the plan, kept up to date by the Plan/PlanGpu/PlanRam/PlanHd events
+    demand_cores = db.Column(db.Integer)
+    demand_ram = db.Column(db.Integer)
+    demand_hd = db.Column(db.Integer)
+    demand_ssd = db.Column(db.Integer)
+    # List of [frequency, capacity] of each GPU of the plan
+    demand_gpus = db.Column(db.JSON)
+    # Plans created by the users, reused when the same configuration is asked again
+    is_custom = db.Column(db.Boolean, default=False)
+    # md5 of the CPU, OS, duration and components of the plan, see config_hash
+    config_hash = db.Column(db.Text)
+    # Title, description and component names, see update_plan_search_vector
+    search_vector = db.deferred(db.Column(postgresql.TSVECTOR))
 
     os = db.relationship('Os', backref=db.backref('plans'))
     cpu = db.relationship('Cpu', backref=db.backref('plans'))
@@ -82,37 +106,32 @@ class Plan(db.Model):
         self.slug_url = slugify(value)
         return value
 
+    __table_args__ = (db.Index('ix_plan_custom_config_hash', 'config_hash', unique=True,
+                               postgresql_where=db.text('is_custom')),
+                      db.Index('ix_plan_search_vector', 'search_vector', postgresql_using='gin'))
+
     def __str__(self):
         return self.title
 
-    @validates('auto_price')
-    def auto_price_update(self, key, value):
-        if value is True:
-            self.price = -1
-        return value
-
-    @validates('price')
-    def price_update(self, key, value):
-        if self.auto_price is True:
-            if self.cpu_model is not None:
-                return self.calculate_price()
-        return value
-
-    @validates('cpu')
-    def cpu_update(self, key, value):
-        if self.auto_price is True:
-            self.price = -1
-        return value
+    def get_config_hash(self):
+        """The config_hash of the plan from its relationships, also for a plan not flushed yet."""
+        components = [('gpu', plan_gpu.gpu.model if plan_gpu.gpu else plan_gpu.gpu_model, plan_gpu.quantity)
+                      for plan_gpu in self.plan_gpus]
+        components += [('hd', plan_hd.hd.model if plan_hd.hd else plan_hd.hd_model, plan_hd.quantity)
+                       for plan_hd in self.plan_hds]
+        components += [('ram', plan_ram.ram.model if plan_ram.ram else plan_ram.ram_model, plan_ram.quantity)
+                       for plan_ram in self.plan_rams]
+        return config_hash(self.cpu.model if self.cpu else self.cpu_model, self.os.name if self.os else self.os_name,
+                           self.duration_months, components)
 
     def calculate_price(self):
-        price = Cpu.query.filter_by(model=self.cpu_model).first().price * self.duration_months
-        for plan_hd in PlanHd.query.filter_by(plan_id=self.id):
-            price += plan_hd.quantity * plan_hd.hd.price * self.duration_months
-        for plan_ram in PlanRam.query.filter_by(plan_id=self.id):
-            price += plan_ram.quantity * plan_ram.ram.price * self.duration_months
-        for plan_gpu in PlanGpu.query.filter_by(plan_id=self.id):
-            price += plan_gpu.quantity * plan_gpu.gpu.price * self.duration_months
-        return price
+        """Price of the plan from the prices of its components, read with one query.
+
+        The plans with auto_price get it on every flush that changes them, see
+        update_plan_price. Returns None for a plan not flushed yet.
+        """
+        prices = plan_prices([self.id]).alias('prices')
+        return db.session.execute(select([prices.c.price])).scalar()
 
     def get_total_ram(self):
         total_ram = 0
@@ -130,73 +149,75 @@ class Plan(db.Model):
                 total_hd += hd.quantity * hd.hd.capacity
         return total_hd, total_ssd
 
-    def available_servers(self, only_one=False, server_id=None):
+    def get_demand(self):
+        """Returns the PlanDemand with the resources used by the plan.
+
+        Read from the demand columns, only a plan not flushed yet walks its components.
         """
-        :param only_one: when True finds only one server.
+        if self.demand_cores is not None:
+            return PlanDemand(self.demand_cores, self.demand_ram, self.demand_hd, self.demand_ssd,
+                              [tuple(gpu) for gpu in self.demand_gpus or ()])
+        total_hd, total_ssd = self.get_total_hd_ssd()
+        gpus = [(plan_gpu.gpu.frequency, plan_gpu.quantity * plan_gpu.gpu.ram) for plan_gpu in self.plan_gpus]
+        return PlanDemand(self.cpu.cores, self.get_total_ram(), total_hd, total_ssd, gpus)
+
+    def servers_query(self):
+        """Range query on the server capacity index for the servers with enough
+        free cores, RAM, HD and SSD. The GPUs are left to match_gpus."""
+        demand = self.get_demand()
+        return Server.query.filter(Server.os_name == self.os_name,
+                                   Server.in_service.is_(True),
+                                   Server.cores_available >= demand.cores,
+                                   Server.ram_available >= demand.ram,
+                                   Server.hd_available >= demand.hd,
+                                   Server.ssd_available >= demand.ssd)
+
+    def ranked_servers(self, policy=None, user_id=None, server_id=None, limit=None):
+        """Ranks the servers that fit the plan with the placement policy.
+
+        :param policy: the PlacementPolicy, by default the one set on the app config.
+        :param user_id: the user buying the plan, used by anti-affinity policies.
+        :return: list of (server_id, used_gpus), the preferred server first.
+        """
+        if policy is None:
+            policy = get_placement_policy()
+        tenants = None
+        if policy.uses_tenants and user_id is not None:
+            tenants = dict(db.session.query(UserPlan.server_id, func.count(UserPlan.id))
+                           .filter(UserPlan.user_id == user_id, UserPlan.expired.is_(False))
+                           .group_by(UserPlan.server_id))
+        return sync_fleet_index().fit(self.get_demand(), self.os_name, server_id=server_id, limit=limit,
+                                      policy=policy, tenants=tenants)
+
+    def available_servers(self, only_one=False, server_id=None, user_id=None):
+        """
+        :param only_one: when True finds only one server, chosen by the placement policy.
         :param server_id: search only the specified server
+        :param user_id: the user buying the plan, used by anti-affinity policies.
         :return: when only_one is True returns the server found and the used
                         resources(used_gpus, total_ram, total_hd, total_ssd)
                 when only_one is False returns a list of available servers
                 when there is no server available, returns None.
         """
-        total_ram = self.get_total_ram()
-
-        total_hd, total_ssd = self.get_total_hd_ssd()
-
-        if server_id is None:
-            servers = Server.query.filter(Server.cores_available >= self.cpu.cores,
-                                          Server.ram_available >= total_ram,
-                                          Server.hd_available >= total_hd,
-                                          Server.ssd_available >= total_ssd,
-                                          Server.os_name == self.os_name)
+        demand = self.get_demand()
+        if only_one is True:
+            fits = self.ranked_servers(user_id=user_id, server_id=server_id, limit=1)
         else:
-            servers = Server.query.filter(Server.cores_available >= self.cpu.cores,
-                                          Server.ram_available >= total_ram,
-                                          Server.hd_available >= total_hd,
-                                          Server.ssd_available >= total_ssd,
-                                          Server.os_name == self.os_name,
-                                          Server.id == server_id)
-        available_servers = []
-        # percorre todos os servidores
-        for server in servers:
-            plan_gpus = list(self.plan_gpus)
-            used_gpus = {}
-            # percorre todas as GPUs do servidor
-            for server_gpu in server.server_gpus:
-                # percorre todas as GPUs do plano
-                for plan_gpu in self.plan_gpus:
-                    # verifica se a GPU ja foi usada antes, se não coloca o valor da utiliazaão dela pra zero
-                    if server_gpu.gpu_model not in used_gpus:
-                        used_gpus[server_gpu.gpu_model] = 0
-                    # testa se a freq é a mesma e a capacidade é maior ou igual,
-                    # levando em consideração se a gpu já foi usada antes
-                    if server_gpu.gpu.frequency == plan_gpu.gpu.frequency and \
-                                    server_gpu.available_capacity >= plan_gpu.quantity * plan_gpu.gpu.ram + used_gpus[
-                                server_gpu.gpu_model]:
-                        # remove a gpu da lista para nao passar na proxima gpu do servidor
-                        plan_gpus.remove(plan_gpu)
-                        # incrementa a utilização da gpu do servidor
-                        used_gpus[server_gpu.gpu_model] += plan_gpu.quantity * plan_gpu.gpu.ram
-            if len(plan_gpus) == 0 and only_one is True:
-                return server, used_gpus, total_ram, total_hd, total_ssd
-            elif len(plan_gpus) == 0:
-                available_servers.append(server)
-        if len(available_servers) == 0:
+            fits = sync_fleet_index().fit(demand, self.os_name, server_id=server_id)
+        if len(fits) == 0:
             return None
-        return available_servers
+        if only_one is True:
+            found_id, used_gpus = fits[0]
+            return Server.query.get(found_id), used_gpus, demand.ram, demand.hd, demand.ssd
+        return Server.query.filter(Server.id.in_([found_id for found_id, _ in fits])).order_by(Server.id).all()
 
 
 @event.listens_for(Plan, 'after_insert')
 def plan_after_insert(maper, connection, target):
-    values = {}
     if target.title == 'Customizado':
-        values['title'] = 'Customizado-' + str(target.id)
-    if target.auto_price is True:
-        values['price'] = target.calculate_price()
-    if values:
         connection.execute(Plan.__table__.update()
                            .where(Plan.__table__.c.id == target.id)
-                           .values(**values))
+                           .values(title='Customizado-' + str(target.id)))
 
 
 class ResourceRequests(db.Model):
@@ -212,6 +233,10 @@ class ResourceRequests(db.Model):
     user_rel = db.relationship('User', foreign_keys=[user_id])
 
 
+# Columns of the components that change the demand of the plans
+COMPONENT_SPEC_COLUMNS = ['cores', 'frequency', 'ram', 'capacity', 'is_ssd']
+
+
 class Resource:
     model = db.Column(db.Text, primary_key=True)
     price = db.Column(db.Float, nullable=False)
@@ -240,6 +265,20 @@ class Resource:
             return value
 
 
+@event.listens_for(Resource, 'after_update', propagate=True)
+def resource_after_update(maper, connection, target):
+    """When the specs of a component change the plans using it must recompute their demand,
+    when its price changes the auto_price plans using it must be repriced."""
+    state = inspect(target)
+    session = object_session(target)
+    if session is None:
+        return
+    if any(state.attrs[key].history.has_changes() for key in COMPONENT_SPEC_COLUMNS if key in state.attrs):
+        session.info.setdefault('changed_components', set()).add((type(target), target.model))
+    if state.attrs.price.history.has_changes():
+        session.info.setdefault('repriced_components', set()).add((type(target), target.model))
+
+
 class Cpu(db.Model, Resource):
     cores = db.Column(db.Integer, nullable=False)
     frequency = db.Column(db.Float, nullable=False)
@@ -279,12 +318,6 @@ class PlanResource:
     def plan(self):
         return db.relationship('Plan', backref=db.backref(self.backref_plan))
 
-    @validates('quantity')
-    def quantity_update(self, key, value):
-        if self.plan.auto_price is True:
-            self.plan.price = -1
-        return value
-
 
 class PlanGpu(db.Model, PlanResource):
     backref_plan = 'plan_gpus'
@@ -337,28 +370,497 @@ class PlanHd(db.Model, PlanResource):
                               "Delete esse componente e crie outro.")
 
 
-@event.listens_for(PlanGpu, 'after_insert')
-def gpu_plan_after_insert(maper, connection, target):
-    if target.plan.auto_price is True:
-        connection.execute(Plan.__table__.update()
-                           .where(Plan.__table__.c.id == target.plan_id)
-                           .values(price=target.plan.calculate_price()))
+PLAN_DEMAND_COLUMNS = ['demand_cores', 'demand_ram', 'demand_hd', 'demand_ssd', 'demand_gpus']
 
+# Text search configuration of the plan search, with the Portuguese stemmer
+SEARCH_CONFIG = 'portuguese'
 
-@event.listens_for(PlanRam, 'after_insert')
-def ram_plan_after_insert(maper, connection, target):
-    if target.plan.auto_price is True:
-        connection.execute(Plan.__table__.update()
-                           .where(Plan.__table__.c.id == target.plan_id)
-                           .values(price=target.plan.calculate_price()))
 
+def mark_plan_changed(session, plan_id):
+    """Schedules the recompute of the derived columns of the plan at the end of the flush."""
+    if session is not None and plan_id is not None:
+        session.info.setdefault('changed_plans', set()).add(plan_id)
 
+
+@event.listens_for(Plan, 'after_insert')
+@event.listens_for(Plan, 'after_update')
+def plan_after_change(maper, connection, target):
+    mark_plan_changed(object_session(target), target.id)
+
+
+@event.listens_for(PlanGpu, 'after_insert')
+@event.listens_for(PlanGpu, 'after_update')
+@event.listens_for(PlanGpu, 'after_delete')
+@event.listens_for(PlanRam, 'after_insert')
+@event.listens_for(PlanRam, 'after_update')
+@event.listens_for(PlanRam, 'after_delete')
 @event.listens_for(PlanHd, 'after_insert')
-def hd_plan_after_insert(maper, connection, target):
-    if target.plan.auto_price is True:
-        connection.execute(Plan.__table__.update()
-                           .where(Plan.__table__.c.id == target.plan_id)
-                           .values(price=target.plan.calculate_price()))
+@event.listens_for(PlanHd, 'after_update')
+@event.listens_for(PlanHd, 'after_delete')
+def plan_resource_after_change(maper, connection, target):
+    mark_plan_changed(object_session(target), target.plan_id)
+
+
+@event.listens_for(Session, 'after_flush_postexec')
+def plan_after_flush_postexec(session, flush_context):
+    """Recomputes the derived columns and the availability of the plans changed on the
+    flush, and the availability of the plans that may run on the servers changed."""
+    plan_ids = session.info.pop('changed_plans', None) or set()
+    changed_components = session.info.pop('changed_components', None)
+    repriced_components = session.info.pop('repriced_components', None)
+    server_ids = session.info.pop('changed_servers', None)
+    connection = session.connection(mapper=Plan.__mapper__)
+    if changed_components:
+        plan_ids |= plans_using_components(connection, changed_components)
+    if plan_ids:
+        update_plan_demand(connection, plan_ids)
+        update_plan_price(connection, plan_ids)
+        update_plan_config_hash(connection, plan_ids)
+        update_plan_search_vector(connection, plan_ids)
+        for plan_id in plan_ids:
+            plan = session.identity_map.get(identity_key(Plan, plan_id))
+            if plan is not None:
+                session.expire(plan, PLAN_DEMAND_COLUMNS + ['price', 'config_hash', 'search_vector'])
+    if repriced_components:
+        reprice_after_flush(session, connection, repriced_components)
+    if plan_ids or server_ids:
+        update_plan_availability(session, plan_ids, server_ids)
+
+
+def plans_using_components_query(components):
+    """Select of the ids of the plans using any of the components, a set of (class, model) pairs."""
+    queries = []
+    for component_class in (Cpu, Gpu, Ram, Hd):
+        models = [model for cls, model in components if cls is component_class]
+        if not models:
+            continue
+        if component_class is Cpu:
+            queries.append(select([Plan.__table__.c.id]).where(Plan.__table__.c.cpu_model.in_(models)))
+        else:
+            plan_resource = {Gpu: PlanGpu, Ram: PlanRam, Hd: PlanHd}[component_class].__table__
+            model_column = plan_resource.c[component_class.__tablename__ + '_model']
+            queries.append(select([plan_resource.c.plan_id]).where(model_column.in_(models)))
+    if not queries:
+        return select([Plan.__table__.c.id]).where(false())
+    return union(*queries) if len(queries) > 1 else queries[0]
+
+
+def plans_using_components(connection, components):
+    """Ids of the plans using any of the components, a set of (class, model) pairs."""
+    return {row[0] for row in connection.execute(plans_using_components_query(components))}
+
+
+def update_plan_demand(connection, plan_ids=None):
+    """Recomputes the demand columns of the plans with set-based UPDATEs.
+
+    :param plan_ids: ids of the plans to update, when None updates all the plans.
+    """
+    plan = Plan.__table__
+    cpu, plan_ram, ram, plan_hd, hd, plan_gpu, gpu = (Cpu.__table__, PlanRam.__table__, Ram.__table__,
+                                                      PlanHd.__table__, Hd.__table__, PlanGpu.__table__,
+                                                      Gpu.__table__)
+    cores = select([cpu.c.cores]).where(cpu.c.model == plan.c.cpu_model)
+    total_ram = select([func.coalesce(func.sum(plan_ram.c.quantity * ram.c.capacity), 0)]) \
+        .where(and_(plan_ram.c.plan_id == plan.c.id, plan_ram.c.ram_model == ram.c.model))
+    total_hd = select([func.coalesce(func.sum(plan_hd.c.quantity * hd.c.capacity), 0)]) \
+        .where(and_(plan_hd.c.plan_id == plan.c.id, plan_hd.c.hd_model == hd.c.model, hd.c.is_ssd.isnot(True)))
+    total_ssd = select([func.coalesce(func.sum(plan_hd.c.quantity * hd.c.capacity), 0)]) \
+        .where(and_(plan_hd.c.plan_id == plan.c.id, plan_hd.c.hd_model == hd.c.model, hd.c.is_ssd.is_(True)))
+    update = plan.update().values(demand_cores=cores.correlate(plan).as_scalar(),
+                                  demand_ram=total_ram.correlate(plan).as_scalar(),
+                                  demand_hd=total_hd.correlate(plan).as_scalar(),
+                                  demand_ssd=total_ssd.correlate(plan).as_scalar())
+    gpus_query = select([plan_gpu.c.plan_id, gpu.c.frequency, plan_gpu.c.quantity * gpu.c.ram]) \
+        .where(plan_gpu.c.gpu_model == gpu.c.model)
+    if plan_ids is None:
+        plan_ids = [row[0] for row in connection.execute(select([plan.c.id]))]
+    else:
+        update = update.where(plan.c.id.in_(plan_ids))
+        gpus_query = gpus_query.where(plan_gpu.c.plan_id.in_(plan_ids))
+    connection.execute(update)
+
+    gpus = {plan_id: [] for plan_id in plan_ids}
+    for plan_id, frequency, capacity in connection.execute(gpus_query):
+        if capacity:
+            gpus[plan_id].append([frequency, capacity])
+    if gpus:
+        connection.execute(plan.update().where(plan.c.id == bindparam('plan_id'))
+                           .values(demand_gpus=bindparam('gpus')),
+                           [{'plan_id': plan_id, 'gpus': sorted(plan_gpus)} for plan_id, plan_gpus in gpus.items()])
+
+
+def plan_prices(plan_ids=None):
+    """Select of (plan_id, price) with the price of the plans computed from the
+    prices of their components: the SUM over the CPU and the quantity times
+    the price of each RAM, HD and GPU, times duration_months.
+
+    :param plan_ids: ids of the plans, when None prices all the plans.
+    """
+    plan, cpu = Plan.__table__, Cpu.__table__
+    cpu_prices = select([plan.c.id.label('plan_id'), cpu.c.price.label('price')]) \
+        .where(cpu.c.model == plan.c.cpu_model)
+    if plan_ids is not None:
+        cpu_prices = cpu_prices.where(plan.c.id.in_(plan_ids))
+    parts = [cpu_prices]
+    for plan_resource, component, model_column in [(PlanRam, Ram, 'ram_model'), (PlanHd, Hd, 'hd_model'),
+                                                   (PlanGpu, Gpu, 'gpu_model')]:
+        plan_resource, component = plan_resource.__table__, component.__table__
+        part = select([plan_resource.c.plan_id, plan_resource.c.quantity * component.c.price]) \
+            .where(plan_resource.c[model_column] == component.c.model)
+        if plan_ids is not None:
+            part = part.where(plan_resource.c.plan_id.in_(plan_ids))
+        parts.append(part)
+    components = union_all(*parts).alias('components')
+    return select([plan.c.id.label('plan_id'),
+                   (func.sum(components.c.price) * plan.c.duration_months).label('price')]) \
+        .select_from(plan.join(components, components.c.plan_id == plan.c.id)) \
+        .group_by(plan.c.id)
+
+
+def config_hash(cpu_model, os_name, duration_months, components):
+    """Canonical hash of a plan configuration, the same computed by plan_config_hashes.
+
+    :param components: iterable of (kind, model, quantity), kind being 'gpu', 'hd' or 'ram'.
+    """
+    quantities = {}
+    for kind, model, quantity in components:
+        quantities[kind, model] = quantities.get((kind, model), 0) + (quantity or 0)
+    items = ','.join(sorted('%s:%s:%d' % (kind, model, quantity) for (kind, model), quantity in quantities.items()
+                            if quantity > 0))
+    return hashlib.md5('|'.join([cpu_model, os_name, str(duration_months), items]).encode('utf-8')).hexdigest()
+
+
+def plan_config_hashes(plan_ids=None):
+    """Select of (plan_id, config_hash) with the md5 of the CPU, OS, duration
+    and the multiset of components of the plans, sorted by kind and model.
+
+    :param plan_ids: ids of the plans, when None hashes all the plans.
+    """
+    plan = Plan.__table__
+    parts = []
+    for plan_resource, kind, model_column in [(PlanGpu, 'gpu', 'gpu_model'), (PlanHd, 'hd', 'hd_model'),
+                                              (PlanRam, 'ram', 'ram_model')]:
+        plan_resource = plan_resource.__table__
+        part = select([plan_resource.c.plan_id, literal(kind).label('kind'),
+                       plan_resource.c[model_column].label('model'), plan_resource.c.quantity])
+        if plan_ids is not None:
+            part = part.where(plan_resource.c.plan_id.in_(plan_ids))
+        parts.append(part)
+    components = union_all(*parts).alias('components')
+    quantity = func.sum(func.coalesce(components.c.quantity, 0))
+    grouped = select([components.c.plan_id, components.c.kind, components.c.model, quantity.label('quantity')]) \
+        .group_by(components.c.plan_id, components.c.kind, components.c.model) \
+        .having(quantity > 0).alias('grouped')
+    item = grouped.c.kind + ':' + grouped.c.model + ':' + cast(grouped.c.quantity, db.Text)
+    # a ordenação byte a byte é a mesma do sorted de config_hash
+    items = select([grouped.c.plan_id,
+                    func.string_agg(item, aggregate_order_by(literal(','), item.collate('"C"'))).label('components')]) \
+        .group_by(grouped.c.plan_id).alias('items')
+    query = select([plan.c.id.label('plan_id'),
+                    func.md5(plan.c.cpu_model + '|' + plan.c.os_name + '|' + cast(plan.c.duration_months, db.Text) +
+                             '|' + func.coalesce(items.c.components, '')).label('config_hash')]) \
+        .select_from(plan.outerjoin(items, items.c.plan_id == plan.c.id))
+    if plan_ids is not None:
+        query = query.where(plan.c.id.in_(plan_ids))
+    return query
+
+
+def update_plan_config_hash(connection, plan_ids=None):
+    """Sets the config_hash of the plans with one UPDATE ... FROM plan_config_hashes.
+
+    :param plan_ids: ids of the plans to update, when None updates all the plans.
+    """
+    plan = Plan.__table__
+    hashes = plan_config_hashes(plan_ids).alias('hashes')
+    connection.execute(plan.update()
+                       .where(and_(plan.c.id == hashes.c.plan_id,
+                                   plan.c.config_hash.is_distinct_from(hashes.c.config_hash)))
+                       .values(config_hash=hashes.c.config_hash))
+
+
+def update_plan_search_vector(connection, plan_ids=None):
+    """Sets the search_vector of the plans with one UPDATE ... FROM: the title
+    weighs the most, then the description, then the CPU, OS and components.
+
+    :param plan_ids: ids of the plans, or a select of them, to update. When
+                     None updates all the plans.
+    """
+    plan = Plan.__table__
+    parts = []
+    for plan_resource, model_column in [(PlanGpu, 'gpu_model'), (PlanHd, 'hd_model'), (PlanRam, 'ram_model')]:
+        plan_resource = plan_resource.__table__
+        part = select([plan_resource.c.plan_id, plan_resource.c[model_column].label('model')])
+        if plan_ids is not None:
+            part = part.where(plan_resource.c.plan_id.in_(plan_ids))
+        parts.append(part)
+    components = union_all(*parts).alias('components')
+    names = select([components.c.plan_id, func.string_agg(components.c.model, ' ').label('names')]) \
+        .group_by(components.c.plan_id).alias('names')
+
+    def weighted(text, weight):
+        return func.setweight(func.to_tsvector(SEARCH_CONFIG, func.coalesce(text, '')), weight)
+    vectors = select([plan.c.id.label('plan_id'),
+                      weighted(plan.c.title, 'A').op('||')(weighted(plan.c.shop_description, 'B'))
+                      .op('||')(weighted(plan.c.cpu_model + ' ' + plan.c.os_name + ' ' +
+                                         func.coalesce(names.c.names, ''), 'C')).label('search_vector')]) \
+        .select_from(plan.outerjoin(names, names.c.plan_id == plan.c.id))
+    if plan_ids is not None:
+        vectors = vectors.where(plan.c.id.in_(plan_ids))
+    vectors = vectors.alias('vectors')
+    connection.execute(plan.update()
+                       .where(and_(plan.c.id == vectors.c.plan_id,
+                                   plan.c.search_vector.is_distinct_from(vectors.c.search_vector)))
+                       .values(search_vector=vectors.c.search_vector))
+
+
+def search_plans_query(search_input):
+    """Query of the public plans matching 'search_input', the best ranked first."""
+    query = func.plainto_tsquery(SEARCH_CONFIG, search_input)
+    return Plan.query.filter(Plan.is_public.is_(True), Plan.search_vector.op('@@')(query)) \
+        .order_by(func.ts_rank(Plan.search_vector, query).desc(), Plan.id)
+
+
+def like_pattern(term):
+    """Escapes the LIKE wildcards of the user input."""
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+# (index, table, column) of the trigram indexes of the search suggestions
+TRIGRAM_INDEXES = [('ix_plan_title_trgm', 'plan', 'title'), ('ix_cpu_model_trgm', 'cpu', 'model'),
+                   ('ix_gpu_model_trgm', 'gpu', 'model'), ('ix_ram_model_trgm', 'ram', 'model'),
+                   ('ix_hd_model_trgm', 'hd', 'model')]
+
+_pg_trgm_installed = {}
+
+
+def create_trigram_indexes(bind):
+    """Creates the pg_trgm extension and the TRIGRAM_INDEXES, when the server
+    has the extension. Without it the suggestions scan the tables.
+
+    :return: False when pg_trgm isn't available.
+    """
+    if not bind.execute("SELECT count(*) FROM pg_available_extensions WHERE name = 'pg_trgm'").scalar():
+        return False
+    bind.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for name, table, column in TRIGRAM_INDEXES:
+        bind.execute('CREATE INDEX IF NOT EXISTS %s ON %s USING gin (%s gin_trgm_ops)' % (name, table, column))
+    _pg_trgm_installed.clear()
+    return True
+
+
+@event.listens_for(db.metadata, 'after_create')
+def metadata_after_create(target, connection, **kw):
+    create_trigram_indexes(connection)
+
+
+def closeness(column, term):
+    """Order by the trigram similarity to 'term', or by length without pg_trgm."""
+    url = str(db.engine.url)
+    if url not in _pg_trgm_installed:
+        _pg_trgm_installed[url] = bool(db.session.connection(mapper=Plan.__mapper__).execute(
+            "SELECT count(*) FROM pg_extension WHERE extname = 'pg_trgm'").scalar())
+    if _pg_trgm_installed[url]:
+        return func.similarity(column, term).desc()
+    return func.length(column)
+
+
+def plan_suggestions(term, limit):
+    """Titles and slugs of the public plans containing 'term', the ones starting
+    with it first, then the most similar. Served by the trigram index."""
+    pattern = like_pattern(term)
+    return db.session.query(Plan.title, Plan.slug_url) \
+        .filter(Plan.is_public.is_(True), Plan.title.ilike('%' + pattern + '%')) \
+        .order_by(Plan.title.ilike(pattern + '%').desc(), closeness(Plan.title, term), Plan.title) \
+        .limit(limit).all()
+
+
+def component_suggestions(term, limit):
+    """Models containing 'term' of the components used by a public plan."""
+    pattern = '%' + like_pattern(term) + '%'
+    plan = Plan.__table__
+    used = [(Cpu.__table__, select([plan.c.id]).where(plan.c.cpu_model == Cpu.__table__.c.model))]
+    for plan_resource, component, model_column in [(PlanGpu, Gpu, 'gpu_model'), (PlanRam, Ram, 'ram_model'),
+                                                   (PlanHd, Hd, 'hd_model')]:
+        plan_resource, component = plan_resource.__table__, component.__table__
+        used.append((component, select([plan.c.id]).where(and_(plan.c.id == plan_resource.c.plan_id,
+                                                                plan_resource.c[model_column] == component.c.model))))
+    queries = [select([component.c.model]).where(and_(component.c.model.ilike(pattern),
+                                                      exists(plans.where(plan.c.is_public.is_(True)))))
+               for component, plans in used]
+    models = union(*queries).alias('models')
+    return [row[0] for row in db.session.execute(
+        select([models.c.model]).order_by(closeness(models.c.model, term), models.c.model)
+        .limit(limit))]
+
+
+PlanDetail = namedtuple('PlanDetail', ['title', 'slug_url', 'price', 'duration_months', 'shop_description',
+                                       'hero_image', 'os_name', 'cpu', 'gpus', 'rams', 'hds'])
+"""Read-only copy of a plan and its components, for the item page."""
+CpuDetail = namedtuple('CpuDetail', ['model', 'cores', 'frequency'])
+GpuDetail = namedtuple('GpuDetail', ['model', 'frequency', 'ram', 'quantity'])
+RamDetail = namedtuple('RamDetail', ['model', 'capacity', 'quantity'])
+HdDetail = namedtuple('HdDetail', ['model', 'capacity', 'is_ssd', 'quantity'])
+
+
+def plan_detail(slug_url):
+    """Loads the plan of slug 'slug_url' with its CPU and components in one
+    statement, joining the few component rows of each kind.
+
+    :return: PlanDetail or None.
+    """
+    plan = Plan.query.options(joinedload(Plan.cpu),
+                              joinedload(Plan.plan_gpus).joinedload(PlanGpu.gpu),
+                              joinedload(Plan.plan_rams).joinedload(PlanRam.ram),
+                              joinedload(Plan.plan_hds).joinedload(PlanHd.hd)) \
+        .filter(Plan.slug_url == slug_url).first()
+    if plan is None:
+        return None
+    return PlanDetail(plan.title, plan.slug_url, plan.price, plan.duration_months, plan.shop_description,
+                      plan.hero_image, plan.os_name, CpuDetail(plan.cpu.model, plan.cpu.cores, plan.cpu.frequency),
+                      sorted(GpuDetail(item.gpu.model, item.gpu.frequency, item.gpu.ram, item.quantity)
+                             for item in plan.plan_gpus),
+                      sorted(RamDetail(item.ram.model, item.ram.capacity, item.quantity) for item in plan.plan_rams),
+                      sorted(HdDetail(item.hd.model, item.hd.capacity, item.hd.is_ssd, item.quantity)
+                             for item in plan.plan_hds))
+
+
+def merge_duplicate_plans(session):
+    """Merges the custom plans with the same configuration into the one with
+    the lowest id, moving their purchases, UserPlans and holds to it, and
+    fills the config_hash of all the plans.
+
+    The plans created before is_custom existed are recognized by the title
+    given by plan_after_insert.
+    :return: number of plans removed.
+    """
+    connection = session.connection(mapper=Plan.__mapper__)
+    plan = Plan.__table__
+    connection.execute(plan.update().where(and_(plan.c.is_custom.isnot(True), plan.c.title.like('Customizado%')))
+                       .values(is_custom=True))
+    hashes = plan_config_hashes().where(plan.c.is_custom.is_(True)).alias('hashes')
+    keep_id = func.min(hashes.c.plan_id).over(partition_by=hashes.c.config_hash)
+    groups = select([hashes.c.plan_id, keep_id.label('keep_id')]).alias('groups')
+    duplicates = [{'duplicate_id': duplicate_id, 'keep_id': kept}
+                  for duplicate_id, kept in connection.execute(select([groups.c.plan_id, groups.c.keep_id])
+                                                               .where(groups.c.plan_id != groups.c.keep_id))]
+    if duplicates:
+        for table in (Purchase.__table__, UserPlan.__table__, CapacityHold.__table__):
+            connection.execute(table.update().where(table.c.plan_id == bindparam('duplicate_id'))
+                               .values(plan_id=bindparam('keep_id')), duplicates)
+        duplicate_ids = [duplicate['duplicate_id'] for duplicate in duplicates]
+        for table in (PlanGpu.__table__, PlanRam.__table__, PlanHd.__table__):
+            connection.execute(table.delete().where(table.c.plan_id.in_(duplicate_ids)))
+        connection.execute(plan.delete().where(plan.c.id.in_(duplicate_ids)))
+    update_plan_config_hash(connection)
+    return len(duplicates)
+
+
+PriceChange = namedtuple('PriceChange', ['plan_id', 'title', 'old_price', 'new_price'])
+"""The price of an auto_price plan before and after update_plan_price."""
+
+
+def update_plan_price(connection, plan_ids=None, dry_run=False):
+    """Sets the price of the auto_price plans with one UPDATE ... FROM plan_prices.
+
+    :param plan_ids: ids of the plans, or a select of them, to update. When
+                     None updates all the plans.
+    :param dry_run: when True only returns the changes, nothing is updated.
+    :return: list of PriceChange of the plans whose price changed.
+    """
+    plan, old_plan = Plan.__table__, Plan.__table__.alias('old_plan')
+    new_prices = plan_prices(plan_ids).alias('new_prices')
+    # the FROM sees the rows before the UPDATE, RETURNING gives the old price too
+    prices = select([new_prices.c.plan_id, new_prices.c.price, old_plan.c.price.label('old_price')]) \
+        .select_from(new_prices.join(old_plan, old_plan.c.id == new_prices.c.plan_id)) \
+        .where(and_(old_plan.c.auto_price.is_(True), old_plan.c.price.is_distinct_from(new_prices.c.price))) \
+        .alias('prices')
+    columns = [plan.c.id, plan.c.title, prices.c.old_price, prices.c.price]
+    if dry_run:
+        rows = connection.execute(select(columns).where(plan.c.id == prices.c.plan_id).order_by(plan.c.id))
+    else:
+        rows = connection.execute(plan.update().where(plan.c.id == prices.c.plan_id)
+                                  .values(price=prices.c.price).returning(*columns))
+    return sorted(PriceChange(*row) for row in rows)
+
+
+def reprice_after_flush(session, connection, components):
+    """Reprices the auto_price plans using the components whose price changed.
+
+    Up to REPRICE_SYNC_LIMIT plans are repriced in the flush, with one
+    UPDATE ... FROM. Above it the repricing is left to reprice_components, run
+    in the background after the commit.
+    """
+    plan = Plan.__table__
+    affected = plans_using_components_query(components)
+    count = connection.execute(select([func.count()]).where(and_(plan.c.id.in_(affected),
+                                                                 plan.c.auto_price.is_(True)))).scalar()
+    if count > current_app.config.get('REPRICE_SYNC_LIMIT', 200):
+        session.info.setdefault('deferred_reprice', set()).update(components)
+        session.info['reprice_report'] = (count, True)
+        return
+    changes = update_plan_price(connection, affected)
+    for change in changes:
+        plan = session.identity_map.get(identity_key(Plan, change.plan_id))
+        if plan is not None:
+            session.expire(plan, ['price'])
+    session.info['reprice_report'] = (len(changes), False)
+
+
+def reprice_components(components, session=None, batch_size=None):
+    """Reprices the auto_price plans using the components in batches of
+    REPRICE_BATCH plans, each one committed.
+
+    :return: list of PriceChange.
+    """
+    session = session or db.session
+    batch_size = batch_size or current_app.config.get('REPRICE_BATCH', 500)
+    plan = Plan.__table__
+    plan_ids = [row[0] for row in session.execute(
+        select([plan.c.id]).where(and_(plan.c.id.in_(plans_using_components_query(components)),
+                                       plan.c.auto_price.is_(True))).order_by(plan.c.id))]
+    changes = []
+    for start in range(0, len(plan_ids), batch_size):
+        changes += update_plan_price(session.connection(mapper=Plan.__mapper__),
+                                     plan_ids[start:start + batch_size])
+        session.commit()
+    return changes
+
+
+def start_background_reprice(app, components):
+    """Runs reprice_components on a thread with its own session."""
+    def reprice():
+        with app.app_context():
+            try:
+                reprice_components(components)
+            finally:
+                db.session.remove()
+    thread = threading.Thread(target=reprice, name='reprice-plans', daemon=True)
+    thread.start()
+    return thread
+
+
+@event.listens_for(Session, 'after_commit')
+def reprice_after_commit(session):
+    components = session.info.pop('deferred_reprice', None)
+    if components:
+        start_background_reprice(current_app._get_current_object(), components)
+
+
+@event.listens_for(Session, 'after_rollback')
+def reprice_after_rollback(session):
+    session.info.pop('deferred_reprice', None)
+    session.info.pop('reprice_report', None)
+
+
+class PlanAvailability(db.Model):
+    """Materialized availability of each plan, recomputed for the plans affected
+    when a plan or a server changes."""
+    plan_id = db.Column(db.Integer, db.ForeignKey('plan.id', ondelete='CASCADE'), primary_key=True)
+    available = db.Column(db.Boolean, nullable=False, default=False, index=True)
+    server_count = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, server_default=func.now())
+
+    plan = db.relationship('Plan', backref=db.backref('availability', uselist=False, passive_deletes=True))
 
 
 class CreditCard(db.Model):
@@ -383,6 +885,8 @@ class Purchase(db.Model):
     plan_id = db.Column(db.Integer, db.ForeignKey('plan.id'), nullable=False)
     user_plan_id = db.Column(db.Integer, db.ForeignKey('user_plan.id'))
     date = db.Column(db.DateTime, server_default=func.now())
+    # CapacityHold consumed by the purchase, the hold is deleted when consumed
+    hold_id = db.Column(db.Integer)
 
     user = db.relationship('User', backref=db.backref('purchase'))
     credit_card = db.relationship('CreditCard', backref=db.backref('purchase'))
@@ -392,43 +896,536 @@ class Purchase(db.Model):
 
 @event.listens_for(Purchase, 'after_insert')
 def purchase_after_insert(maper, connection, target):
-    """Creates or updates a UserPlan and updates the end_date by the plan duration_months.
-        If is a new UserPlan, finds a server compatible with the plan and set the server in use."""
+    """Queues the purchase to be processed after the flush, see purchase_after_flush."""
+    object_session(target).info.setdefault('pending_purchases', []).append(target)
 
-    @event.listens_for(Session, "after_flush", once=True)
-    def receive_after_flush(session, context):
 
-        if target.user_plan_id is None:
+@event.listens_for(Session, 'after_flush')
+def purchase_after_flush(session, context):
+    """Creates or updates a UserPlan and updates the end_date by the plan duration_months.
+        If is a new UserPlan, finds a server compatible with the plan and set the server in use.
+
+    The purchases are queued on the session, a listener registered for each
+    purchase would run on the next flush of any session, even one of another thread."""
+    purchases = session.info.pop('pending_purchases', None)
+    if not purchases:
+        return
+    connection = session.connection(mapper=Purchase.__mapper__)
+    allocated = session.info.get('allocated_purchases', set())
+    for target in purchases:
+        if target in allocated:
+            # alocada por allocate_purchases, o UserPlan já foi criado
+            allocated.discard(target)
+        elif target.user_plan_id is None:
             plan = Plan.query.filter_by(id=target.plan_id).first()
-            available_server = plan.available_servers(only_one=True)
-            if available_server is None:
-                raise ValidationError("Não existe servidor disponível para este plano. Mande um pedido "
-                                      "de recurso para os administradores ou compre outro plano")
-
-            server, used_gpus, total_ram, total_hd, total_ssd = available_server
-            connection.execute(Server.__table__.update()
-                               .where(Server.__table__.c.id == server.id)
-                               .values(cores_available=server.cores_available - plan.cpu.cores,
-                                       ram_available=server.ram_available - total_ram,
-                                       hd_available=server.hd_available - total_hd,
-                                       ssd_available=server.ssd_available - total_ssd))
-            for gpu in server.server_gpus:
-                if gpu.gpu_model in used_gpus and used_gpus[gpu.gpu_model] > 0:
-                    connection.execute(ServerGpu.__table__.update()
-                                       .where(ServerGpu.__table__.c.server_id == server.id and
-                                              ServerGpu.__table__.c.gpu_model == gpu.gpu_model)
-                                       .values(available_capacity=gpu.available_capacity - used_gpus[gpu.gpu_model]))
-
+            server_id, demand, used_gpus = allocate_purchase(session, connection, target, plan)
             user_plan = UserPlan(user_id=target.user_id,
                                  plan_id=target.plan_id,
-                                 server_id=server.id)
-            user_plan.end_date = add_months(datetime.datetime.now(), target.plan.duration_months)
+                                 server_id=server_id)
+            user_plan.end_date = add_months(datetime.datetime.now(), plan.duration_months)
+            user_plan.set_usage(demand, used_gpus)
             user_plan.purchases.append(target)
             session.add(user_plan)
         else:
-            connection.execute(UserPlan.__table__.update()
-                               .where(UserPlan.__table__.c.id == target.user_plan_id)
-                               .values(end_date=add_months(target.user_plan.end_date, target.plan.duration_months)))
+            user_plan = UserPlan.query.get(target.user_plan_id)
+            plan = user_plan.plan
+            user_plan_table = UserPlan.__table__
+            renewed = connection.execute(user_plan_table.update()
+                                         .where(and_(user_plan_table.c.id == user_plan.id,
+                                                     user_plan_table.c.expired.is_(False)))
+                                         .values(end_date=add_months(user_plan.end_date, plan.duration_months)))
+            if renewed.rowcount == 0:
+                # o plano expirou e os recursos foram liberados, procura um servidor de novo
+                server_id, demand, used_gpus = allocate_purchase(session, connection, target, plan)
+                start_date = datetime.datetime.now()
+                connection.execute(user_plan_table.update()
+                                   .where(user_plan_table.c.id == user_plan.id)
+                                   .values(server_id=server_id, expired=False, start_date=start_date,
+                                           end_date=add_months(start_date, plan.duration_months),
+                                           cores=demand.cores, ram=demand.ram, hd=demand.hd, ssd=demand.ssd))
+                user_plan_gpu = UserPlanGpu.__table__
+                connection.execute(user_plan_gpu.delete().where(user_plan_gpu.c.user_plan_id == user_plan.id))
+                gpus = [{'user_plan_id': user_plan.id, 'gpu_model': gpu_model, 'amount': amount}
+                        for gpu_model, amount in sorted(used_gpus.items()) if amount > 0]
+                if gpus:
+                    connection.execute(user_plan_gpu.insert(), gpus)
+                record_allocation(connection, allocation_entries(server_id, demand, used_gpus, 'renewal',
+                                                                 user_plan_id=user_plan.id))
+            session.expire(user_plan)
+
+
+def allocate_purchase(session, connection, purchase, plan):
+    """Reserves the resources of a purchase, on the server of its hold when it has one.
+
+    :return: (server_id, demand, used_gpus)
+    """
+    consumed = None
+    if purchase.hold_id is not None:
+        consumed = consume_hold(connection, purchase.hold_id, purchase.user_id, plan.id)
+    if consumed is None:
+        allocation = allocate_server(connection, plan, user_id=purchase.user_id)
+        if allocation is None:
+            raise ValidationError("Não existe servidor disponível para este plano. Mande um pedido "
+                                  "de recurso para os administradores ou compre outro plano")
+        consumed = (allocation[0], plan.get_demand(), allocation[1])
+    touch_server(session, consumed[0])
+    return consumed
+
+
+def allocate_server(connection, plan, user_id=None):
+    """Reserves the resources of the plan on the best server of the placement policy.
+
+    The candidates come from the fleet index, which may be stale when other
+    workers are buying at the same time, so when the reservation on a candidate
+    fails it is marked dirty and the next one is tried, up to
+    ALLOCATION_MAX_ATTEMPTS candidates.
+
+    :return: (server_id, used_gpus) or None when no server could be reserved.
+    """
+    demand = plan.get_demand()
+    attempts = current_app.config.get('ALLOCATION_MAX_ATTEMPTS', 10)
+    for server_id, used_gpus in plan.ranked_servers(user_id=user_id, limit=attempts):
+        if reserve_server(connection, server_id, demand, used_gpus):
+            return server_id, used_gpus
+        fleet_index.mark_dirty(server_id)
+    return None
+
+
+def reserve_server(connection, server_id, demand, used_gpus):
+    """Subtracts the resources of a plan from the server with guarded updates.
+
+    Each counter is decremented only where it is still large enough
+    (x = x - n WHERE x >= n). A concurrent transaction updating the same row
+    waits for this one and checks the guard again on the updated row, so
+    the server is never overcommitted. The updates run inside a savepoint,
+    rolled back when any of them doesn't find enough free resources.
+
+    :return: True when the resources were reserved.
+    """
+    server, server_gpu = Server.__table__, ServerGpu.__table__
+    columns = [(server.c.cores_available, demand.cores), (server.c.ram_available, demand.ram),
+               (server.c.hd_available, demand.hd), (server.c.ssd_available, demand.ssd)]
+    columns = [(column, amount) for column, amount in columns if amount]
+    savepoint = connection.begin_nested()
+    try:
+        result = connection.execute(server.update()
+                                    .where(and_(server.c.id == server_id,
+                                                *[column >= amount for column, amount in columns]))
+                                    .values({column: column - amount for column, amount in columns}))
+        reserved = result.rowcount == 1
+        for gpu_model, amount in sorted(used_gpus.items()):
+            if not reserved:
+                break
+            if amount <= 0:
+                continue
+            result = connection.execute(server_gpu.update()
+                                        .where(and_(server_gpu.c.server_id == server_id,
+                                                    server_gpu.c.gpu_model == gpu_model,
+                                                    server_gpu.c.available_capacity >= amount))
+                                        .values(available_capacity=server_gpu.c.available_capacity - amount))
+            reserved = result.rowcount == 1
+    except Exception:
+        savepoint.rollback()
+        raise
+    if reserved:
+        savepoint.commit()
+    else:
+        savepoint.rollback()
+    return reserved
+
+
+def release_server(connection, server_id, demand, used_gpus):
+    """Gives back to the server the resources of a plan, with relative updates."""
+    server, server_gpu = Server.__table__, ServerGpu.__table__
+    connection.execute(server.update()
+                       .where(server.c.id == server_id)
+                       .values(cores_available=server.c.cores_available + demand.cores,
+                               ram_available=server.c.ram_available + demand.ram,
+                               hd_available=server.c.hd_available + demand.hd,
+                               ssd_available=server.c.ssd_available + demand.ssd))
+    for gpu_model, amount in sorted(used_gpus.items()):
+        if amount > 0:
+            connection.execute(server_gpu.update()
+                               .where(and_(server_gpu.c.server_id == server_id, server_gpu.c.gpu_model == gpu_model))
+                               .values(available_capacity=server_gpu.c.available_capacity + amount))
+
+
+class Allocation(db.Model):
+    """Append-only ledger of the resources allocated on the servers.
+
+    Every reservation of a UserPlan or CapacityHold appends positive amounts
+    and every release the same amounts negated, in the transaction that
+    changes the counters. The available columns of Server and ServerGpu are
+    the aggregate of the ledger kept up to date, and can be rebuilt from it
+    with rebuild_server_availability. The GPU capacity is recorded on rows
+    of its own, with the gpu_model.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    server_id = db.Column(db.Integer, db.ForeignKey('server.id', ondelete='CASCADE'), nullable=False, index=True)
+    user_plan_id = db.Column(db.Integer, db.ForeignKey('user_plan.id'), index=True)
+    # the holds are deleted when released or consumed
+    hold_id = db.Column(db.Integer)
+    gpu_model = db.Column(db.Text, db.ForeignKey('gpu.model'))
+    cores = db.Column(db.Integer, nullable=False, default=0)
+    ram = db.Column(db.Integer, nullable=False, default=0)
+    hd = db.Column(db.Integer, nullable=False, default=0)
+    ssd = db.Column(db.Integer, nullable=False, default=0)
+    gpu = db.Column(db.Integer, nullable=False, default=0)
+    reason = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, server_default=func.now())
+
+
+def allocation_entries(server_id, demand, used_gpus, reason, sign=1, user_plan_id=None, hold_id=None):
+    """Ledger rows of a placement, with sign=-1 when the resources are given back."""
+    entry = dict(server_id=server_id, user_plan_id=user_plan_id, hold_id=hold_id, reason=reason)
+    entries = [dict(entry, gpu_model=None, cores=sign * demand.cores, ram=sign * demand.ram,
+                    hd=sign * demand.hd, ssd=sign * demand.ssd, gpu=0)]
+    entries += [dict(entry, gpu_model=gpu_model, cores=0, ram=0, hd=0, ssd=0, gpu=sign * amount)
+                for gpu_model, amount in sorted(used_gpus.items()) if amount > 0]
+    return entries
+
+
+def record_allocation(connection, entries):
+    """Appends the entries to the allocation ledger."""
+    if entries:
+        connection.execute(Allocation.__table__.insert(), entries)
+
+
+def record_allocation_from(connection, reason, base, gpus):
+    """Appends to the ledger the rows of two selects, for the set based
+    allocations and releases.
+
+    :param base: select of (server_id, user_plan_id, hold_id, cores, ram, hd, ssd)
+                 with the signed amounts.
+    :param gpus: select of (server_id, user_plan_id, hold_id, gpu_model, gpu).
+    """
+    allocation = Allocation.__table__
+    connection.execute(allocation.insert().from_select(
+        ['server_id', 'user_plan_id', 'hold_id', 'cores', 'ram', 'hd', 'ssd', 'reason'],
+        base.column(bindparam('base_reason', reason))))
+    connection.execute(allocation.insert().from_select(
+        ['server_id', 'user_plan_id', 'hold_id', 'gpu_model', 'gpu', 'reason'],
+        gpus.column(bindparam('gpu_reason', reason))))
+
+
+def rebuild_server_availability(session=None, server_ids=None):
+    """Recomputes the available columns of the servers and server GPUs from the
+    allocation ledger: the totals minus the sum of the allocations, with one
+    grouped query for the servers and one for the server GPUs.
+
+    :param server_ids: servers rebuilt, by default all of them.
+    :return: number of servers rebuilt.
+    """
+    session = session or db.session
+    server, server_gpu, cpu, allocation = Server.__table__, ServerGpu.__table__, Cpu.__table__, Allocation.__table__
+    connection = session.connection(mapper=Allocation.__mapper__)
+    allocated = select([server.c.id,
+                        func.coalesce(func.sum(allocation.c.cores), 0).label('cores'),
+                        func.coalesce(func.sum(allocation.c.ram), 0).label('ram'),
+                        func.coalesce(func.sum(allocation.c.hd), 0).label('hd'),
+                        func.coalesce(func.sum(allocation.c.ssd), 0).label('ssd')]) \
+        .select_from(server.outerjoin(allocation, allocation.c.server_id == server.c.id)) \
+        .group_by(server.c.id)
+    allocated_gpus = select([server_gpu.c.server_id, server_gpu.c.gpu_model,
+                             func.coalesce(func.sum(allocation.c.gpu), 0).label('gpu')]) \
+        .select_from(server_gpu.outerjoin(allocation, and_(allocation.c.server_id == server_gpu.c.server_id,
+                                                           allocation.c.gpu_model == server_gpu.c.gpu_model))) \
+        .group_by(server_gpu.c.server_id, server_gpu.c.gpu_model)
+    if server_ids is not None:
+        allocated = allocated.where(server.c.id.in_(server_ids))
+        allocated_gpus = allocated_gpus.where(server_gpu.c.server_id.in_(server_ids))
+    allocated, allocated_gpus = allocated.alias('allocated'), allocated_gpus.alias('allocated_gpus')
+
+    rebuilt = [row.id for row in connection.execute(
+        server.update()
+        .where(and_(server.c.id == allocated.c.id, cpu.c.model == server.c.cpu_model))
+        .values(cores_available=cpu.c.cores - allocated.c.cores,
+                ram_available=func.coalesce(server.c.ram_total, 0) - allocated.c.ram,
+                hd_available=func.coalesce(server.c.hd_total, 0) - allocated.c.hd,
+                ssd_available=func.coalesce(server.c.ssd_total, 0) - allocated.c.ssd)
+        .returning(server.c.id))]
+    connection.execute(server_gpu.update()
+                       .where(and_(server_gpu.c.server_id == allocated_gpus.c.server_id,
+                                   server_gpu.c.gpu_model == allocated_gpus.c.gpu_model))
+                       .values(available_capacity=func.coalesce(server_gpu.c.total_capacity, 0) -
+                               allocated_gpus.c.gpu))
+    for server_id in rebuilt:
+        touch_server(session, server_id)
+    refresh_changed_servers(session, rebuilt)
+    return len(rebuilt)
+
+
+def backfill_allocation_ledger(session=None):
+    """Records on the ledger the UserPlans and CapacityHolds allocated before
+    it existed, the ones without any allocation row. The UserPlans without
+    the usage columns get the demand of their plan, and no GPUs.
+
+    :return: number of UserPlans and holds recorded.
+    """
+    session = session or db.session
+    user_plan, user_plan_gpu, plan = UserPlan.__table__, UserPlanGpu.__table__, Plan.__table__
+    hold, hold_gpu, allocation = CapacityHold.__table__, CapacityHoldGpu.__table__, Allocation.__table__
+    connection = session.connection(mapper=Allocation.__mapper__)
+    connection.execute(user_plan.update()
+                       .where(and_(user_plan.c.cores.is_(None), plan.c.id == user_plan.c.plan_id))
+                       .values(cores=plan.c.demand_cores, ram=plan.c.demand_ram,
+                               hd=plan.c.demand_hd, ssd=plan.c.demand_ssd))
+
+    missing_plans = select([user_plan.c.id]).where(and_(
+        user_plan.c.expired.is_(False), user_plan.c.server_id.isnot(None),
+        ~exists().where(allocation.c.user_plan_id == user_plan.c.id)))
+    missing_holds = select([hold.c.id]).where(~exists().where(allocation.c.hold_id == hold.c.id))
+    user_plan_ids = [row.id for row in connection.execute(missing_plans)]
+    hold_ids = [row.id for row in connection.execute(missing_holds)]
+    if user_plan_ids:
+        record_allocation_from(
+            connection, 'backfill',
+            select([user_plan.c.server_id, user_plan.c.id, null(), user_plan.c.cores, user_plan.c.ram,
+                    user_plan.c.hd, user_plan.c.ssd]).where(user_plan.c.id.in_(user_plan_ids)),
+            select([user_plan.c.server_id, user_plan.c.id, null(), user_plan_gpu.c.gpu_model, user_plan_gpu.c.amount])
+            .select_from(user_plan_gpu.join(user_plan, user_plan.c.id == user_plan_gpu.c.user_plan_id))
+            .where(user_plan.c.id.in_(user_plan_ids)))
+    if hold_ids:
+        record_allocation_from(
+            connection, 'backfill',
+            select([hold.c.server_id, null(), hold.c.id, hold.c.cores, hold.c.ram, hold.c.hd, hold.c.ssd])
+            .where(hold.c.id.in_(hold_ids)),
+            select([hold.c.server_id, null(), hold.c.id, hold_gpu.c.gpu_model, hold_gpu.c.amount])
+            .select_from(hold_gpu.join(hold, hold.c.id == hold_gpu.c.hold_id))
+            .where(hold.c.id.in_(hold_ids)))
+    return len(user_plan_ids) + len(hold_ids)
+
+
+class CapacityHold(db.Model):
+    """Capacity of a plan held on a server while the user checks out.
+
+    The resources are subtracted from the server when the hold is created, so
+    the fleet index and the plan availability already count the holds. A
+    purchase with the hold_id takes the server of the hold, and the expired
+    holds are given back by release_expired_holds.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    plan_id = db.Column(db.Integer, db.ForeignKey('plan.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    server_id = db.Column(db.Integer, db.ForeignKey('server.id'), nullable=False)
+    cores = db.Column(db.Integer, default=0)
+    ram = db.Column(db.Integer, default=0)
+    hd = db.Column(db.Integer, default=0)
+    ssd = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, server_default=func.now())
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    plan = db.relationship('Plan')
+    gpus = db.relationship('CapacityHoldGpu', cascade='all, delete-orphan', passive_deletes=True)
+
+
+class CapacityHoldGpu(db.Model):
+    hold_id = db.Column(db.Integer, db.ForeignKey('capacity_hold.id', ondelete='CASCADE'), primary_key=True)
+    gpu_model = db.Column(db.Text, db.ForeignKey('gpu.model'), primary_key=True)
+    amount = db.Column(db.Integer, nullable=False)
+
+
+@event.listens_for(CapacityHold, 'after_insert')
+def capacity_hold_after_insert(maper, connection, target):
+    """Records the resources held on the allocation ledger."""
+    demand = PlanDemand(target.cores or 0, target.ram or 0, target.hd or 0, target.ssd or 0, [])
+    record_allocation(connection, allocation_entries(target.server_id, demand,
+                                                     {gpu.gpu_model: gpu.amount for gpu in target.gpus},
+                                                     'hold', hold_id=target.id))
+
+
+def hold_capacity(plan, user_id, ttl=None):
+    """Holds the capacity of the plan on a server for 'ttl' seconds, by default
+    CAPACITY_HOLD_TTL. The hold of the same user and plan is renewed.
+
+    :return: the CapacityHold or None when no server fits the plan.
+    """
+    session = db.session
+    ttl = ttl or current_app.config.get('CAPACITY_HOLD_TTL', 600)
+    expires_at = func.now() + datetime.timedelta(seconds=ttl)
+    hold = CapacityHold.query.filter_by(plan_id=plan.id, user_id=user_id).with_for_update().first()
+    if hold is not None:
+        hold.expires_at = expires_at
+        return hold
+
+    allocation = allocate_server(session.connection(mapper=CapacityHold.__mapper__), plan, user_id=user_id)
+    if allocation is None:
+        return None
+    server_id, used_gpus = allocation
+    demand = plan.get_demand()
+    hold = CapacityHold(plan_id=plan.id, user_id=user_id, server_id=server_id, cores=demand.cores,
+                        ram=demand.ram, hd=demand.hd, ssd=demand.ssd, expires_at=expires_at,
+                        gpus=[CapacityHoldGpu(gpu_model=gpu_model, amount=amount)
+                              for gpu_model, amount in used_gpus.items() if amount > 0])
+    session.add(hold)
+    touch_server(session, server_id)
+    return hold
+
+
+def consume_hold(connection, hold_id, user_id, plan_id):
+    """Deletes the hold of the user for the plan, its resources become the
+    resources of the purchase. An expired hold not released yet still holds
+    the capacity and is consumed as well.
+
+    :return: (server_id, demand, used_gpus) held, or None when the hold was released.
+    """
+    hold, hold_gpu = CapacityHold.__table__, CapacityHoldGpu.__table__
+    row = connection.execute(select([hold])
+                             .where(and_(hold.c.id == hold_id, hold.c.user_id == user_id, hold.c.plan_id == plan_id))
+                             .with_for_update()).first()
+    if row is None:
+        return None
+    used_gpus = dict(connection.execute(select([hold_gpu.c.gpu_model, hold_gpu.c.amount])
+                                        .where(hold_gpu.c.hold_id == hold_id)).fetchall())
+    connection.execute(hold.delete().where(hold.c.id == hold_id))
+    demand = PlanDemand(row.cores or 0, row.ram or 0, row.hd or 0, row.ssd or 0, [])
+    record_allocation(connection, allocation_entries(row.server_id, demand, used_gpus, 'hold consumed',
+                                                     sign=-1, hold_id=hold_id))
+    return row.server_id, demand, used_gpus
+
+
+def release_holds(session, condition, limit=None):
+    """Gives back the capacity of the holds matching 'condition' and deletes them.
+
+    The holds are locked with SKIP LOCKED, a hold being consumed or released
+    by another transaction is left to it. The capacity is summed per server
+    and given back with one UPDATE ... FROM for the servers and one for the
+    server GPUs.
+
+    :return: number of holds released.
+    """
+    hold, hold_gpu = CapacityHold.__table__, CapacityHoldGpu.__table__
+    server, server_gpu = Server.__table__, ServerGpu.__table__
+    connection = session.connection(mapper=CapacityHold.__mapper__)
+    locked = select([hold.c.id]).where(condition).order_by(hold.c.id).limit(limit) \
+        .with_for_update(skip_locked=True)
+    hold_ids = [row.id for row in connection.execute(locked)]
+    if not hold_ids:
+        return 0
+
+    released = select([hold.c.server_id, func.sum(hold.c.cores).label('cores'), func.sum(hold.c.ram).label('ram'),
+                       func.sum(hold.c.hd).label('hd'), func.sum(hold.c.ssd).label('ssd')]) \
+        .where(hold.c.id.in_(hold_ids)).group_by(hold.c.server_id).alias('released')
+    connection.execute(server.update()
+                       .where(server.c.id == released.c.server_id)
+                       .values(cores_available=server.c.cores_available + released.c.cores,
+                               ram_available=server.c.ram_available + released.c.ram,
+                               hd_available=server.c.hd_available + released.c.hd,
+                               ssd_available=server.c.ssd_available + released.c.ssd))
+    released_gpus = select([hold.c.server_id, hold_gpu.c.gpu_model, func.sum(hold_gpu.c.amount).label('amount')]) \
+        .select_from(hold_gpu.join(hold, hold.c.id == hold_gpu.c.hold_id)) \
+        .where(hold.c.id.in_(hold_ids)).group_by(hold.c.server_id, hold_gpu.c.gpu_model).alias('released_gpus')
+    connection.execute(server_gpu.update()
+                       .where(and_(server_gpu.c.server_id == released_gpus.c.server_id,
+                                   server_gpu.c.gpu_model == released_gpus.c.gpu_model))
+                       .values(available_capacity=server_gpu.c.available_capacity + released_gpus.c.amount))
+    record_allocation_from(connection, 'hold released',
+                           select([hold.c.server_id, null(), hold.c.id, -hold.c.cores, -hold.c.ram, -hold.c.hd,
+                                   -hold.c.ssd]).where(hold.c.id.in_(hold_ids)),
+                           select([hold.c.server_id, null(), hold.c.id, hold_gpu.c.gpu_model, -hold_gpu.c.amount])
+                           .select_from(hold_gpu.join(hold, hold.c.id == hold_gpu.c.hold_id))
+                           .where(hold.c.id.in_(hold_ids)))
+    server_ids = {row.server_id for row in connection.execute(hold.delete()
+                                                               .where(hold.c.id.in_(hold_ids))
+                                                               .returning(hold.c.server_id))}
+    for server_id in server_ids:
+        touch_server(session, server_id)
+    refresh_changed_servers(session, server_ids)
+    return len(hold_ids)
+
+
+def release_expired_holds(session=None, limit=None):
+    """Releases the holds past their expires_at, see release_holds."""
+    return release_holds(session or db.session, CapacityHold.__table__.c.expires_at <= func.now(), limit)
+
+
+ExpiryReport = namedtuple('ExpiryReport', ['plans', 'servers', 'cores', 'ram', 'hd', 'ssd', 'gpu'])
+"""Resources given back by expire_user_plans, 'gpu' is the GPU capacity of all models."""
+
+
+def expire_user_plans(session=None, now=None, limit=None):
+    """Marks the UserPlans past their end_date as expired and gives their
+    resources back to the servers.
+
+    The plans are found by the partial index on end_date and locked with
+    SKIP LOCKED, a plan being renewed by another transaction is left to it.
+    The reserved resources are summed per server and given back with one
+    UPDATE ... FROM for the servers and one for the server GPUs, so a run
+    takes the same few statements for any number of plans. The plans bought
+    before the usage was kept on the UserPlan give back the plan demand and
+    no GPUs.
+
+    :param now: expires the plans with end_date before it, by default the
+                database time.
+    :param limit: maximum number of plans expired.
+    :return: ExpiryReport
+    """
+    session = session or db.session
+    user_plan, user_plan_gpu, plan = UserPlan.__table__, UserPlanGpu.__table__, Plan.__table__
+    server, server_gpu = Server.__table__, ServerGpu.__table__
+    connection = session.connection(mapper=UserPlan.__mapper__)
+    now = now if now is not None else func.now()
+    locked = select([user_plan.c.id]) \
+        .where(and_(user_plan.c.expired.is_(False), user_plan.c.end_date <= now)) \
+        .order_by(user_plan.c.end_date).limit(limit).with_for_update(skip_locked=True)
+    user_plan_ids = [row.id for row in connection.execute(user_plan.update()
+                                                          .where(user_plan.c.id.in_(locked))
+                                                          .values(expired=True)
+                                                          .returning(user_plan.c.id))]
+    if not user_plan_ids:
+        return ExpiryReport(0, 0, 0, 0, 0, 0, 0)
+    expired = user_plan.c.id == any_(bindparam('user_plan_ids', user_plan_ids, type_=postgresql.ARRAY(db.Integer)))
+
+    usage = [func.coalesce(user_plan.c.cores, plan.c.demand_cores, 0),
+             func.coalesce(user_plan.c.ram, plan.c.demand_ram, 0),
+             func.coalesce(user_plan.c.hd, plan.c.demand_hd, 0),
+             func.coalesce(user_plan.c.ssd, plan.c.demand_ssd, 0)]
+    usage_rows = user_plan.join(plan, plan.c.id == user_plan.c.plan_id)
+    usage_gpus = user_plan_gpu.join(user_plan, user_plan.c.id == user_plan_gpu.c.user_plan_id)
+    allocated = and_(expired, user_plan.c.server_id.isnot(None))
+    record_allocation_from(connection, 'expired',
+                           select([user_plan.c.server_id, user_plan.c.id, null()] + [-column for column in usage])
+                           .select_from(usage_rows).where(allocated),
+                           select([user_plan.c.server_id, user_plan.c.id, null(), user_plan_gpu.c.gpu_model,
+                                   -user_plan_gpu.c.amount])
+                           .select_from(usage_gpus).where(allocated))
+
+    released = select([user_plan.c.server_id] +
+                      [func.sum(column).label(name) for column, name in zip(usage, ['cores', 'ram', 'hd', 'ssd'])]) \
+        .select_from(usage_rows).where(allocated) \
+        .group_by(user_plan.c.server_id).alias('released')
+    server_rows = connection.execute(server.update()
+                                     .where(server.c.id == released.c.server_id)
+                                     .values(cores_available=server.c.cores_available + released.c.cores,
+                                             ram_available=server.c.ram_available + released.c.ram,
+                                             hd_available=server.c.hd_available + released.c.hd,
+                                             ssd_available=server.c.ssd_available + released.c.ssd)
+                                     .returning(server.c.id, released.c.cores, released.c.ram,
+                                                released.c.hd, released.c.ssd)).fetchall()
+    released_gpus = select([user_plan.c.server_id, user_plan_gpu.c.gpu_model,
+                            func.sum(user_plan_gpu.c.amount).label('amount')]) \
+        .select_from(usage_gpus).where(allocated) \
+        .group_by(user_plan.c.server_id, user_plan_gpu.c.gpu_model).alias('released_gpus')
+    gpu_rows = connection.execute(server_gpu.update()
+                                  .where(and_(server_gpu.c.server_id == released_gpus.c.server_id,
+                                              server_gpu.c.gpu_model == released_gpus.c.gpu_model))
+                                  .values(available_capacity=server_gpu.c.available_capacity + released_gpus.c.amount)
+                                  .returning(server_gpu.c.server_id, released_gpus.c.amount)).fetchall()
+
+    server_ids = {row[0] for row in server_rows} | {row[0] for row in gpu_rows}
+    for server_id in server_ids:
+        touch_server(session, server_id)
+    refresh_changed_servers(session, server_ids)
+    return ExpiryReport(len(user_plan_ids), len(server_ids),
+                        *[sum(row[column] for row in server_rows) for column in range(1, 5)],
+                        sum(row[1] for row in gpu_rows))
+
+
+def refresh_changed_servers(session, server_ids):
+    """Recomputes the plan availability of servers changed without a flush."""
+    if server_ids:
+        session.info.get('changed_servers', set()).difference_update(server_ids)
+        update_plan_availability(session, server_ids=server_ids)
 
 
 class Server(db.Model):
@@ -451,6 +1448,11 @@ class Server(db.Model):
     hd_available = db.Column(db.Integer, default=0)
     ssd_total = db.Column(db.Integer, default=0)
     ssd_available = db.Column(db.Integer, default=0)
+    # a server out of service is not offered to new plans, see drain_servers
+    in_service = db.Column(db.Boolean, nullable=False, default=True, server_default='true')
+
+    __table_args__ = (db.Index('ix_server_capacity', 'os_name', 'cores_available', 'ram_available',
+                               'hd_available', 'ssd_available'),)
 
     os = db.relationship('Os', backref=db.backref('server'))
     cpu = db.relationship('Cpu', backref=db.backref('server'))
@@ -491,25 +1493,6 @@ class Server(db.Model):
             self.__setattr__(available, available_value + value - old_value)
         return value
 
-    @validates('user_plans')
-    def user_plans_update(self, key, value):
-        """When a user_plan is updated(server_id is changed),
-           set all plan resources in use."""
-        usage = value.plan.available_servers(only_one=True, server_id=self.id)
-        if usage is None:
-            raise ValidationError("Esse servidor não é compativel com esse plano.")
-        server, used_gpus, total_ram, total_hd, total_ssd = usage
-
-        self.cores_available -= value.plan.cpu.cores
-        self.ram_available -= total_ram
-        self.hd_available -= total_hd
-        self.ssd_available -= total_ssd
-
-        for gpu in self.server_gpus:
-            if gpu.gpu_model in used_gpus and used_gpus[gpu.gpu_model] > 0:
-                gpu.available_capacity -= used_gpus[gpu.gpu_model]
-        return value
-
 
 @event.listens_for(Server, 'before_insert')
 def server_before_insert(maper, connection, target):
@@ -519,6 +1502,116 @@ def server_before_insert(maper, connection, target):
     target.hd_slot_available = target.hd_slot_total
 
 
+@event.listens_for(Server, 'after_insert')
+@event.listens_for(Server, 'after_update')
+@event.listens_for(Server, 'after_delete')
+def server_after_change(maper, connection, target):
+    """Refresh the server row of the fleet index."""
+    touch_server(object_session(target), target.id)
+
+
+SERVER_AVAILABLE_COLUMNS = ['cores_available', 'ram_available', 'hd_available', 'ssd_available']
+
+NO_RESOURCES_MESSAGE = "Não existem recursos disponíveis. Tente diminuir a quantidade ou adicionar novos recursos."
+NO_SLOTS_MESSAGE = "Não existem slots no servidor disponíveis. Tente diminuir a quantidade."
+IN_USE_MESSAGE = "O uso do recurso está maior do que o disponível. Tente diminuir a utilização dos recursos " \
+                 "ou aumente a quantidade de recursos a serem adicionados."
+RAM_MAX_MESSAGE = "RAM máxima do servidor atingida."
+
+# Columns that can't go above another column of the same row
+INVENTORY_UPPER_BOUNDS = {'ram_total': 'ram_max'}
+
+
+def queue_inventory_change(session, model, ident, deltas, messages):
+    """Queues relative changes to the counters of one row, applied at the end of
+    the flush by inventory_after_flush. Changes to the same row are summed.
+
+    :param model: mapped class of the row, e.g. Server or Ram.
+    :param ident: primary key of the row.
+    :param deltas: dict of column -> value added to the column.
+    :param messages: dict of column -> error raised when the change would leave
+                     the column negative (or above its upper bound).
+    """
+    changes = session.info.setdefault('inventory_changes', {})
+    _, row_deltas, row_messages = changes.setdefault((model.__name__, tuple(ident)), (model, {}, {}))
+    for column, delta in deltas.items():
+        row_deltas[column] = row_deltas.get(column, 0) + delta
+    for column, message in messages.items():
+        row_messages.setdefault(column, message)
+
+
+@event.listens_for(Session, 'after_flush', insert=True)
+def inventory_after_flush(session, context):
+    """Applies the queued inventory changes with one relative UPDATE per row,
+    guarded so no counter goes negative or above its upper bound.
+
+    Registered before the other after_flush listeners, the purchases of the
+    same flush already see the new capacity.
+    """
+    changes = session.info.pop('inventory_changes', None)
+    if not changes:
+        return
+    connection = session.connection(mapper=Server.__mapper__)
+    # the rows are locked always in the same order by concurrent flushes
+    for key in sorted(changes):
+        model, deltas, messages = changes[key]
+        table = model.__table__
+        row = and_(*[column == value for column, value in zip(inspect(model).primary_key, key[1])])
+        values, guards = {}, []
+        for name, delta in deltas.items():
+            column = table.c[name]
+            if delta == 0:
+                continue
+            values[column] = column + delta
+            if delta < 0:
+                guards.append(column >= -delta)
+            elif name in INVENTORY_UPPER_BOUNDS:
+                guards.append(column + delta <= table.c[INVENTORY_UPPER_BOUNDS[name]])
+        if not values:
+            continue
+        result = connection.execute(table.update().where(and_(row, *guards)).values(values))
+        if result.rowcount != 1:
+            raise ValidationError(inventory_error(connection, table, row, deltas, messages))
+        session.info.setdefault('inventory_expire', []).append((model, key[1], list(deltas)))
+
+
+def inventory_error(connection, table, row, deltas, messages):
+    """Finds the message of the guard that stopped an inventory change."""
+    current = connection.execute(select([table]).where(row)).first()
+    if current is not None:
+        for name, delta in deltas.items():
+            value = (current[name] or 0) + delta
+            upper_bound = INVENTORY_UPPER_BOUNDS.get(name)
+            if (delta < 0 and value < 0) or (delta > 0 and upper_bound and value > current[upper_bound]):
+                return messages.get(name, NO_RESOURCES_MESSAGE)
+    return NO_RESOURCES_MESSAGE
+
+
+@event.listens_for(Session, 'after_flush_postexec')
+def inventory_after_flush_postexec(session, context):
+    """The counters were changed by SQL, reload them on the next access."""
+    for model, ident, names in session.info.pop('inventory_expire', ()):
+        instance = session.identity_map.get(identity_key(model, ident))
+        if instance is not None:
+            session.expire(instance, names)
+
+
+@event.listens_for(Session, 'after_rollback')
+def inventory_after_rollback(session):
+    session.info.pop('inventory_changes', None)
+    session.info.pop('inventory_expire', None)
+
+
+def lock_server_resource(connection, target):
+    """Locks the row of a component installed on a server and returns its
+    current values, the loaded ones may be stale."""
+    table = type(target).__table__
+    mapper = inspect(type(target))
+    row = and_(*[column == value
+                 for column, value in zip(mapper.primary_key, mapper.primary_key_from_instance(target))])
+    return connection.execute(select([table]).where(row).with_for_update()).first()
+
+
 class ServerResource:
     backref_plan = 'server_resources'
     quantity = db.Column(db.Integer, default=0)
@@ -558,49 +1651,42 @@ class ServerGpu(db.Model, ServerResource):
         """
         if value < 0:
             raise ValidationError('A quantidade precisa ser maior que zero.')
-        elif self.quantity is None:
-            return value
-        elif self.gpu.available < value - self.quantity:
-            raise ValidationError(
-                "Não existem recursos disponíveis. Tente diminuir a quantidade ou adicionar novos recursos.")
-        elif self.server.gpu_slot_available < value - self.quantity:
-            raise ValidationError(
-                "Não existem slots disponíveis. Tente diminuir a quantidade de recursos.")
-
-        net_capacity = self.gpu.ram * (value - self.quantity)
-
-        if self.available_capacity + net_capacity < 0:
-            raise ValidationError(
-                "O uso do recurso está maior do que o disponível. Tente diminuir a utilização dos recursos"
-                " ou aumente a quantidade de recursos a serem adicionados.")
-        else:
-            self.total_capacity += net_capacity
-            self.available_capacity += net_capacity
-            self.gpu.available -= value - self.quantity
-            self.server.gpu_slot_available -= value - self.quantity
+        elif self.quantity is None or not inspect(self).persistent:
             return value
 
+        session = object_session(self)
+        added = value - self.quantity
+        net_capacity = self.gpu.ram * added
+        queue_inventory_change(session, ServerGpu, inspect(self).identity,
+                               {'total_capacity': net_capacity, 'available_capacity': net_capacity},
+                               {'available_capacity': IN_USE_MESSAGE})
+        queue_inventory_change(session, Gpu, (self.gpu_model,), {'available': -added},
+                               {'available': NO_RESOURCES_MESSAGE})
+        queue_inventory_change(session, Server, (self.server_id,), {'gpu_slot_available': -added},
+                               {'gpu_slot_available': NO_SLOTS_MESSAGE})
+        return value
+
 
 @event.listens_for(ServerGpu, 'before_insert')
 def server_gpu_before_insert(maper, connection, target):
     """Before the insert, updates the total_capacity, available_capacity,
     gpu.available and server.gpu_slot_available based on the quantity.
     """
-    if target.gpu.available < target.quantity:
-        raise ValidationError("Não existem recursos disponíveis. Tente diminuir "
-                              "a quantidade ou adicionar novos recursos.")
-    elif target.server.gpu_slot_available < target.quantity:
-        raise ValidationError("Não existem slots no servidor disponíveis."
-                              "Tente diminuir a quantidade.")
-    else:
-        target.available_capacity = target.gpu.ram * target.quantity
-        target.total_capacity = target.gpu.ram * target.quantity
-        connection.execute(Server.__table__.update()
-                           .where(Server.__table__.c.id == target.server_id)
-                           .values(gpu_slot_available=target.server.gpu_slot_available - target.quantity))
-        connection.execute(Gpu.__table__.update()
-                           .where(Gpu.__table__.c.model == target.gpu_model)
-                           .values(available=target.gpu.available - target.quantity))
+    session = object_session(target)
+    target.available_capacity = target.gpu.ram * target.quantity
+    target.total_capacity = target.gpu.ram * target.quantity
+    queue_inventory_change(session, Gpu, (target.gpu_model,), {'available': -target.quantity},
+                           {'available': NO_RESOURCES_MESSAGE})
+    queue_inventory_change(session, Server, (target.server_id,), {'gpu_slot_available': -target.quantity},
+                           {'gpu_slot_available': NO_SLOTS_MESSAGE})
+
+
+@event.listens_for(ServerGpu, 'after_insert')
+@event.listens_for(ServerGpu, 'after_update')
+@event.listens_for(ServerGpu, 'after_delete')
+def server_gpu_after_change(maper, connection, target):
+    """Refresh the server row of the fleet index."""
+    touch_server(object_session(target), target.server_id)
 
 
 @event.listens_for(ServerGpu, 'before_delete')
@@ -608,15 +1694,12 @@ def server_gpu_before_delete(maper, connection, target):
     """ Before the delete, updates the gpu.available and
     server.gpu_slot_available based on the quantity.
     """
-    if target.available_capacity < target.total_capacity:
+    current = lock_server_resource(connection, target)
+    if current.available_capacity < current.total_capacity:
         raise ValidationError('Erro! O GPU a ser deletado ainda está em uso!')
-    else:
-        connection.execute(Server.__table__.update()
-                           .where(Server.__table__.c.id == target.server_id)
-                           .values(gpu_slot_available=target.server.ram_slot_available + target.quantity))
-        connection.execute(Gpu.__table__.update()
-                           .where(Gpu.__table__.c.model == target.gpu_model)
-                           .values(available=target.gpu.available + target.quantity))
+    session = object_session(target)
+    queue_inventory_change(session, Gpu, (target.gpu_model,), {'available': current.quantity}, {})
+    queue_inventory_change(session, Server, (target.server_id,), {'gpu_slot_available': current.quantity}, {})
 
 
 class ServerRam(db.Model, ServerResource):
@@ -641,54 +1724,37 @@ class ServerRam(db.Model, ServerResource):
         """
         if value < 0:
             raise ValidationError('A quantidade precisa ser maior que zero.')
-        elif self.quantity is None:
-            return value
-        elif self.ram.available < value - self.quantity:
-            raise ValidationError(
-                "Não existem recursos disponíveis. Tente diminuir a quantidade ou adicionar novos recursos.")
-        elif self.server.ram_slot_available < value - self.quantity:
-            raise ValidationError(
-                "Não existem slots disponíveis. Tente diminuir a quantidade de recursos.")
-
-        net_capacity = self.ram.capacity * value - self.ram.capacity * self.quantity
-
-        if self.server.ram_available + net_capacity < 0:
-            raise ValidationError("O uso do recurso está maior do que o disponível. "
-                                  "Tente diminuir a utilização dos recursos ou aumente "
-                                  "a quantidade de recursos a serem adicionados.")
-        elif self.server.ram_max < self.server.ram_total + net_capacity:
-            raise ValidationError("RAM máxima do servidor atingida.")
-        else:
-            self.server.ram_total += net_capacity
-            self.server.ram_available += net_capacity
-            self.server.ram_slot_available -= value - self.quantity
-            self.ram.available -= value - self.quantity
+        elif self.quantity is None or not inspect(self).persistent:
             return value
 
+        session = object_session(self)
+        added = value - self.quantity
+        net_capacity = self.ram.capacity * added
+        queue_inventory_change(session, Ram, (self.ram_model,), {'available': -added},
+                               {'available': NO_RESOURCES_MESSAGE})
+        queue_inventory_change(session, Server, (self.server_id,),
+                               {'ram_total': net_capacity, 'ram_available': net_capacity,
+                                'ram_slot_available': -added},
+                               {'ram_total': RAM_MAX_MESSAGE, 'ram_available': IN_USE_MESSAGE,
+                                'ram_slot_available': NO_SLOTS_MESSAGE})
+        touch_server(session, self.server_id)
+        return value
+
 
 @event.listens_for(ServerRam, 'before_insert')
 def server_ram_before_insert(maper, connection, target):
     """ Before the insert, updates the server.ram_total, server.ram_available,
     ram.available and server.ram_slot_available based on the quantity.
     """
-    if target.ram.available < target.quantity:
-        raise ValidationError("Não existem recursos disponíveis. Tente diminuir "
-                              "a quantidade ou adicionar novos recursos.")
-    elif target.server.ram_slot_available < target.quantity:
-        raise ValidationError("Não existem slots no servidor disponíveis."
-                              "Tente diminuir a quantidade.")
-    elif target.server.ram_max < target.server.ram_total + target.ram.capacity * target.quantity:
-        raise ValidationError("RAM máxima do servidor atingida.")
-    else:
-        added_capacity = target.ram.capacity * target.quantity
-        connection.execute(Server.__table__.update()
-                           .where(Server.__table__.c.id == target.server_id)
-                           .values(ram_total=target.server.ram_total + added_capacity,
-                                   ram_available=target.server.ram_available + added_capacity,
-                                   ram_slot_available=target.server.ram_slot_available - target.quantity))
-        connection.execute(Ram.__table__.update()
-                           .where(Ram.__table__.c.model == target.ram_model)
-                           .values(available=target.ram.available - target.quantity))
+    session = object_session(target)
+    added_capacity = target.ram.capacity * target.quantity
+    queue_inventory_change(session, Ram, (target.ram_model,), {'available': -target.quantity},
+                           {'available': NO_RESOURCES_MESSAGE})
+    queue_inventory_change(session, Server, (target.server_id,),
+                           {'ram_total': added_capacity, 'ram_available': added_capacity,
+                            'ram_slot_available': -target.quantity},
+                           {'ram_total': RAM_MAX_MESSAGE, 'ram_slot_available': NO_SLOTS_MESSAGE})
+    touch_server(session, target.server_id)
 
 
 @event.listens_for(ServerRam, 'before_delete')
@@ -696,18 +1762,16 @@ def server_ram_before_delete(maper, connection, target):
     """ Before the delete, updates the server.ram_total, server.ram_available,
     ram.available and server.ram_slot_available based on the quantity.
     """
-    if target.quantity * target.ram.capacity > target.server.ram_available:
-        raise ValidationError('Erro! A RAM a ser deletada ainda está em uso!')
-    else:
-        removed_capacity = target.quantity * target.ram.capacity
-        connection.execute(Server.__table__.update()
-                           .where(Server.__table__.c.id == target.server_id)
-                           .values(ram_total=target.server.ram_total - removed_capacity,
-                                   ram_available=target.server.ram_available - removed_capacity,
-                                   ram_slot_available=target.server.ram_slot_available + target.quantity))
-        connection.execute(Ram.__table__.update()
-                           .where(Ram.__table__.c.model == target.ram_model)
-                           .values(available=target.ram.available + target.quantity))
+    session = object_session(target)
+    quantity = lock_server_resource(connection, target).quantity
+    removed_capacity = quantity * target.ram.capacity
+    queue_inventory_change(session, Ram, (target.ram_model,), {'available': quantity}, {})
+    queue_inventory_change(session, Server, (target.server_id,),
+                           {'ram_total': -removed_capacity, 'ram_available': -removed_capacity,
+                            'ram_slot_available': quantity},
+                           {'ram_total': 'Erro! A RAM a ser deletada ainda está em uso!',
+                            'ram_available': 'Erro! A RAM a ser deletada ainda está em uso!'})
+    touch_server(session, target.server_id)
 
 
 class ServerHd(db.Model, ServerResource):
@@ -733,33 +1797,28 @@ class ServerHd(db.Model, ServerResource):
         """
         if value < 0:
             raise ValidationError('A quantidade precisa ser maior que zero.')
-        elif self.quantity is None:
-            return value
-        elif self.hd.available < value - self.quantity:
-            raise ValidationError(
-                "Não existem recursos disponíveis. Tente diminuir a quantidade ou adicionar novos recursos.")
-        elif self.server.hd_slot_available < value - self.quantity:
-            raise ValidationError(
-                "Não existem slots disponíveis. Tente diminuir a quantidade de recursos.")
-
-        net_capacity = self.hd.capacity * value - self.hd.capacity * self.quantity
-
-        if (self.hd.is_ssd is True and self.server.ssd_available + net_capacity < 0) or \
-                (self.hd.is_ssd is False and self.server.hd_available + net_capacity < 0):
-            raise ValidationError(
-                "O uso do recurso está maior do que o disponível. Tente diminuir a utilização dos recursos"
-                " ou aumente a quantidade de recursos a serem adicionados.")
-        else:
-            if self.hd.is_ssd is True:
-                self.server.ssd_total += net_capacity
-                self.server.ssd_available += net_capacity
-            else:
-                self.server.hd_total += net_capacity
-                self.server.hd_available += net_capacity
-            self.hd.available -= value - self.quantity
-            self.server.hd_slot_available -= value - self.quantity
+        elif self.quantity is None or not inspect(self).persistent:
             return value
 
+        session = object_session(self)
+        added = value - self.quantity
+        queue_inventory_change(session, Hd, (self.hd_model,), {'available': -added},
+                               {'available': NO_RESOURCES_MESSAGE})
+        queue_server_hd_change(session, self.server_id, self.hd, self.hd.capacity * added, -added,
+                               IN_USE_MESSAGE)
+        touch_server(session, self.server_id)
+        return value
+
+
+def queue_server_hd_change(session, server_id, hd, capacity, slots, in_use_message):
+    """Queues the change of the HD or SSD capacity and of the HD slots of a server."""
+    prefix = 'ssd_' if hd.is_ssd is True else 'hd_'
+    queue_inventory_change(session, Server, (server_id,),
+                           {prefix + 'total': capacity, prefix + 'available': capacity,
+                            'hd_slot_available': slots},
+                           {prefix + 'total': in_use_message, prefix + 'available': in_use_message,
+                            'hd_slot_available': NO_SLOTS_MESSAGE})
+
 
 @event.listens_for(ServerHd, 'before_insert')
 def server_hd_before_insert(maper, connection, target):
@@ -767,27 +1826,12 @@ def server_hd_before_insert(maper, connection, target):
     server.ssd_total, server.ssd_available, hd.available and
     server.hd_slot_available based on the quantity.
     """
-    if target.hd.available < target.quantity:
-        raise ValidationError("Não existem recursos disponíveis. Tente diminuir "
-                              "a quantidade ou adicionar novos recursos.")
-    elif target.server.hd_slot_available < target.quantity:
-        raise ValidationError("Não existem slots no servidor disponíveis."
-                              "Tente diminuir a quantidade.")
-    else:
-        added_capacity = target.hd.capacity * target.quantity
-        if target.hd.is_ssd is True:
-            server_values = {'ssd_available': target.server.ssd_available + added_capacity,
-                             'ssd_total': target.server.ssd_available + added_capacity}
-        else:
-            server_values = {'hd_available': target.server.hd_available + added_capacity,
-                             'hd_total': target.server.hd_available + added_capacity}
-        server_values['hd_slot_available'] = target.server.hd_slot_available - target.quantity
-        connection.execute(Server.__table__.update()
-                           .where(Server.__table__.c.id == target.server_id)
-                           .values(**server_values))
-        connection.execute(Hd.__table__.update()
-                           .where(Hd.__table__.c.model == target.hd_model)
-                           .values(available=target.hd.available - target.quantity))
+    session = object_session(target)
+    queue_inventory_change(session, Hd, (target.hd_model,), {'available': -target.quantity},
+                           {'available': NO_RESOURCES_MESSAGE})
+    queue_server_hd_change(session, target.server_id, target.hd, target.hd.capacity * target.quantity,
+                           -target.quantity, IN_USE_MESSAGE)
+    touch_server(session, target.server_id)
 
 
 @event.listens_for(ServerHd, 'before_delete')
@@ -796,23 +1840,131 @@ def server_hd_before_delete(maper, connection, target):
     server.ssd_total, server.ssd_available, hd.available and
     server.hd_slot_available based on the quantity.
     """
-    if target.quantity * target.hd.capacity > target.server.hd_available:
-        raise ValidationError('Erro! O HD a ser deletado ainda está em uso!')
-    else:
-        removed_capacity = target.quantity * target.hd.capacity
-        if target.hd.is_ssd is True:
-            server_values = {'ssd_available': target.server.ssd_available - removed_capacity,
-                             'ssd_total': target.server.ssd_available - removed_capacity}
-        else:
-            server_values = {'hd_available': target.server.hd_available - removed_capacity,
-                             'hd_total': target.server.hd_available - removed_capacity}
-        server_values['hd_slot_available'] = target.server.hd_slot_available - target.quantity
-        connection.execute(Server.__table__.update()
-                           .where(Server.__table__.c.id == target.server_id)
-                           .values(**server_values))
-        connection.execute(Hd.__table__.update()
-                           .where(Hd.__table__.c.model == target.hd_model)
-                           .values(available=target.hd.available + target.quantity))
+    session = object_session(target)
+    quantity = lock_server_resource(connection, target).quantity
+    queue_inventory_change(session, Hd, (target.hd_model,), {'available': quantity}, {})
+    queue_server_hd_change(session, target.server_id, target.hd, -quantity * target.hd.capacity, quantity,
+                           'Erro! O HD a ser deletado ainda está em uso!')
+    touch_server(session, target.server_id)
+
+
+def expire_server_counters(session, server):
+    """The counters of the server were changed by relative updates, reloads them
+    on the next access."""
+    session.expire(server, SERVER_AVAILABLE_COLUMNS)
+    for server_gpu in server.server_gpus:
+        session.expire(server_gpu, ['available_capacity'])
+
+
+def expire_servers(session, server_ids):
+    """Expires the counters of the servers loaded on the session, see expire_server_counters."""
+    for server_id in server_ids:
+        server = session.identity_map.get(identity_key(Server, server_id))
+        if server is not None:
+            expire_server_counters(session, server)
+
+
+def touch_server(session, server_id):
+    """Marks the server as changed on the fleet index and on the plan availability."""
+    fleet_index.mark_dirty(server_id)
+    if session is not None:
+        session.info.setdefault('touched_servers', set()).add(server_id)
+        session.info.setdefault('changed_servers', set()).add(server_id)
+
+
+def fleet_index_rows(session, server_ids=None, os_names=None):
+    """Queries the server and server GPU rows used by the fleet index, the
+    servers out of service are left out."""
+    servers = session.query(Server.id, Server.os_name, Server.cores_available, Server.ram_available,
+                            Server.hd_available, Server.ssd_available).filter(Server.in_service.is_(True))
+    gpus = session.query(ServerGpu.server_id, ServerGpu.gpu_model, Gpu.frequency, ServerGpu.available_capacity) \
+        .join(Gpu, Gpu.model == ServerGpu.gpu_model) \
+        .join(Server, Server.id == ServerGpu.server_id).filter(Server.in_service.is_(True))
+    if server_ids is not None:
+        servers = servers.filter(Server.id.in_(server_ids))
+        gpus = gpus.filter(ServerGpu.server_id.in_(server_ids))
+    if os_names is not None:
+        servers = servers.filter(Server.os_name.in_(os_names))
+        gpus = gpus.filter(Server.os_name.in_(os_names))
+    return servers.all(), gpus.all()
+
+
+def sync_fleet_index(session=None):
+    """Returns the fleet index, reloading the servers changed since the last call."""
+    session = session or db.session
+    with fleet_index.lock:
+        if fleet_index.needs_reload():
+            fleet_index.pop_dirty()
+            fleet_index.load(*fleet_index_rows(session))
+        elif fleet_index.dirty:
+            server_ids = fleet_index.pop_dirty()
+            fleet_index.update(server_ids, *fleet_index_rows(session, server_ids))
+    return fleet_index
+
+
+def update_plan_availability(session, plan_ids=None, server_ids=None):
+    """Recomputes the plan_availability rows.
+
+    The servers are read in the same transaction into a FleetIndex of their
+    own: the shared fleet index may miss the changes of other workers and of
+    this transaction, and the upsert would store its stale counts.
+
+    :param plan_ids: plans changed, their availability is always recomputed.
+    :param server_ids: servers changed, recomputes the plans with the same OS.
+                       When both are None recomputes all the plans.
+    """
+    plan, server = Plan.__table__, Server.__table__
+    connection = session.connection(mapper=PlanAvailability.__mapper__)
+    query = select([plan.c.id, plan.c.os_name, plan.c.demand_cores, plan.c.demand_ram, plan.c.demand_hd,
+                    plan.c.demand_ssd, plan.c.demand_gpus])
+    os_names = set()
+    if server_ids:
+        # the deleted servers are only left on the fleet index
+        os_names = fleet_index.os_names(server_ids) | {
+            row[0] for row in connection.execute(select([server.c.os_name]).distinct()
+                                                 .where(server.c.id.in_(server_ids)))}
+    if plan_ids or server_ids:
+        conditions = []
+        if plan_ids:
+            conditions.append(plan.c.id.in_(plan_ids))
+        if os_names:
+            conditions.append(plan.c.os_name.in_(os_names))
+        if not conditions:
+            return
+        query = query.where(or_(*conditions))
+    # upsert in the same order on every transaction, avoiding deadlocks between concurrent purchases
+    query = query.order_by(plan.c.id)
+
+    plan_rows = connection.execute(query).fetchall()
+    if not plan_rows:
+        return
+    index = FleetIndex()
+    index.load(*fleet_index_rows(session, os_names={row[1] for row in plan_rows}
+                                 if plan_ids or server_ids else None))
+    values = []
+    for plan_id, os_name, cores, ram, hd, ssd, gpus in plan_rows:
+        demand = PlanDemand(cores or 0, ram or 0, hd or 0, ssd or 0, [tuple(gpu) for gpu in gpus or ()])
+        server_count = len(index.fit(demand, os_name))
+        values.append({'plan_id': plan_id, 'available': server_count > 0, 'server_count': server_count})
+    insert = postgresql.insert(PlanAvailability.__table__)
+    connection.execute(insert.on_conflict_do_update(
+        index_elements=['plan_id'],
+        set_=dict(available=insert.excluded.available, server_count=insert.excluded.server_count,
+                  updated_at=func.now())), values)
+
+
+@event.listens_for(Session, 'after_commit')
+def fleet_index_after_commit(session):
+    """Other threads may have synced the servers before the commit, with the old values."""
+    fleet_index.mark_dirty(*session.info.pop('touched_servers', ()))
+
+
+@event.listens_for(Session, 'after_rollback')
+def fleet_index_after_rollback(session):
+    """The index may hold values written by the rolled back transaction."""
+    fleet_index.mark_dirty(*session.info.pop('touched_servers', ()))
+    session.info.pop('pending_purchases', None)
+    session.info.pop('allocated_purchases', None)
 
 
 class UserPlan(db.Model):
@@ -822,43 +1974,107 @@ class UserPlan(db.Model):
     server_id = db.Column(db.Integer, db.ForeignKey('server.id'))
     start_date = db.Column(db.DateTime, default=func.now())
     end_date = db.Column(db.DateTime, default=func.now())
+    expired = db.Column(db.Boolean, nullable=False, default=False, server_default='false')
+    # resources reserved on the server, given back when the plan expires
+    cores = db.Column(db.Integer)
+    ram = db.Column(db.Integer)
+    hd = db.Column(db.Integer)
+    ssd = db.Column(db.Integer)
+
+    # the expiry sweeper only looks for the plans not expired yet
+    __table_args__ = (db.Index('ix_user_plan_active_end_date', 'end_date', postgresql_where=db.text('NOT expired')),)
 
     plan = db.relationship('Plan', backref=db.backref('user_plan'))
     user = db.relationship('User', backref=db.backref('user_plan'))
     server = db.relationship('Server', backref=db.backref('user_plans'))
+    gpus = db.relationship('UserPlanGpu', cascade='all, delete-orphan', passive_deletes=True)
 
     @validates('server')
     def update_server(self, key, value):
-        """When the user_plans updates, free all resources in the old server."""
-        if self.server == value:
+        """When the server changes, reserves the plan on the new server and gives
+        back the resources on the old one."""
+        if self.server == value or not inspect(self).persistent:
             return value
-        plan = Plan.query.filter_by(id=self.plan_id).first()
-        available_server = plan.available_servers(only_one=True, server_id=value.id)
-        if available_server is None:
-            raise ValidationError("Esse servidor não esta disponível.")
-        server, used_gpus, total_ram, total_hd, total_ssd = available_server
-        if self.server_id is not None:
-            self.server.cores_available += plan.cpu.cores
-            self.server.ram_available += total_ram
-            self.server.hd_available += total_hd
-            self.server.ssd_available += total_ssd
-            free_gpus = {}
-            for server_gpu in self.server.server_gpus:
-                # percorre todas as GPUs do plano
-                for plan_gpu in plan.plan_gpus:
-                    # verifica se a GPU ja foi liberada antes, se não coloca o valor da utiliazaão dela pra zero
-                    if server_gpu.gpu_model not in free_gpus:
-                        free_gpus[server_gpu.gpu_model] = 0
-                    # testa se a freq é a mesma e a capacidade é maior ou igual,
-                    # levando em consideração se a gpu já foi liberada antes
-                    if server_gpu.gpu.frequency == plan_gpu.gpu.frequency and \
-                                            server_gpu.total_capacity - free_gpus[server_gpu.gpu_model] >= \
-                                            plan_gpu.quantity * plan_gpu.gpu.ram:
-                        # incrementa a utilização da gpu do servidor
-                        server_gpu.available_capacity += plan_gpu.quantity * plan_gpu.gpu.ram
-                        free_gpus[server_gpu.gpu_model] += plan_gpu.quantity * plan_gpu.gpu.ram
+        session = object_session(self)
+        connection = session.connection(mapper=Server.__mapper__)
+        demand, used_gpus = self.plan.get_demand(), {}
+        if value is not None:
+            fits = self.plan.ranked_servers(server_id=value.id, limit=1)
+            if not fits or not reserve_server(connection, value.id, demand, fits[0][1]):
+                fleet_index.mark_dirty(value.id)
+                raise ValidationError("Esse servidor não esta disponível.")
+            used_gpus = fits[0][1]
+            touch_server(session, value.id)
+        if self.server_id is not None and not self.expired:
+            old_demand, old_gpus = self.get_usage()
+            release_server(connection, self.server_id, old_demand, old_gpus)
+            record_allocation(connection, allocation_entries(self.server_id, old_demand, old_gpus, 'moved',
+                                                             sign=-1, user_plan_id=self.id))
+            touch_server(session, self.server_id)
+            expire_server_counters(session, self.server)
+        if value is not None:
+            record_allocation(connection, allocation_entries(value.id, demand, used_gpus, 'moved',
+                                                             user_plan_id=self.id))
+            self.set_usage(demand, used_gpus)
+            expire_server_counters(session, value)
         return value
 
+    def get_usage(self):
+        """Returns the PlanDemand and used_gpus reserved on the server for the plan.
+
+        The plans bought before the usage was kept get the demand of the plan,
+        and their GPUs are searched among the capacity in use on the server.
+        """
+        if self.cores is not None:
+            return (PlanDemand(self.cores, self.ram or 0, self.hd or 0, self.ssd or 0, []),
+                    {gpu.gpu_model: gpu.amount for gpu in self.gpus})
+        demand = self.plan.get_demand()
+        in_use = {server_gpu.gpu_model: (server_gpu.gpu.frequency,
+                                         server_gpu.total_capacity - server_gpu.available_capacity)
+                  for server_gpu in self.server.server_gpus}
+        return demand, match_gpus(in_use, demand.gpus) or {}
+
+    def set_usage(self, demand, used_gpus):
+        """Keeps the resources reserved on the server for the plan."""
+        self.cores, self.ram, self.hd, self.ssd = demand.cores, demand.ram, demand.hd, demand.ssd
+        self.gpus = [UserPlanGpu(gpu_model=gpu_model, amount=amount)
+                     for gpu_model, amount in sorted(used_gpus.items()) if amount > 0]
+
+    def relocate(self, policy=None):
+        """Moves the plan to the best other server of the placement policy.
+
+        The server is reserved by the guarded updates of update_server, so when
+        another worker took the capacity of a candidate first the next one is
+        tried, up to ALLOCATION_MAX_ATTEMPTS candidates, like allocate_server.
+
+        :return: the new server or None when no other server could be reserved.
+        """
+        attempts = current_app.config.get('ALLOCATION_MAX_ATTEMPTS', 10)
+        candidates = [server_id for server_id, used_gpus
+                      in self.plan.ranked_servers(policy=policy, user_id=self.user_id, limit=attempts + 1)
+                      if server_id != self.server_id]
+        for server_id in candidates[:attempts]:
+            try:
+                self.server = Server.query.get(server_id)
+            except ValidationError:
+                continue
+            return self.server
+        return None
+
+
+@event.listens_for(UserPlan, 'after_insert')
+def user_plan_after_insert(maper, connection, target):
+    """Records the resources reserved for the new plan on the allocation ledger."""
+    if target.server_id is not None and target.cores is not None:
+        record_allocation(connection, allocation_entries(target.server_id, *target.get_usage(), reason='purchase',
+                                                         user_plan_id=target.id))
+
+
+class UserPlanGpu(db.Model):
+    user_plan_id = db.Column(db.Integer, db.ForeignKey('user_plan.id', ondelete='CASCADE'), primary_key=True)
+    gpu_model = db.Column(db.Text, db.ForeignKey('gpu.model'), primary_key=True)
+    amount = db.Column(db.Integer, nullable=False)
+
 
 class UserPlanStats(db.Model):
     user_plan_id = db.Column(db.Integer, db.ForeignKey('user_plan.id'), nullable=False, primary_key=True)
@@ -867,3 +2083,50 @@ class UserPlanStats(db.Model):
     disk_usage = db.Column(db.Float)
 
     user_plan = db.relationship('UserPlan', backref=db.backref('user_plan_stats'))
+
+
+def plan_server_count():
+    """Correlated subquery counting the servers that can host the plan.
+
+    Besides the OS and the cores, RAM, HD and SSD demand columns, each plan GPU
+    must fit on one server GPU of the same frequency and the plan GPUs of each
+    frequency must fit on the free capacity of that frequency. It may count a
+    server where the exact GPU assignment of match_gpus fails.
+    """
+    plan, server = Plan.__table__, Server.__table__
+    plan_gpu, server_gpu = PlanGpu.__table__, ServerGpu.__table__
+    plan_gpu_model, server_gpu_model = Gpu.__table__.alias('plan_gpu_model'), Gpu.__table__.alias('server_gpu_model')
+    plan_gpus = plan_gpu.join(plan_gpu_model, plan_gpu_model.c.model == plan_gpu.c.gpu_model)
+    server_gpus = server_gpu.join(server_gpu_model, server_gpu_model.c.model == server_gpu.c.gpu_model)
+
+    gpu_fits = select([server_gpu.c.server_id]).select_from(server_gpus) \
+        .where(and_(server_gpu.c.server_id == server.c.id,
+                    server_gpu_model.c.frequency == plan_gpu_model.c.frequency,
+                    server_gpu.c.available_capacity >= plan_gpu.c.quantity * plan_gpu_model.c.ram)) \
+        .correlate(server, plan_gpu, plan_gpu_model)
+    gpu_missing = select([plan_gpu.c.plan_id]).select_from(plan_gpus) \
+        .where(and_(plan_gpu.c.plan_id == plan.c.id, ~exists(gpu_fits))) \
+        .correlate(plan)
+    free_capacity = select([func.coalesce(func.sum(server_gpu.c.available_capacity), 0)]).select_from(server_gpus) \
+        .where(and_(server_gpu.c.server_id == server.c.id,
+                    server_gpu_model.c.frequency == plan_gpu_model.c.frequency)) \
+        .correlate(server, plan_gpu_model).as_scalar()
+    gpu_over_capacity = select([plan_gpu_model.c.frequency]).select_from(plan_gpus) \
+        .where(plan_gpu.c.plan_id == plan.c.id) \
+        .group_by(plan_gpu_model.c.frequency) \
+        .having(func.sum(plan_gpu.c.quantity * plan_gpu_model.c.ram) > free_capacity) \
+        .correlate(plan)
+
+    return select([func.count(server.c.id)]) \
+        .where(and_(server.c.os_name == plan.c.os_name,
+                    server.c.in_service.is_(True),
+                    server.c.cores_available >= plan.c.demand_cores,
+                    server.c.ram_available >= plan.c.demand_ram,
+                    server.c.hd_available >= plan.c.demand_hd,
+                    server.c.ssd_available >= plan.c.demand_ssd,
+                    ~exists(gpu_missing),
+                    ~exists(gpu_over_capacity))) \
+        .correlate_except(server).as_scalar()
+
+
+Plan.server_count = column_property(plan_server_count(), deferred=True)
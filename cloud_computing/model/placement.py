@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+from flask import current_app
+
+DEFAULT_PLACEMENT_POLICY = 'best-fit'
+
+
+class PlacementPolicy:
+    """Orders the servers of the fleet index that fit a plan."""
+    name = None
+    # True when rank needs the number of plans of the same user on each server
+    uses_tenants = False
+
+    def rank(self, index, rows, demand, tenants=None, limit=None):
+        """Returns 'rows' ordered from the preferred to the least preferred server.
+
+        :param index: the FleetIndex holding the rows.
+        :param rows: array with the index rows that fit the demand.
+        :param demand: the PlanDemand being placed.
+        :param tenants: dict of server_id -> plans of the same user on the server.
+        :param limit: when set only the preferred 'limit' rows, and the ones
+                      tied with them, need to be returned.
+        """
+        raise NotImplementedError
+
+    def __str__(self):
+        return self.name
+
+
+class FirstFit(PlacementPolicy):
+    """Takes the server with the lowest id."""
+    name = 'first-fit'
+
+    def rank(self, index, rows, demand, tenants=None, limit=None):
+        return sort_rows(rows, [index.server_ids[rows]], limit)
+
+
+class BestFit(PlacementPolicy):
+    """Takes the server with the least capacity left after the placement."""
+    name = 'best-fit'
+
+    def rank(self, index, rows, demand, tenants=None, limit=None):
+        return sort_rows(rows, [index.server_ids[rows], remaining_capacity(index, rows, demand)], limit)
+
+
+class WorstFit(PlacementPolicy):
+    """Takes the server with the most capacity left after the placement."""
+    name = 'worst-fit'
+
+    def rank(self, index, rows, demand, tenants=None, limit=None):
+        return sort_rows(rows, [index.server_ids[rows], -remaining_capacity(index, rows, demand)], limit)
+
+
+class Spread(PlacementPolicy):
+    """Anti-affinity: takes the server with the fewest plans of the same user,
+    breaking ties by the most capacity left."""
+    name = 'spread'
+    uses_tenants = True
+
+    def rank(self, index, rows, demand, tenants=None, limit=None):
+        if not len(rows):
+            return rows
+        # the user has plans on few servers, scattered on zeros for the whole fleet
+        same_user = np.zeros(len(index.server_ids), dtype=np.int64)
+        if tenants:
+            tenant_rows = index.rows_of(np.fromiter(tenants.keys(), dtype=np.int64, count=len(tenants)))
+            counts = np.fromiter(tenants.values(), dtype=np.int64, count=len(tenants))
+            same_user[tenant_rows[tenant_rows >= 0]] = counts[tenant_rows >= 0]
+        capacity = remaining_capacity(index, rows, demand)
+        # a single primary key, so that 'limit' narrows the sort: a plan of the
+        # user weighs more than any difference of capacity
+        weight = capacity.max() - capacity.min() + 1
+        return sort_rows(rows, [index.server_ids[rows], same_user[rows] * weight - capacity], limit)
+
+
+PLACEMENT_POLICIES = {policy.name: policy for policy in (FirstFit, BestFit, WorstFit, Spread)}
+
+
+def sort_rows(rows, keys, limit=None):
+    """Orders 'rows' by 'keys', the last key being the primary one as in
+    numpy.lexsort. With 'limit' only the rows whose primary key is among the
+    'limit' smallest are sorted, the others are left out."""
+    if limit is not None and limit < len(rows):
+        primary = keys[-1]
+        head = primary <= np.partition(primary, limit - 1)[limit - 1]
+        rows, keys = rows[head], [key[head] for key in keys]
+    if len(keys) == 1:
+        return rows[np.argsort(keys[0], kind='stable')]
+    return rows[np.lexsort(keys)]
+
+
+def remaining_capacity(index, rows, demand):
+    """Free capacity left on each row after placing 'demand', as the sum of the
+    fractions of the largest server of the fleet left for each resource."""
+    weights = 1.0 / index.capacity_scale()
+    needed = np.array([demand.cores, demand.ram, demand.hd, demand.ssd])
+    return index.capacity.dot(weights)[rows] - needed.dot(weights)
+
+
+def get_placement_policy(name=None):
+    """Returns the placement policy 'name', by default the one set on
+    the PLACEMENT_POLICY config."""
+    if name is None:
+        name = current_app.config.get('PLACEMENT_POLICY', DEFAULT_PLACEMENT_POLICY)
+    if name not in PLACEMENT_POLICIES:
+        raise ValueError('Unknown placement policy: %s' % name)
+    return PLACEMENT_POLICIES[name]()
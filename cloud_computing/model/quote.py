@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+from collections import namedtuple
+
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session, object_session
+
+from cloud_computing.model.database import db
+from cloud_computing.model.fleet_index import PlanDemand
+from cloud_computing.model.models import Resource, Cpu, Gpu, Ram, Hd, Os, sync_fleet_index
+
+Quote = namedtuple('Quote', ['price', 'monthly_price', 'available', 'server_count', 'demand'])
+"""Price of a hypothetical plan, the total for the duration and by month, and
+the number of servers where it fits now."""
+
+
+class ComponentCatalog:
+    """In-process cache of the component prices and specs, and of the OS names.
+
+    Loaded with one query per table and dropped after the commit of a change
+    to the components in this process, or after max_age seconds, picking up
+    the changes made by other workers.
+    """
+
+    def __init__(self, max_age=None):
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.components = None
+        self.os_names = None
+        self.loaded_at = None
+
+    def invalidate(self):
+        with self.lock:
+            self.components = None
+
+    def get(self, session=None):
+        """Returns (components, os_names), components being a dict of the
+        component class to a dict of model -> row."""
+        with self.lock:
+            if self.components is None or \
+                    (self.max_age is not None and time.time() - self.loaded_at > self.max_age):
+                self.load(session or db.session)
+            return self.components, self.os_names
+
+    def load(self, session):
+        components = {}
+        for component_class in (Cpu, Gpu, Ram, Hd):
+            table = component_class.__table__
+            components[component_class] = {row.model: row for row in session.execute(select([table]))}
+        self.os_names = {row.name for row in session.execute(select([Os.__table__.c.name]))}
+        self.components = components
+        self.loaded_at = time.time()
+
+
+component_catalog = ComponentCatalog()
+
+
+def quote_plan(cpu_model, os_name, duration_months, rams=None, hds=None, gpus=None):
+    """Prices a plan that isn't saved and counts the servers where it fits,
+    with the component catalog and the fleet index, without writing.
+
+    :param rams, hds, gpus: dicts of component model -> quantity.
+    :return: Quote.
+    :raise ValueError: when a component or the OS doesn't exist, or a
+                       quantity isn't positive.
+    """
+    components, os_names = component_catalog.get()
+    if os_name not in os_names:
+        raise ValueError('Sistema operacional desconhecido: %s' % os_name)
+    if duration_months is None or duration_months <= 0:
+        raise ValueError('A duração precisa ser maior que zero.')
+    cpu = component(components, Cpu, cpu_model)
+    monthly_price = cpu.price
+    ram = hd = ssd = 0
+    demand_gpus = []
+    for component_class, quantities in [(Ram, rams), (Hd, hds), (Gpu, gpus)]:
+        for model, quantity in (quantities or {}).items():
+            if quantity <= 0:
+                raise ValueError('A quantidade de %s precisa ser maior que zero.' % model)
+            row = component(components, component_class, model)
+            monthly_price += quantity * row.price
+            if component_class is Ram:
+                ram += quantity * row.capacity
+            elif component_class is Hd and row.is_ssd:
+                ssd += quantity * row.capacity
+            elif component_class is Hd:
+                hd += quantity * row.capacity
+            else:
+                demand_gpus.append((row.frequency, quantity * row.ram))
+    demand = PlanDemand(cpu.cores, ram, hd, ssd, demand_gpus)
+    server_count = len(sync_fleet_index().fit(demand, os_name))
+    return Quote(monthly_price * duration_months, monthly_price, server_count > 0, server_count, demand)
+
+
+def component(components, component_class, model):
+    row = components[component_class].get(model)
+    if row is None:
+        raise ValueError('Componente desconhecido: %s' % model)
+    return row
+
+
+@event.listens_for(Resource, 'after_insert', propagate=True)
+@event.listens_for(Resource, 'after_update', propagate=True)
+@event.listens_for(Resource, 'after_delete', propagate=True)
+@event.listens_for(Os, 'after_insert')
+@event.listens_for(Os, 'after_delete')
+def component_after_change(maper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        session.info['component_catalog_changed'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def component_catalog_after_commit(session):
+    if session.info.pop('component_catalog_changed', None):
+        component_catalog.invalidate()
+
+
+@event.listens_for(Session, 'after_rollback')
+def component_catalog_after_rollback(session):
+    session.info.pop('component_catalog_changed', None)
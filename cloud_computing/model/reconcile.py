@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+from collections import namedtuple
+
+from sqlalchemy import and_, or_, case, func, select, union_all, null
+
+from cloud_computing.model.database import db
+from cloud_computing.model.models import Server, ServerGpu, ServerRam, ServerHd, Cpu, Gpu, Ram, Hd, UserPlan, \
+    UserPlanGpu, Plan, CapacityHold, CapacityHoldGpu, Allocation, touch_server, refresh_changed_servers, \
+    record_allocation_from
+
+Drift = namedtuple('Drift', ['server_id', 'gpu_model', 'column', 'stored', 'expected'])
+"""A counter of a server, or of a server GPU when gpu_model is set, that
+differs from the value recomputed by reconcile_fleet."""
+
+# Server counters recomputed from the components and the plans
+SERVER_COUNTERS = ['cores_available', 'ram_total', 'ram_available', 'ram_slot_available', 'hd_total',
+                   'hd_available', 'ssd_total', 'ssd_available', 'hd_slot_available', 'gpu_slot_available']
+SERVER_GPU_COUNTERS = ['total_capacity', 'available_capacity']
+
+
+def reconcile_fleet(session=None, server_ids=None, fix=False):
+    """Recomputes the counters of the servers and compares them with the stored ones.
+
+    The totals and the free slots come from server_ram, server_hd and
+    server_gpu, the resources in use from the active UserPlans and the
+    capacity holds, each with one grouped query. When 'fix' is True the
+    servers that drifted are updated with one UPDATE ... FROM for the
+    servers and one for the server GPUs, and the allocation ledger gets
+    the rows that make its sum match the resources in use.
+
+    :param server_ids: servers checked, by default all of them.
+    :return: list of Drift.
+    """
+    session = session or db.session
+    connection = session.connection(mapper=Server.__mapper__)
+    server, server_gpu = Server.__table__, ServerGpu.__table__
+    expected, expected_gpus = expected_counters(server_ids)
+
+    server_drifted = or_(*[server.c[column].is_distinct_from(expected.c[column]) for column in SERVER_COUNTERS])
+    gpu_drifted = or_(*[server_gpu.c[column].is_distinct_from(expected_gpus.c[column])
+                        for column in SERVER_GPU_COUNTERS])
+    server_join = server.c.id == expected.c.id
+    gpu_join = and_(server_gpu.c.server_id == expected_gpus.c.server_id,
+                    server_gpu.c.gpu_model == expected_gpus.c.gpu_model)
+
+    drifts = []
+    for row in connection.execute(select([server] + list(expected.c)).where(and_(server_join, server_drifted))
+                                  .order_by(server.c.id).apply_labels()):
+        drifts += [Drift(row[server.c.id], None, column, row[server.c[column]], row[expected.c[column]])
+                   for column in SERVER_COUNTERS if row[server.c[column]] != row[expected.c[column]]]
+    for row in connection.execute(select([server_gpu] + list(expected_gpus.c)).where(and_(gpu_join, gpu_drifted))
+                                  .order_by(server_gpu.c.server_id, server_gpu.c.gpu_model).apply_labels()):
+        drifts += [Drift(row[server_gpu.c.server_id], row[server_gpu.c.gpu_model], column,
+                         row[server_gpu.c[column]], row[expected_gpus.c[column]])
+                   for column in SERVER_GPU_COUNTERS if row[server_gpu.c[column]] != row[expected_gpus.c[column]]]
+
+    if fix:
+        connection.execute(server.update().where(and_(server_join, server_drifted))
+                           .values({column: expected.c[column] for column in SERVER_COUNTERS}))
+        connection.execute(server_gpu.update().where(and_(gpu_join, gpu_drifted))
+                           .values({column: expected_gpus.c[column] for column in SERVER_GPU_COUNTERS}))
+        correct_allocation_ledger(connection, server_ids)
+        changed = {drift.server_id for drift in drifts}
+        for server_id in changed:
+            touch_server(session, server_id)
+        refresh_changed_servers(session, changed)
+    return drifts
+
+
+def expected_counters(server_ids=None):
+    """Subqueries with the recomputed counters of each server and server GPU."""
+    server, server_gpu, cpu, gpu = Server.__table__, ServerGpu.__table__, Cpu.__table__, Gpu.__table__
+    server_ram, ram, server_hd, hd = ServerRam.__table__, Ram.__table__, ServerHd.__table__, Hd.__table__
+
+    rams = select([server_ram.c.server_id, func.sum(server_ram.c.quantity).label('slots'),
+                   func.sum(server_ram.c.quantity * ram.c.capacity).label('total')]) \
+        .select_from(server_ram.join(ram, ram.c.model == server_ram.c.ram_model)) \
+        .group_by(server_ram.c.server_id).alias('rams')
+    hd_capacity = server_hd.c.quantity * hd.c.capacity
+    hds = select([server_hd.c.server_id, func.sum(server_hd.c.quantity).label('slots'),
+                  func.sum(case([(hd.c.is_ssd.is_(True), 0)], else_=hd_capacity)).label('hd'),
+                  func.sum(case([(hd.c.is_ssd.is_(True), hd_capacity)], else_=0)).label('ssd')]) \
+        .select_from(server_hd.join(hd, hd.c.model == server_hd.c.hd_model)) \
+        .group_by(server_hd.c.server_id).alias('hds')
+    gpus = select([server_gpu.c.server_id, func.sum(server_gpu.c.quantity).label('slots')]) \
+        .group_by(server_gpu.c.server_id).alias('gpus')
+    used = used_resources().alias('used')
+
+    def total(column):
+        return func.coalesce(column, 0)
+
+    expected = select([server.c.id,
+                       (cpu.c.cores - total(used.c.cores)).label('cores_available'),
+                       total(rams.c.total).label('ram_total'),
+                       (total(rams.c.total) - total(used.c.ram)).label('ram_available'),
+                       (server.c.ram_slot_total - total(rams.c.slots)).label('ram_slot_available'),
+                       total(hds.c.hd).label('hd_total'),
+                       (total(hds.c.hd) - total(used.c.hd)).label('hd_available'),
+                       total(hds.c.ssd).label('ssd_total'),
+                       (total(hds.c.ssd) - total(used.c.ssd)).label('ssd_available'),
+                       (server.c.hd_slot_total - total(hds.c.slots)).label('hd_slot_available'),
+                       (server.c.gpu_slot_total - total(gpus.c.slots)).label('gpu_slot_available')]) \
+        .select_from(server.join(cpu, cpu.c.model == server.c.cpu_model)
+                     .outerjoin(rams, rams.c.server_id == server.c.id)
+                     .outerjoin(hds, hds.c.server_id == server.c.id)
+                     .outerjoin(gpus, gpus.c.server_id == server.c.id)
+                     .outerjoin(used, used.c.server_id == server.c.id))
+
+    used_gpus = used_gpu_resources().alias('used_gpus')
+    gpu_total = server_gpu.c.quantity * gpu.c.ram
+    expected_gpus = select([server_gpu.c.server_id, server_gpu.c.gpu_model,
+                            gpu_total.label('total_capacity'),
+                            (gpu_total - total(used_gpus.c.amount)).label('available_capacity')]) \
+        .select_from(server_gpu.join(gpu, gpu.c.model == server_gpu.c.gpu_model)
+                     .outerjoin(used_gpus, and_(used_gpus.c.server_id == server_gpu.c.server_id,
+                                                used_gpus.c.gpu_model == server_gpu.c.gpu_model)))
+    if server_ids is not None:
+        expected = expected.where(server.c.id.in_(server_ids))
+        expected_gpus = expected_gpus.where(server_gpu.c.server_id.in_(server_ids))
+    return expected.alias('expected'), expected_gpus.alias('expected_gpus')
+
+
+def used_resources():
+    """Resources in use on each server by the active UserPlans and the holds.
+    The UserPlans without the usage columns count the demand of their plan."""
+    user_plan, plan, hold = UserPlan.__table__, Plan.__table__, CapacityHold.__table__
+    plans = select([user_plan.c.server_id,
+                    func.coalesce(user_plan.c.cores, plan.c.demand_cores, 0).label('cores'),
+                    func.coalesce(user_plan.c.ram, plan.c.demand_ram, 0).label('ram'),
+                    func.coalesce(user_plan.c.hd, plan.c.demand_hd, 0).label('hd'),
+                    func.coalesce(user_plan.c.ssd, plan.c.demand_ssd, 0).label('ssd')]) \
+        .select_from(user_plan.join(plan, plan.c.id == user_plan.c.plan_id)) \
+        .where(and_(user_plan.c.expired.is_(False), user_plan.c.server_id.isnot(None)))
+    holds = select([hold.c.server_id, hold.c.cores, hold.c.ram, hold.c.hd, hold.c.ssd])
+    rows = union_all(plans, holds).alias('in_use')
+    return select([rows.c.server_id, func.sum(rows.c.cores).label('cores'), func.sum(rows.c.ram).label('ram'),
+                   func.sum(rows.c.hd).label('hd'), func.sum(rows.c.ssd).label('ssd')]) \
+        .group_by(rows.c.server_id)
+
+
+def used_gpu_resources():
+    """GPU capacity in use on each server GPU by the active UserPlans and the holds."""
+    user_plan, user_plan_gpu = UserPlan.__table__, UserPlanGpu.__table__
+    hold, hold_gpu = CapacityHold.__table__, CapacityHoldGpu.__table__
+    plans = select([user_plan.c.server_id, user_plan_gpu.c.gpu_model, user_plan_gpu.c.amount]) \
+        .select_from(user_plan_gpu.join(user_plan, user_plan.c.id == user_plan_gpu.c.user_plan_id)) \
+        .where(and_(user_plan.c.expired.is_(False), user_plan.c.server_id.isnot(None)))
+    holds = select([hold.c.server_id, hold_gpu.c.gpu_model, hold_gpu.c.amount]) \
+        .select_from(hold_gpu.join(hold, hold.c.id == hold_gpu.c.hold_id))
+    rows = union_all(plans, holds).alias('gpus_in_use')
+    return select([rows.c.server_id, rows.c.gpu_model, func.sum(rows.c.amount).label('amount')]) \
+        .group_by(rows.c.server_id, rows.c.gpu_model)
+
+
+def correct_allocation_ledger(connection, server_ids=None):
+    """Appends to the allocation ledger the difference between the resources in
+    use and the sum of the ledger of each server, so rebuild_server_availability
+    gives the reconciled counters."""
+    allocation = Allocation.__table__
+    used, used_gpus = used_resources().alias('used'), used_gpu_resources().alias('used_gpus')
+    ledger = select([allocation.c.server_id, func.sum(allocation.c.cores).label('cores'),
+                     func.sum(allocation.c.ram).label('ram'), func.sum(allocation.c.hd).label('hd'),
+                     func.sum(allocation.c.ssd).label('ssd')]) \
+        .group_by(allocation.c.server_id).alias('ledger')
+    ledger_gpus = select([allocation.c.server_id, allocation.c.gpu_model,
+                          func.sum(allocation.c.gpu).label('gpu')]) \
+        .where(allocation.c.gpu_model.isnot(None)) \
+        .group_by(allocation.c.server_id, allocation.c.gpu_model).alias('ledger_gpus')
+
+    server = Server.__table__
+    differences = [func.coalesce(getattr(used.c, name), 0) - func.coalesce(getattr(ledger.c, name), 0)
+                   for name in ['cores', 'ram', 'hd', 'ssd']]
+    base = select([server.c.id, null(), null()] + differences) \
+        .select_from(server.outerjoin(used, used.c.server_id == server.c.id)
+                     .outerjoin(ledger, ledger.c.server_id == server.c.id)) \
+        .where(or_(*[difference != 0 for difference in differences]))
+    # full join, the GPU may be missing from the ledger or from the plans in use
+    server_id = func.coalesce(used_gpus.c.server_id, ledger_gpus.c.server_id)
+    gpu_difference = func.coalesce(used_gpus.c.amount, 0) - func.coalesce(ledger_gpus.c.gpu, 0)
+    gpus = select([server_id, null(), null(), func.coalesce(used_gpus.c.gpu_model, ledger_gpus.c.gpu_model),
+                   gpu_difference]) \
+        .select_from(used_gpus.outerjoin(ledger_gpus, and_(ledger_gpus.c.server_id == used_gpus.c.server_id,
+                                                           ledger_gpus.c.gpu_model == used_gpus.c.gpu_model),
+                                         full=True)) \
+        .where(gpu_difference != 0)
+    if server_ids is not None:
+        base = base.where(server.c.id.in_(server_ids))
+        gpus = gpus.where(server_id.in_(server_ids))
+
+    record_allocation_from(connection, 'reconcile', base, gpus)
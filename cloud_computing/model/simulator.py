@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import heapq
+import itertools
+import random
+import time
+from collections import namedtuple, Counter
+
+import numpy as np
+from sqlalchemy import func, select, and_
+
+from cloud_computing.model.database import db
+from cloud_computing.model.fleet_index import FleetIndex, PlanDemand, CORES, RAM, HD, SSD
+from cloud_computing.model.models import Server, ServerGpu, Cpu, Gpu, Plan, Purchase, UserPlan, UserPlanGpu, \
+    fleet_index_rows
+from cloud_computing.utils.form_utils import add_months
+
+RESOURCES = ['cores', 'ram', 'hd', 'ssd', 'gpu']
+
+FleetSnapshot = namedtuple('FleetSnapshot', ['server_rows', 'gpu_rows', 'leases'])
+"""Inventory the simulation starts from: the fleet index rows of the servers
+and of their GPUs, and the (end_date, server_id, demand, used_gpus) of the
+UserPlans already placed, given back on their end date."""
+
+SimulatedPurchase = namedtuple('SimulatedPurchase', ['date', 'user_id', 'os_name', 'demand', 'months', 'lease'])
+"""A purchase replayed by simulate. A purchase whose 'lease' is still active
+renews it instead of being placed again, like the renewal of a UserPlan."""
+
+SimulationReport = namedtuple('SimulationReport', ['purchases', 'rejected', 'rejection_rate', 'fragmented',
+                                                   'utilization', 'peak_utilization', 'exhausted', 'seconds'])
+"""Result of simulate. 'fragmented' counts the rejections where each resource
+was free on some server but never all of them on the same one. 'utilization'
+and 'peak_utilization' map each resource to the mean and the largest daily
+fraction in use, 'exhausted' maps it to the first date a purchase was
+rejected because no server had enough of it, or None."""
+
+
+def fleet_snapshot(session=None, empty=False, clones=None):
+    """Takes a snapshot of the fleet in service.
+
+    :param empty: when True the servers start with their whole capacity,
+                  without the UserPlans, e.g. to replay past purchases.
+    :param clones: dict of server_id -> copies of the server added to the
+                   fleet with its whole capacity, to try new hardware.
+    :return: FleetSnapshot.
+    """
+    session = session or db.session
+    if empty:
+        server_rows, gpu_rows = total_capacity_rows(session)
+        leases = []
+    else:
+        server_rows, gpu_rows = fleet_index_rows(session)
+        leases = active_leases(session)
+    server_rows, gpu_rows = [tuple(row) for row in server_rows], [tuple(row) for row in gpu_rows]
+    if clones:
+        totals, total_gpus = total_capacity_rows(session, list(clones))
+        next_id = max([row[0] for row in server_rows] + [0]) + 1
+        for server_id, os_name, cores, ram, hd, ssd in totals:
+            for _ in range(clones[server_id]):
+                server_rows.append((next_id, os_name, cores, ram, hd, ssd))
+                gpu_rows += [(next_id,) + tuple(row[1:]) for row in total_gpus if row[0] == server_id]
+                next_id += 1
+    return FleetSnapshot(server_rows, gpu_rows, leases)
+
+
+def total_capacity_rows(session, server_ids=None):
+    """Fleet index rows of the servers in service with nothing allocated."""
+    servers = session.query(Server.id, Server.os_name, Cpu.cores, Server.ram_total, Server.hd_total,
+                            Server.ssd_total) \
+        .join(Cpu, Cpu.model == Server.cpu_model).filter(Server.in_service.is_(True))
+    gpus = session.query(ServerGpu.server_id, ServerGpu.gpu_model, Gpu.frequency, ServerGpu.total_capacity) \
+        .join(Gpu, Gpu.model == ServerGpu.gpu_model) \
+        .join(Server, Server.id == ServerGpu.server_id).filter(Server.in_service.is_(True))
+    if server_ids is not None:
+        servers = servers.filter(Server.id.in_(server_ids))
+        gpus = gpus.filter(ServerGpu.server_id.in_(server_ids))
+    return servers.all(), gpus.all()
+
+
+def active_leases(session):
+    """The (end_date, server_id, demand, used_gpus) of the active UserPlans on
+    the servers in service, read with one query for the plans and one for
+    their GPUs."""
+    user_plan, plan, server = UserPlan.__table__, Plan.__table__, Server.__table__
+    user_plan_gpu = UserPlanGpu.__table__
+    active = and_(user_plan.c.expired.is_(False), server.c.in_service.is_(True))
+    plans = select([user_plan.c.id, user_plan.c.end_date, user_plan.c.server_id,
+                    func.coalesce(user_plan.c.cores, plan.c.demand_cores, 0),
+                    func.coalesce(user_plan.c.ram, plan.c.demand_ram, 0),
+                    func.coalesce(user_plan.c.hd, plan.c.demand_hd, 0),
+                    func.coalesce(user_plan.c.ssd, plan.c.demand_ssd, 0)]) \
+        .select_from(user_plan.join(plan, plan.c.id == user_plan.c.plan_id)
+                     .join(server, server.c.id == user_plan.c.server_id)) \
+        .where(active)
+    gpus = select([user_plan_gpu.c.user_plan_id, user_plan_gpu.c.gpu_model, user_plan_gpu.c.amount]) \
+        .select_from(user_plan_gpu.join(user_plan, user_plan.c.id == user_plan_gpu.c.user_plan_id)
+                     .join(server, server.c.id == user_plan.c.server_id)) \
+        .where(active)
+    connection = session.connection(mapper=UserPlan.__mapper__)
+    used_gpus = {}
+    for user_plan_id, gpu_model, amount in connection.execute(gpus):
+        used_gpus.setdefault(user_plan_id, {})[gpu_model] = amount
+    return [(end_date.date(), server_id, PlanDemand(cores, ram, hd, ssd, []), used_gpus.get(user_plan_id, {}))
+            for user_plan_id, end_date, server_id, cores, ram, hd, ssd in connection.execute(plans)]
+
+
+def purchase_stream(session=None, since=None, until=None, start=None):
+    """The purchases made between 'since' and 'until', in order.
+
+    :param start: date the first purchase is moved to, the others keep their
+                  distance from it. By default the purchases keep their dates.
+    :return: list of SimulatedPurchase, leased by their UserPlan.
+    """
+    session = session or db.session
+    purchase, plan = Purchase.__table__, Plan.__table__
+    query = select([purchase.c.date, purchase.c.user_id, purchase.c.user_plan_id, plan.c.id]) \
+        .select_from(purchase.join(plan, plan.c.id == purchase.c.plan_id)) \
+        .order_by(purchase.c.date, purchase.c.id)
+    if since is not None:
+        query = query.where(purchase.c.date >= since)
+    if until is not None:
+        query = query.where(purchase.c.date < until)
+    rows = session.connection(mapper=Purchase.__mapper__).execute(query).fetchall()
+    plans = plan_demands(session, {row[3] for row in rows})
+    shift = datetime.timedelta(0)
+    if start is not None and rows:
+        shift = start - rows[0][0].date()
+    return [SimulatedPurchase(date.date() + shift, user_id, plans[plan_id][0], plans[plan_id][1],
+                              plans[plan_id][2], user_plan_id)
+            for date, user_id, user_plan_id, plan_id in rows]
+
+
+def synthetic_stream(session=None, purchases=10000, start=None, days=365, users=1000, seed=0):
+    """Random purchases of the public plans, each plan bought in proportion to
+    its past purchases (plus one, so the new plans are bought too).
+
+    :return: list of SimulatedPurchase spread over 'days' from 'start'.
+    """
+    session = session or db.session
+    start = start or datetime.date.today()
+    popularity = dict(session.query(Plan.id, func.count(Purchase.id))
+                      .outerjoin(Purchase, Purchase.plan_id == Plan.id)
+                      .filter(Plan.is_public.is_(True)).group_by(Plan.id))
+    if not popularity:
+        return []
+    plans = plan_demands(session, popularity)
+    plan_ids = sorted(plans)
+    rng = random.Random(seed)
+    chosen = rng.choices(plan_ids, [popularity[plan_id] + 1 for plan_id in plan_ids], k=purchases)
+    offsets = sorted(rng.randrange(days) for _ in range(purchases))
+    return [SimulatedPurchase(start + datetime.timedelta(days=offset), rng.randrange(users), plans[plan_id][0],
+                              plans[plan_id][1], plans[plan_id][2], None)
+            for offset, plan_id in zip(offsets, chosen)]
+
+
+def plan_demands(session, plan_ids):
+    """dict of plan_id -> (os_name, PlanDemand, duration_months)."""
+    if not plan_ids:
+        return {}
+    plans = Plan.query.filter(Plan.id.in_(plan_ids)).all()
+    return {plan.id: (plan.os_name, plan.get_demand(), plan.duration_months) for plan in plans}
+
+
+def simulate(snapshot, stream, policy):
+    """Replays 'stream' on an in-memory FleetIndex loaded from 'snapshot',
+    placing each purchase like Plan.available_servers with 'policy' and giving
+    the resources back when its lease ends.
+
+    :param stream: list of SimulatedPurchase ordered by date.
+    :return: SimulationReport.
+    """
+    started = time.time()
+    index = FleetIndex()
+    index.load(snapshot.server_rows, snapshot.gpu_rows)
+    # (end, sequence, lease, row, demand, used_gpus, user_id) of each placement
+    ends = []
+    sequence = itertools.count()
+    # lease -> [end, row, demand, used_gpus, user_id] of the leases placed by the stream
+    active = {}
+    for end, server_id, demand, used_gpus in snapshot.leases:
+        row = index.rows.get(server_id)
+        if row is not None:
+            heapq.heappush(ends, (end, next(sequence), None, row, demand, used_gpus, None))
+    totals = index.capacity.sum(axis=0) + np.sum([[demand.cores, demand.ram, demand.hd, demand.ssd]
+                                                  for _, _, _, _, demand, _, _ in ends], axis=0, dtype=np.int64)
+    gpu_total = index.gpu_free.sum() + sum(sum(used_gpus.values()) for _, _, _, _, _, used_gpus, _ in ends)
+    totals = np.append(totals, gpu_total)
+
+    tenants = {}
+    rejected = fragmented = 0
+    exhausted = dict.fromkeys(RESOURCES)
+    samples = []
+    day = stream[0].date if stream else None
+    for purchase in stream:
+        while day < purchase.date:
+            samples.append(used_fraction(index, totals))
+            day += datetime.timedelta(days=1)
+        while ends and ends[0][0] <= purchase.date:
+            end, _, lease, row, demand, used_gpus, user_id = heapq.heappop(ends)
+            if lease is not None:
+                if active[lease][0] != end:
+                    # renovado, a entrada com o novo fim libera os recursos
+                    continue
+                del active[lease]
+            index.allocate(row, demand, used_gpus, sign=-1)
+            if user_id is not None:
+                user_tenants, server_id = tenants[user_id], int(index.server_ids[row])
+                user_tenants[server_id] -= 1
+                if not user_tenants[server_id]:
+                    # only the servers still holding plans of the user, as the tenants of ranked_servers
+                    del user_tenants[server_id]
+
+        if purchase.lease is not None and purchase.lease in active:
+            # renovação, o plano continua no mesmo servidor
+            placement = active[purchase.lease]
+            placement[0] = add_months(placement[0], purchase.months)
+            heapq.heappush(ends, (placement[0], next(sequence), purchase.lease) + tuple(placement[1:]))
+            continue
+        user_tenants = tenants.setdefault(purchase.user_id, Counter())
+        fits = index.fit(purchase.demand, purchase.os_name, limit=1, policy=policy, tenants=user_tenants)
+        if not fits:
+            rejected += 1
+            missing = missing_resources(index, purchase.demand, purchase.os_name)
+            if not missing:
+                fragmented += 1
+            for resource in missing:
+                if exhausted[resource] is None:
+                    exhausted[resource] = purchase.date
+            continue
+        server_id, used_gpus = fits[0]
+        row = index.rows[server_id]
+        index.allocate(row, purchase.demand, used_gpus)
+        user_tenants[server_id] += 1
+        end = add_months(purchase.date, purchase.months)
+        if purchase.lease is not None:
+            active[purchase.lease] = [end, row, purchase.demand, used_gpus, purchase.user_id]
+        heapq.heappush(ends, (end, next(sequence), purchase.lease, row, purchase.demand, used_gpus,
+                              purchase.user_id))
+    if stream:
+        samples.append(used_fraction(index, totals))
+
+    samples = np.array(samples).reshape(-1, len(RESOURCES))
+    mean = samples.mean(axis=0) if len(samples) else np.zeros(len(RESOURCES))
+    peak = samples.max(axis=0) if len(samples) else np.zeros(len(RESOURCES))
+    return SimulationReport(len(stream), rejected, rejected / max(len(stream), 1), fragmented,
+                            dict(zip(RESOURCES, mean.tolist())), dict(zip(RESOURCES, peak.tolist())), exhausted,
+                            time.time() - started)
+
+
+def used_fraction(index, totals):
+    """Fraction of the fleet capacity in use, in the order of RESOURCES. A
+    resource the fleet doesn't have is never in use."""
+    free = np.append(index.capacity.sum(axis=0), index.gpu_free.sum())
+    return np.where(totals > 0, 1 - free / np.maximum(totals, 1), 0)
+
+
+def missing_resources(index, demand, os_name):
+    """The resources of 'demand' that no server with the OS has free, even
+    looking at each resource alone."""
+    os_code = index.os_codes.get(os_name)
+    rows = index.server_os == os_code if os_code is not None else np.zeros(len(index.server_ids), dtype=bool)
+    missing = [resource for resource, column, needed in [('cores', CORES, demand.cores), ('ram', RAM, demand.ram),
+                                                          ('hd', HD, demand.hd), ('ssd', SSD, demand.ssd)]
+               if needed > 0 and not np.any(index.capacity[rows, column] >= needed)]
+    for frequency, amount in demand.gpus:
+        column = index.gpu_classes.get(frequency)
+        if column is None or not np.any(index.gpu_max[rows, column] >= amount):
+            missing.append('gpu')
+            break
+    return missing
@@ -0,0 +1,37 @@
+// Completes the search boxes with /api/suggestions, the plans open directly
+(function () {
+  var datalist = document.getElementById('search-suggestions');
+  if (!datalist) {
+    return;
+  }
+  var plans = {};
+  var timer = null;
+
+  function fill(data) {
+    datalist.innerHTML = '';
+    plans = {};
+    data.plans.forEach(function (plan) {
+      plans[plan.title] = plan.url;
+    });
+    Object.keys(plans).concat(data.components).forEach(function (value) {
+      var option = document.createElement('option');
+      option.value = value;
+      datalist.appendChild(option);
+    });
+  }
+
+  document.querySelectorAll('input[list="search-suggestions"]').forEach(function (input) {
+    input.addEventListener('input', function () {
+      if (plans.hasOwnProperty(input.value)) {
+        window.location = plans[input.value];
+        return;
+      }
+      clearTimeout(timer);
+      timer = setTimeout(function () {
+        fetch(datalist.dataset.url + '?q=' + encodeURIComponent(input.value))
+          .then(function (response) { return response.json(); })
+          .then(fill);
+      }, 150);
+    });
+  });
+})();
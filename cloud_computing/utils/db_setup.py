@@ -4,9 +4,10 @@ import datetime
 from flask_security import utils
 
 from cloud_computing.model.database import db
-from cloud_computing.model.models import Os, Cpu, Gpu, Ram, Hd, ResourceRequests, CreditCard, Server, Plan
+from cloud_computing.model.models import Os, Cpu, Gpu, Ram, Hd, ResourceRequests, CreditCard, Server, Plan, \
+    update_plan_availability, update_plan_search_vector
 from cloud_computing.model.database import user_datastore
-from cloud_computing.utils.db_utils import get, get_or_create
+from cloud_computing.utils.db_utils import get, get_or_create, upgrade_schema
 
 
 SERVER_ID = 1500
@@ -19,6 +20,7 @@ def setup_database_data(app):
     with app.app_context():
         # Create any database tables that don't exist yet
         db.create_all()
+        upgrade_schema(db.engine, db.metadata)
 
         # Setup the user roles
         user_datastore.find_or_create_role(name='admin',
@@ -26,6 +28,11 @@ def setup_database_data(app):
         user_datastore.find_or_create_role(name='end-user',
                                            description='End user')
 
+        # Fill the availability and the search vector of the plans created by older versions
+        update_plan_availability(db.session)
+        update_plan_search_vector(db.session.connection(mapper=Plan.__mapper__),
+                                  db.session.query(Plan.id).filter(Plan.search_vector.is_(None)))
+
         db.session.commit()
 
     # TODO Remove test data before release
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+from sqlalchemy import inspect, text
+
 
 def get_or_create(session, _model, **kwargs):
     """Returns a database instance. If there is none creates one."""
@@ -15,3 +17,60 @@ def get_or_create(session, _model, **kwargs):
 def get(session, _model, **kwargs):
     """Queries the database instance in the session."""
     return session.query(_model).filter_by(**kwargs).first()
+
+
+def upgrade_schema(engine, metadata):
+    """Adds the columns and indexes declared on the models that are missing on
+    tables created by an older version, create_all only creates new tables.
+    The NOT NULL columns with a default that are still nullable are filled."""
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    for table in metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        columns = {column['name']: column for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in columns:
+                add_column(engine, table, column)
+            elif columns[column.name]['nullable'] and not column.nullable and not column.primary_key:
+                # left NULL by the versions that added the columns without their defaults
+                backfill_column(engine, table, column)
+        indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in indexes:
+                index.create(engine)
+
+
+def add_column(engine, table, column):
+    """Adds the column to the table with its server default, the existing rows
+    getting the default instead of NULL."""
+    preparer = engine.dialect.identifier_preparer
+    default = column_default(engine, column)
+    engine.execute('ALTER TABLE %s ADD COLUMN %s %s%s' % (preparer.format_table(table), preparer.format_column(column),
+                                                         column.type.compile(dialect=engine.dialect),
+                                                         ' DEFAULT ' + default if default is not None else ''))
+    backfill_column(engine, table, column)
+
+
+def backfill_column(engine, table, column):
+    """Writes the default of the column, the server default or a scalar Python
+    one, on the rows where it's NULL and sets NOT NULL when the column is
+    declared so. Does nothing for the columns without a default."""
+    preparer = engine.dialect.identifier_preparer
+    table_name, column_name = preparer.format_table(table), preparer.format_column(column)
+    update = 'UPDATE {table} SET {column} = {value} WHERE {column} IS NULL'
+    default = column_default(engine, column)
+    if default is not None:
+        engine.execute(update.format(table=table_name, column=column_name, value=default))
+    elif column.default is not None and column.default.is_scalar:
+        engine.execute(text(update.format(table=table_name, column=column_name, value=':value')),
+                       value=column.default.arg)
+    else:
+        return
+    if not column.nullable:
+        engine.execute('ALTER TABLE %s ALTER COLUMN %s SET NOT NULL' % (table_name, column_name))
+
+
+def column_default(engine, column):
+    """SQL of the server default of the column, or None."""
+    return engine.dialect.ddl_compiler(engine.dialect, None).get_column_default_string(column)
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+
+from cloud_computing.model.models import Resource, Os, Plan, PlanGpu, PlanRam, PlanHd, Server, ServerGpu, \
+    ServerRam, ServerHd
+
+
+class LRUBackend:
+    """In-process cache of the last 'max_entries' pages, each one kept for up
+    to 'ttl' seconds, the staleness allowed for the changes committed by
+    other workers."""
+
+    def __init__(self, max_entries=512, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and time.monotonic() > expires_at:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl if self.ttl is not None else None)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class RedisBackend:
+    """Pages kept on Redis, shared by all the workers."""
+
+    def __init__(self, client, prefix='cloud_computing:page:', ttl=None):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        # only the deploys using this backend need the redis package
+        import redis
+        return cls(redis.StrictRedis.from_url(url), **kwargs)
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return value.decode('utf-8') if value is not None else None
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, value.encode('utf-8'), ex=self.ttl)
+
+    def clear(self):
+        keys = list(self.client.scan_iter(match=self.prefix + '*'))
+        if keys:
+            self.client.delete(*keys)
+
+
+class PageCache:
+    """Cache of the rendered shop pages, cleared after the commit of any change
+    to the plans, servers or components. Does nothing without a backend."""
+
+    def __init__(self, backend=None):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, config):
+        """Creates the backend set by PAGE_CACHE_BACKEND: 'lru', 'redis' or None."""
+        name, ttl = config.get('PAGE_CACHE_BACKEND'), config.get('PAGE_CACHE_TTL')
+        if name == 'lru':
+            self.backend = LRUBackend(config.get('PAGE_CACHE_SIZE', 512), ttl=ttl)
+        elif name == 'redis':
+            self.backend = RedisBackend.from_url(config['PAGE_CACHE_REDIS_URL'], ttl=ttl)
+        elif name is None:
+            self.backend = None
+        else:
+            raise ValueError('Cache de páginas desconhecido: %s' % name)
+
+    def get_or_render(self, key, render):
+        """Returns the page cached on 'key', or renders and caches it."""
+        if self.backend is None:
+            return render()
+        page = self.backend.get(key)
+        if page is not None:
+            self.hits += 1
+            return page
+        self.misses += 1
+        page = render()
+        self.backend.set(key, page)
+        return page
+
+    def invalidate(self):
+        if self.backend is not None:
+            self.backend.clear()
+
+
+page_cache = PageCache()
+# Search suggestions of the hot prefixes, always in-process
+suggestion_cache = PageCache(LRUBackend(max_entries=1024, ttl=60))
+
+SHOP_MODELS = [Plan, PlanGpu, PlanRam, PlanHd, Server, ServerGpu, ServerRam, ServerHd, Os]
+
+
+def shop_after_change(maper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        session.info['shop_pages_changed'] = True
+
+
+for shop_model in SHOP_MODELS:
+    for event_name in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(shop_model, event_name, shop_after_change)
+for event_name in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(Resource, event_name, shop_after_change, propagate=True)
+
+
+@event.listens_for(Session, 'before_commit')
+@event.listens_for(Session, 'after_flush_postexec')
+def shop_servers_touched(session, *args):
+    """The allocations change the server counters, and so the available plans,
+    without ORM events, see touch_server."""
+    if session.info.get('touched_servers'):
+        session.info['shop_pages_changed'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def page_cache_after_commit(session):
+    if session.info.pop('shop_pages_changed', None):
+        page_cache.invalidate()
+        suggestion_cache.invalidate()
+
+
+@event.listens_for(Session, 'after_rollback')
+def page_cache_after_rollback(session):
+    session.info.pop('shop_pages_changed', None)
@@ -1,15 +1,20 @@
 # -*- coding: utf-8 -*-
 import datetime
 import pygal
+from flask import flash
+from flask_admin.actions import action
 from flask_admin.contrib import sqla
 from flask_admin.contrib.sqla import validators
 from flask_security import current_user, utils
 from markupsafe import Markup
 from sqlalchemy import func
+from sqlalchemy.orm import undefer
 from wtforms import ValidationError, SelectField
 from wtforms.fields import PasswordField, IntegerField
 
 from cloud_computing.model.models import ResourceRequests, PlanGpu, PlanRam, PlanHd, ServerGpu, ServerRam, ServerHd
+from cloud_computing.model.allocation import drain_servers
+from cloud_computing.model.reconcile import reconcile_fleet
 from cloud_computing.utils.form_utils import ReadonlyCKTextAreaField, CKTextAreaField, ReadOnlyIntegerField
 
 ADMIN_RESOURCES_REQUEST_MESSAGE_LENGTH = 100
@@ -100,7 +105,7 @@ class RoleAdmin(AdminView):
 
 class PlanAdmin(AdminView):
     column_list = ['title', 'auto_price', 'price', 'duration_months',
-                   'cpu', 'os', 'plan_gpus', 'plan_rams', 'plan_hds', 'is_public']
+                   'cpu', 'os', 'plan_gpus', 'plan_rams', 'plan_hds', 'is_public', 'server_count']
     column_searchable_list = ['title', 'auto_price', 'duration_months', 'duration_months', 'shop_description',
                               'is_public']
 
@@ -128,7 +133,12 @@ class PlanAdmin(AdminView):
         plan_hds='HDs',
         os='OS',
         is_public='É Público?',
-        auto_price='Preço automático?')
+        auto_price='Preço automático?',
+        server_count='Cabe em N servidores')
+
+    def get_query(self):
+        """Loads the server_count of the plans on the same query."""
+        return super(PlanAdmin, self).get_query().options(undefer('server_count'))
 
 
 class ResourceRequestsAdmin(AdminView):
@@ -227,6 +237,17 @@ class ComponentAdmin(AdminView):
             else:
                 raise ValidationError("Quantidade total precisa ser maior que zero.")
 
+    def after_model_change(self, form, model, is_created):
+        """Reports the auto_price plans repriced by a price change."""
+        report = self.session.info.pop('reprice_report', None)
+        if report is None:
+            return
+        plans, deferred = report
+        if deferred:
+            flash('%d planos com preço automático serão recalculados em segundo plano.' % plans, 'info')
+        elif plans:
+            flash('%d planos com preço automático recalculados.' % plans, 'success')
+
 
 class CpuAdmin(ComponentAdmin):
     column_list = ['model', 'cores', 'frequency', 'price', 'total', 'available']
@@ -297,8 +318,8 @@ class HdAdmin(ComponentAdmin):
 
 class ServerAdmin(AdminView):
     column_list = ['id', 'cpu', 'cores_available', 'gpu_slot_available', 'server_gpus', 'ram_slot_available', 'ram_available', 'hd_slot_available',
-                   'hd_available', 'ssd_available', 'os']
-    form_columns = ['cpu', 'gpu_slot_total', 'ram_slot_total', 'ram_max', 'hd_slot_total', 'os']
+                   'hd_available', 'ssd_available', 'os', 'in_service']
+    form_columns = ['cpu', 'gpu_slot_total', 'ram_slot_total', 'ram_max', 'hd_slot_total', 'os', 'in_service']
 
     inline_models = [(ServerGpu,
                       dict(form_columns=['server_id', 'gpu_model', 'gpu', 'quantity'],
@@ -325,7 +346,8 @@ class ServerAdmin(AdminView):
         gpu_slot_total='Total de Slots de GPU',
         ram_slot_total='Total de Slots de RAM',
         hd_slot_total='Total de Slots de HD',
-        ram_max='Capacidade Máxima de RAM (GB)'
+        ram_max='Capacidade Máxima de RAM (GB)',
+        in_service='Em Serviço'
     )
     def _cores_formatter(self, context, model, name):
         return '%s/%s' % (model.cores_available, model.cpu.cores)
@@ -358,6 +380,35 @@ class ServerAdmin(AdminView):
         ssd_available=_ssd_formatter
     )
 
+    @action('reconcile', 'Reconciliar contadores',
+            'Recalcular os contadores dos servidores selecionados a partir dos componentes e planos?')
+    def action_reconcile(self, ids):
+        drifts = reconcile_fleet(self.session, server_ids=[int(server_id) for server_id in ids], fix=True)
+        self.session.commit()
+        if drifts:
+            flash('%d contadores corrigidos em %d servidores: %s' % (
+                len(drifts), len({drift.server_id for drift in drifts}),
+                ', '.join('%d.%s %s -> %s' % (drift.server_id, drift.column, drift.stored, drift.expected)
+                          for drift in drifts)), 'success')
+        else:
+            flash('Nenhum contador divergente.', 'success')
+
+    @action('drain', 'Esvaziar servidores',
+            'Retirar os servidores selecionados de serviço e migrar os seus planos para outros servidores?')
+    def action_drain(self, ids):
+        try:
+            result = drain_servers([int(server_id) for server_id in ids])
+            self.session.commit()
+        except ValidationError as error:
+            self.session.rollback()
+            flash(str(error), 'error')
+            return
+        flash('%d planos migrados.' % len(result.moved), 'success')
+        if result.unplaced:
+            flash('Sem servidor disponível para os planos: %s' % ', '.join(
+                '%d (%s, servidor %d)' % (user_plan.id, user_plan.plan.title, user_plan.server_id)
+                for user_plan in result.unplaced), 'error')
+
     def on_model_delete(self, model):
         if model.cpu.cores != model.cores_available:
             raise ValidationError("O servidor não pode ser excluido pois o CPU ainda está em uso.")
@@ -404,6 +455,8 @@ class UserPlanAdmin(AdminView):
         return Markup(date_chart.render(True))
 
     def _time_remaining(view, context, model, name):
+        if model.expired:
+            return "Expirado"
         time_remaining = model.end_date - datetime.datetime.now()
         return str(time_remaining.days) + " dias restantes"
 
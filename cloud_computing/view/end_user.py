@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-from flask import flash, request
+from flask import flash, request, current_app
 from flask_admin import expose
 from flask_admin.babel import gettext
 from flask_admin.contrib import sqla
@@ -10,10 +10,14 @@ from flask_admin.model.helpers import get_mdict_item_or_list
 from flask_security import current_user
 from markupsafe import Markup
 from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
 from werkzeug.utils import redirect
-from wtforms import BooleanField
+from wtforms import BooleanField, ValidationError
 
-from cloud_computing.model.models import ResourceRequests, CreditCard, Purchase, UserPlan, User
+from cloud_computing.controller.controller import Controller
+from cloud_computing.model.allocation import allocate_purchases
+from cloud_computing.model.models import ResourceRequests, CreditCard, Purchase, UserPlan, User, CapacityHold, Plan, \
+    config_hash
 from cloud_computing.utils.form_utils import CKTextAreaField
 from cloud_computing.view.admin import UserAdmin, UserPlanAdmin, PlanAdmin
 
@@ -28,6 +32,22 @@ class UserModelView(sqla.ModelView):
         return current_user.has_role('end-user')
 
 
+def form_config_hash(form):
+    """The config_hash of the plan in the form, read from the form data without
+    creating the model."""
+    components = []
+    for kind in ('gpu', 'hd', 'ram'):
+        field = getattr(form, 'plan_%ss' % kind)
+        for entry in field.entries:
+            if field.should_delete(entry):
+                continue
+            data = entry.data
+            component = data.get(kind)
+            components.append((kind, component.model if component else data.get(kind + '_model'),
+                               data.get('quantity')))
+    return config_hash(form.cpu.data.model, form.os.data.name, form.duration_months.data, components)
+
+
 class CustomPlan(PlanAdmin):
     column_list = ['title', 'price', 'duration_months',
                    'cpu', 'os', 'plan_gpus', 'plan_rams', 'plan_hds']
@@ -39,6 +59,33 @@ class CustomPlan(PlanAdmin):
     can_edit = False
     can_view_details = True
 
+    def create_model(self, form):
+        """Reuses the custom plan with the same configuration, when there is one,
+        instead of creating another."""
+        plan_hash = form_config_hash(form)
+        existing = Plan.query.filter(Plan.is_custom.is_(True), Plan.config_hash == plan_hash).first()
+        if existing is None:
+            model = super(CustomPlan, self).create_model(form)
+            if model is not False:
+                return model
+            # an identical plan committed by a concurrent request, see handle_view_exception
+            existing = Plan.query.filter(Plan.is_custom.is_(True), Plan.config_hash == plan_hash).first()
+            if existing is None:
+                return False
+        flash('Já existe um plano com essa configuração: %s.' % existing.title, 'info')
+        return existing
+
+    def handle_view_exception(self, exc):
+        """The violations of ix_plan_custom_config_hash are answered with the
+        existing plan by create_model."""
+        if isinstance(exc, IntegrityError) and \
+                getattr(getattr(exc.orig, 'diag', None), 'constraint_name', None) == 'ix_plan_custom_config_hash':
+            return True
+        return super(CustomPlan, self).handle_view_exception(exc)
+
+    def on_model_change(self, form, model, is_created):
+        model.is_custom = True
+
     def is_accessible(self):
         return current_user.has_role('end-user')
 
@@ -94,6 +141,7 @@ class PurchaseUser(UserModelView):
         user_plan='Contratação',
         price='Preço')
     form_columns = ['plan', 'credit_card']
+    list_template = 'admin/purchase_list.html'
 
     def _price_formatter(view, context, model, name):
         return model.plan.price
@@ -116,8 +164,69 @@ class PurchaseUser(UserModelView):
         """Select only the requests with the user_id equal to the current user."""
         return super(PurchaseUser, self).get_query().filter(Purchase.user_id == current_user.id)
 
+    def create_form(self, obj=None):
+        """Fills the plan of the CapacityHold passed on the 'hold' argument."""
+        form = super(PurchaseUser, self).create_form(obj)
+        hold = self._get_hold()
+        if hold is not None and request.method == 'GET':
+            form.plan.data = hold.plan
+        return form
+
     def on_model_change(self, form, model, is_created):
         model.user = current_user
+        hold = self._get_hold()
+        if hold is not None and hold.plan_id == model.plan.id:
+            model.hold_id = hold.id
+
+    def _get_hold(self):
+        hold_id = request.args.get('hold', type=int)
+        if hold_id is None:
+            return None
+        # the purchase being created can't be flushed before getting the hold_id
+        with self.session.no_autoflush:
+            return CapacityHold.query.filter_by(id=hold_id, user_id=current_user.id).first()
+
+    @expose('/checkout/', methods=('GET', 'POST'))
+    def checkout_view(self):
+        """Buys several plans at once, placed on the servers by allocate_purchases."""
+        return_url = get_redirect_target() or self.get_url('.index_view')
+        plans = Controller.get_available_plans()
+
+        if request.method == 'POST':
+            credit_card = CreditCard.query.filter_by(id=request.form.get('credit_card', type=int),
+                                                     user_id=current_user.id).first()
+            quantities = {plan.id: request.form.get('plan-%d' % plan.id, 0, type=int) for plan in plans}
+            max_per_plan, max_total = current_app.config['CHECKOUT_MAX_PER_PLAN'], \
+                current_app.config['CHECKOUT_MAX_TOTAL']
+            if credit_card is None:
+                flash('Cadastre um cartão de crédito antes de comprar.', 'error')
+            elif any(quantity < 0 or quantity > max_per_plan for quantity in quantities.values()):
+                flash('Escolha de 0 a %d unidades de cada plano.' % max_per_plan, 'error')
+            elif sum(quantities.values()) > max_total:
+                flash('Compre no máximo %d planos de uma vez.' % max_total, 'error')
+            elif not sum(quantities.values()):
+                flash('Escolha a quantidade de pelo menos um plano.', 'error')
+            else:
+                purchases = [Purchase(user_id=current_user.id, plan_id=plan_id, credit_card_id=credit_card.id)
+                             for plan_id, quantity in quantities.items() for _ in range(quantity)]
+                try:
+                    result = allocate_purchases(purchases, partial=request.form.get('partial') == 'y')
+                    self.session.commit()
+                except ValidationError as ex:
+                    self.session.rollback()
+                    flash(str(ex), 'error')
+                else:
+                    flash('%d plano(s) comprado(s) com sucesso.' % len(result.placed), 'success')
+                    if result.rejected:
+                        flash('%d plano(s) não couberam em nenhum servidor e não foram comprados.'
+                              % len(result.rejected), 'warning')
+                    return redirect(return_url)
+
+        return self.render('admin/checkout.html',
+                           plans=plans,
+                           max_per_plan=current_app.config['CHECKOUT_MAX_PER_PLAN'],
+                           credit_cards=CreditCard.query.filter_by(user_id=current_user.id).all(),
+                           return_url=return_url)
 
 
 class CreditCardUser(UserModelView):
@@ -1,42 +1,118 @@
 # -*- coding: utf-8 -*-
 
-from flask import Blueprint, render_template, request
+from flask import Blueprint, render_template, request, redirect, url_for, flash, current_app, abort, jsonify, \
+    session
+from flask_security import current_user, login_required
 from cloud_computing.controller.controller import Controller
+from cloud_computing.utils.page_cache import page_cache
 
 
 default_blueprint = Blueprint('default', __name__)
 
 
+# Roles checked by the shop templates
+SHOP_ROLES = ('admin', 'end-user')
+
+
+def user_role():
+    """The part of the shop pages that changes with the user, every role
+    checked by the templates that the user has."""
+    if current_user.is_anonymous:
+        return 'anonymous'
+    return '+'.join(role for role in SHOP_ROLES if current_user.has_role(role)) or 'user'
+
+
+def cached_page(key, render):
+    """Renders the shop page from the page cache, but for the requests with
+    flashed messages to show, whose pages aren't cached."""
+    if '_flashes' in session:
+        return render()
+    return page_cache.get_or_render(key, render)
+
+
 @default_blueprint.route('/')
 def show_homescreen():
     """Shows the homescreen."""
+    return cached_page('home:%s' % user_role(), render_homescreen)
+
+
+def render_homescreen():
     plans = Controller.get_available_plans()
 
     return render_template('shop-homepage.html', plans=plans)
 
 
+@default_blueprint.route('/api/quote')
+def quote_plan():
+    """Quotes a configuration without creating the plan, e.g.
+    /api/quote?cpu=Xeon&os=Linux&months=3&ram=DDR4 8GB:2&hd=SSD 250GB:1
+    """
+    try:
+        quote = Controller.quote_plan(request.args.get('cpu'), request.args.get('os'),
+                                      request.args.get('months', 1, type=int),
+                                      rams=component_quantities('ram'), hds=component_quantities('hd'),
+                                      gpus=component_quantities('gpu'))
+    except ValueError as error:
+        return jsonify(error=str(error)), 400
+    return jsonify(price=quote.price, monthly_price=quote.monthly_price, available=quote.available,
+                   server_count=quote.server_count, demand=quote.demand._asdict())
+
+
+@default_blueprint.route('/api/suggestions')
+def search_suggestions():
+    """Completes the search box, e.g. /api/suggestions?q=tes"""
+    limit = min(request.args.get('limit', 8, type=int), 20)
+    plans, components = Controller.suggest(request.args.get('q', ''), limit)
+    return jsonify(plans=[dict(title=title, url=url_for('default.show_item', slug_url=slug_url))
+                          for title, slug_url in plans],
+                   components=components)
+
+
+def component_quantities(name):
+    """Reads the MODEL:QUANTITY arguments 'name' of the request into a dict."""
+    quantities = {}
+    for value in request.args.getlist(name):
+        model, _, quantity = value.rpartition(':')
+        if not model or not quantity.isdigit():
+            raise ValueError('Componente inválido: %s' % value)
+        quantities[model] = quantities.get(model, 0) + int(quantity)
+    return quantities
+
+
 @default_blueprint.route('/<slug_url>')
 def show_item(slug_url):
     """Shows the item detail page."""
-    plan = Controller.get_plan_by_slug_url(slug_url)
+    return cached_page('item:%s:%s' % (user_role(), slug_url), lambda: render_item(slug_url))
 
-    if plan is not None:
-        gpu_list = Controller.get_plan_gpu_list(plan.id)
-        ram_list = Controller.get_plan_ram_list(plan.id)
-        hd_list = Controller.get_plan_hd_list(plan.id)
 
-        return render_template('shop-item.html', plan=plan, gpu_list=gpu_list,
-                               ram_list=ram_list, hd_list=hd_list)
+def render_item(slug_url):
+    return render_template('shop-item.html', plan=Controller.get_plan_detail(slug_url))
+
+
+@default_blueprint.route('/<slug_url>/reserve', methods=['POST'])
+@login_required
+def reserve_item(slug_url):
+    """Holds the capacity of the plan and sends the user to the purchase form."""
+    plan = Controller.get_plan_by_slug_url(slug_url)
+    if plan is None or not current_user.has_role('end-user'):
+        abort(404)
+
+    hold = Controller.hold_plan(plan, current_user.id)
+    if hold is None:
+        flash('Não existe servidor disponível para este plano. Mande um pedido de recurso '
+              'para os administradores ou compre outro plano', 'error')
+        return redirect(url_for('default.show_item', slug_url=slug_url))
 
-    else:
-        return render_template('shop-item.html', plan=plan)
+    flash('Plano reservado por %d minutos.' % (current_app.config['CAPACITY_HOLD_TTL'] // 60), 'success')
+    return redirect(url_for('purchase.create_view', hold=hold.id))
 
 
-@default_blueprint.route('/search-results', methods=['POST'])
+@default_blueprint.route('/search-results', methods=['GET', 'POST'])
 def search_elements():
-    """Searches for matches to the input on the database."""
-    search_input = request.form['search-box']
+    """Searches for matches to the input on the database, the pages after the
+    first are linked with GET."""
+    search_input = request.values.get('search-box', '')
 
-    results = Controller.search_plan(search_input)
+    results = Controller.search_plan(search_input, page=request.args.get('page', 1, type=int))
 
-    return render_template('shop-search-results.html', results=results)
+    return render_template('shop-search-results.html', results=results, search_input=search_input)
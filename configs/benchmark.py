@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+
+from configs.common import *  # NOQA
+
+# Banco de dados apagado e criado de novo por benchmarks.scenarios
+SQLALCHEMY_DATABASE_URI = 'postgresql://postgres:@localhost/cloud_computing_benchmarks'
+
+try:
+    from configs.local import *  # NOQA
+except ImportError:
+    pass
@@ -24,3 +24,38 @@ SQLALCHEMY_TRACK_MODIFICATIONS = False
 # Custom pages
 SECURITY_LOGIN_USER_TEMPLATE = 'login.html'
 SECURITY_REGISTER_USER_TEMPLATE = 'register.html'
+
+# Seconds before the in-process fleet capacity index is fully reloaded, picking
+# up changes made by other workers
+FLEET_INDEX_MAX_AGE = 30
+
+# Seconds before the in-process cache of the component prices used by the plan quotes is reloaded
+QUOTE_CATALOG_MAX_AGE = 60
+
+# Cache of the rendered shop pages: 'lru' (in-process), 'redis' (needs the redis package) or None.
+# PAGE_CACHE_TTL bounds, in seconds, how long a worker may serve a page changed by another worker
+PAGE_CACHE_BACKEND = 'lru'
+PAGE_CACHE_SIZE = 512
+PAGE_CACHE_TTL = 30
+PAGE_CACHE_REDIS_URL = os.environ.get('REDIS_URL')
+
+# Server placement policy of new purchases: first-fit, best-fit, worst-fit or spread
+PLACEMENT_POLICY = 'best-fit'
+
+# Servers tried by a purchase when the reservation fails on the ones chosen first
+ALLOCATION_MAX_ATTEMPTS = 10
+
+# Units of each plan, and plans in total, bought by one checkout
+CHECKOUT_MAX_PER_PLAN = 10
+CHECKOUT_MAX_TOTAL = 50
+
+# Seconds the capacity of a plan stays held on a server while the user checks out
+CAPACITY_HOLD_TTL = 600
+
+# Seconds the consolidation planner searches for migrations before returning the best plan found
+CONSOLIDATION_TIME_BUDGET = 5
+
+# Auto priced plans repriced in the flush that changes a component price, above
+# it they are repriced after the commit in a background thread, in batches of REPRICE_BATCH
+REPRICE_SYNC_LIMIT = 200
+REPRICE_BATCH = 500
@@ -5,6 +5,9 @@ import pytest
 
 from cloud_computing.app_factory import AppFactory
 from cloud_computing.model.database import db as _db
+from cloud_computing.model.fleet_index import fleet_index
+from cloud_computing.model.quote import component_catalog
+from cloud_computing.utils.page_cache import page_cache, suggestion_cache
 from . import factories
 
 
@@ -19,6 +22,10 @@ def app():
 
 @pytest.yield_fixture(scope='function')
 def db(app):
+    fleet_index.clear()
+    component_catalog.invalidate()
+    page_cache.invalidate()
+    suggestion_cache.invalidate()
     _db.drop_all()
     _db.create_all()
     yield _db
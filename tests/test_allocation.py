@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import threading
+
+import pytest
+from flask import get_flashed_messages
+from flask_login import login_user
+from wtforms import ValidationError
+
+from cloud_computing.model.allocation import allocate_purchases, drain_servers
+from cloud_computing.model import models
+from cloud_computing.model.fleet_index import fleet_index
+from cloud_computing.model.models import Server, Purchase, UserPlan, Cpu, Os, Plan, User, CreditCard, \
+    CapacityHold, ServerGpu, PlanGpu, Allocation, reserve_server, sync_fleet_index, hold_capacity, \
+    release_expired_holds, expire_user_plans, rebuild_server_availability
+from cloud_computing.model.placement import PLACEMENT_POLICIES
+from cloud_computing.view import end_user
+from . import factories
+
+THREADS = 8
+PURCHASES_PER_THREAD = 6
+
+
+def test_reserve_server_is_guarded(session):
+    plan = factories.PlanFactory(is_public=True)
+    server = factories.ServerFactory(cpu=plan.cpu, os=plan.os)
+    session.flush()
+    connection = session.connection(mapper=Server.__mapper__)
+    demand = plan.get_demand()
+    cores = server.cores_available
+    assert reserve_server(connection, server.id, demand, {})
+    assert not reserve_server(connection, server.id, demand._replace(cores=cores), {})
+    session.expire_all()
+    assert server.cores_available == cores - demand.cores
+
+
+def test_concurrent_purchases_do_not_overcommit(app, db):
+    session = db.create_scoped_session()
+    db.session = session
+    cpu = Cpu(model='CPU 8', cores=8, frequency=2.0, price=1, total=100)
+    plan_cpu = Cpu(model='CPU 1', cores=1, frequency=2.0, price=1, total=100)
+    os = Os(name='Linux')
+    session.add_all([cpu, plan_cpu, os])
+    session.flush()
+    servers = [Server(cpu_model=cpu.model, os_name=os.name, ram_slot_total=10, ram_max=160,
+                      gpu_slot_total=10, hd_slot_total=100) for _ in range(3)]
+    plan = Plan(title='Plano', price=10, duration_months=1, cpu_model=plan_cpu.model, os_name=os.name,
+                shop_description='Plano', is_public=True)
+    users = [User(name=str(i), last_name=str(i), email='%d@example.com' % i, password='x', active=True)
+             for i in range(THREADS)]
+    session.add_all(servers + [plan] + users)
+    session.flush()
+    cards = [CreditCard(number=i, name=str(i), cvv=i, exp_date=datetime.datetime(2030, 6, 1), users=user)
+             for i, user in enumerate(users)]
+    session.add_all(cards)
+    session.commit()
+    plan_id = plan.id
+    card_ids = [(card.users.id, card.id) for card in cards]
+    fleet_index.clear()
+
+    results = []
+
+    def buy(user_id, credit_card_id):
+        with app.app_context():
+            for _ in range(PURCHASES_PER_THREAD):
+                try:
+                    db.session.add(Purchase(user_id=user_id, credit_card_id=credit_card_id, plan_id=plan_id))
+                    db.session.commit()
+                    results.append(True)
+                except ValidationError:
+                    db.session.rollback()
+                    results.append(False)
+            db.session.remove()
+
+    threads = [threading.Thread(target=buy, args=ids) for ids in card_ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    try:
+        # 3 servers with 8 cores host 24 plans of 1 core, the other purchases fail
+        assert len(results) == THREADS * PURCHASES_PER_THREAD
+        assert results.count(True) == 3 * cpu.cores
+        assert UserPlan.query.count() == 3 * cpu.cores
+        assert [server.cores_available for server in Server.query.all()] == [0, 0, 0]
+    finally:
+        session.remove()
+
+
+def test_allocate_purchases(session):
+    plan = factories.PlanFactory(is_public=True)
+    servers = [factories.ServerFactory(cpu=plan.cpu, os=plan.os) for _ in range(2)]
+    card = factories.CreditCardFactory()
+    session.flush()
+    purchases = [Purchase(user_id=card.user_id, credit_card_id=card.id, plan_id=plan.id) for _ in range(3)]
+
+    with pytest.raises(ValidationError):
+        allocate_purchases(purchases)
+
+    result = allocate_purchases(purchases, partial=True)
+    session.flush()
+    session.expire_all()
+    assert len(result.placed) == 2 and result.rejected == [purchases[2]]
+    assert sorted(server_id for _, server_id in result.placed) == sorted(server.id for server in servers)
+    assert [server.cores_available for server in servers] == [0, 0]
+    assert UserPlan.query.count() == 2
+    assert all(purchase.user_plan.server_id is not None for purchase in purchases[:2])
+    assert purchases[2] not in session
+
+
+def test_allocate_purchases_with_stale_index(session):
+    plan = factories.PlanFactory(is_public=True)
+    servers = [factories.ServerFactory(cpu=plan.cpu, os=plan.os) for _ in range(2)]
+    card = factories.CreditCardFactory()
+    session.flush()
+    sync_fleet_index(session)
+    # outro processo ocupa o primeiro servidor sem passar pelo índice deste
+    session.connection(mapper=Server.__mapper__).execute(
+        Server.__table__.update().where(Server.__table__.c.id == servers[0].id).values(cores_available=0))
+
+    result = allocate_purchases([Purchase(user_id=card.user_id, credit_card_id=card.id, plan_id=plan.id)],
+                                policy=PLACEMENT_POLICIES['first-fit']())
+    assert [server_id for _, server_id in result.placed] == [servers[1].id]
+
+
+def test_capacity_hold(session):
+    plan = factories.PlanFactory(is_public=True)
+    server = factories.ServerFactory(cpu=plan.cpu, os=plan.os)
+    card = factories.CreditCardFactory()
+    session.flush()
+    cores = server.cores_available
+
+    hold = hold_capacity(plan, card.user_id)
+    session.flush()
+    session.expire_all()
+    assert hold.server_id == server.id
+    assert server.cores_available == cores - plan.cpu.cores
+    assert plan.available_servers() is None
+    assert hold_capacity(plan, card.user_id) is hold
+
+    purchase = Purchase(user_id=card.user_id, credit_card_id=card.id, plan_id=plan.id, hold_id=hold.id)
+    session.add(purchase)
+    # the UserPlan is added by the after_flush of the purchase
+    session.flush()
+    session.flush()
+    session.expire_all()
+    assert purchase.user_plan.server_id == server.id
+    assert server.cores_available == cores - plan.cpu.cores
+    assert CapacityHold.query.count() == 0
+
+
+def test_release_expired_holds(session):
+    plan = factories.PlanFactory(is_public=True)
+    server = factories.ServerFactory(cpu=plan.cpu, os=plan.os)
+    user = factories.UserFactory()
+    session.flush()
+    cores = server.cores_available
+    hold_capacity(plan, user.id)
+    session.flush()
+    assert release_expired_holds(session) == 0
+
+    CapacityHold.query.update({'expires_at': datetime.datetime(2000, 1, 1)})
+    assert release_expired_holds(session) == 1
+    session.expire_all()
+    assert server.cores_available == cores
+    assert CapacityHold.query.count() == 0
+    assert plan.available_servers() == [server]
+
+
+def test_expire_user_plans(session):
+    plan = factories.PlanFactory(is_public=True)
+    gpu = factories.GpuFactory(model='GPU 4GB', ram=4, frequency=2.0)
+    servers = [factories.ServerFactory(cpu=plan.cpu, os=plan.os) for _ in range(2)]
+    session.add_all([PlanGpu(plan=plan, gpu=gpu, quantity=1)] +
+                    [ServerGpu(server=server, gpu=gpu, quantity=1) for server in servers])
+    card = factories.CreditCardFactory()
+    session.flush()
+    purchases = [Purchase(user_id=card.user_id, credit_card_id=card.id, plan_id=plan.id) for _ in range(2)]
+    allocate_purchases(purchases)
+    session.flush()
+    expired_plan = purchases[0].user_plan
+    assert (expired_plan.cores, [(g.gpu_model, g.amount) for g in expired_plan.gpus]) == (plan.cpu.cores,
+                                                                                         [(gpu.model, 4)])
+    expired_plan.end_date = datetime.datetime(2000, 1, 1)
+    session.flush()
+
+    report = expire_user_plans(session)
+    assert (report.plans, report.servers, report.cores, report.gpu) == (1, 1, plan.cpu.cores, 4)
+    assert expire_user_plans(session).plans == 0
+    session.expire_all()
+    server = expired_plan.server
+    assert expired_plan.expired
+    assert server.cores_available == plan.cpu.cores
+    assert server.server_gpus[0].available_capacity == 4
+    assert [s.id for s in plan.available_servers()] == [server.id]
+
+    # renewing an expired plan reserves the resources again
+    session.add(Purchase(user_id=card.user_id, credit_card_id=card.id, plan_id=plan.id,
+                         user_plan_id=expired_plan.id))
+    session.flush()
+    session.flush()
+    session.expire_all()
+    assert not expired_plan.expired and expired_plan.end_date > datetime.datetime.now()
+    assert expired_plan.server_id == server.id
+    assert server.cores_available == 0 and server.server_gpus[0].available_capacity == 0
+
+
+def test_allocation_ledger(session):
+    plan = factories.PlanFactory(is_public=True)
+    gpu = factories.GpuFactory(model='GPU 4GB', ram=4, frequency=2.0)
+    servers = [factories.ServerFactory(cpu=plan.cpu, os=plan.os) for _ in range(3)]
+    session.add_all([PlanGpu(plan=plan, gpu=gpu, quantity=1)] +
+                    [ServerGpu(server=server, gpu=gpu, quantity=1) for server in servers])
+    card = factories.CreditCardFactory()
+    session.flush()
+    cores = plan.cpu.cores
+
+    purchase = Purchase(user_id=card.user_id, credit_card_id=card.id, plan_id=plan.id)
+    allocate_purchases([purchase], policy=PLACEMENT_POLICIES['first-fit']())
+    hold = hold_capacity(plan, card.user_id)
+    session.flush()
+    user_plan = purchase.user_plan
+    assert (user_plan.server_id, hold.server_id) == (servers[0].id, servers[1].id)
+    assert user_plan.relocate() is servers[2]
+    session.flush()
+    session.expire_all()
+    assert [server.cores_available for server in servers] == [cores, 0, 0]
+    assert [server.server_gpus[0].available_capacity for server in servers] == [4, 0, 0]
+
+    ledger = session.query(Allocation.reason, Allocation.server_id, Allocation.cores, Allocation.gpu) \
+        .order_by(Allocation.id).all()
+    assert ledger == [('purchase', servers[0].id, cores, 0), ('purchase', servers[0].id, 0, 4),
+                      ('hold', servers[1].id, cores, 0), ('hold', servers[1].id, 0, 4),
+                      ('moved', servers[0].id, -cores, 0), ('moved', servers[0].id, 0, -4),
+                      ('moved', servers[2].id, cores, 0), ('moved', servers[2].id, 0, 4)]
+
+    # counters lost, rebuilt from the ledger
+    session.execute(Server.__table__.update().values(cores_available=99))
+    session.execute(ServerGpu.__table__.update().values(available_capacity=99))
+    assert rebuild_server_availability(session) == 3
+    session.expire_all()
+    assert [server.cores_available for server in servers] == [cores, 0, 0]
+    assert [server.server_gpus[0].available_capacity for server in servers] == [4, 0, 0]
+
+    CapacityHold.query.update({'expires_at': datetime.datetime(2000, 1, 1)})
+    release_expired_holds(session)
+    assert rebuild_server_availability(session, [servers[1].id]) == 1
+    session.expire_all()
+    assert (servers[1].cores_available, servers[1].server_gpus[0].available_capacity) == (cores, 4)
+
+
+def test_relocate_stale_candidate(session):
+    plan = factories.PlanFactory(is_public=True)
+    servers = [factories.ServerFactory(cpu=plan.cpu, os=plan.os) for _ in range(4)]
+    card = factories.CreditCardFactory()
+    session.flush()
+    purchase = Purchase(user_id=card.user_id, credit_card_id=card.id, plan_id=plan.id)
+    allocate_purchases([purchase], policy=PLACEMENT_POLICIES['first-fit']())
+    session.flush()
+    user_plan = purchase.user_plan
+    assert user_plan.server_id == servers[0].id
+
+    # outro processo ocupou o segundo servidor sem que o índice soubesse
+    session.execute(Server.__table__.update().where(Server.id == servers[1].id).values(cores_available=0))
+    assert user_plan.relocate(policy=PLACEMENT_POLICIES['first-fit']()) is servers[2]
+    session.flush()
+    session.expire_all()
+    assert [server.cores_available for server in servers] == [plan.cpu.cores, 0, 0, plan.cpu.cores]
+
+    # nenhum outro servidor consegue receber o plano
+    session.execute(Server.__table__.update().where(Server.id != servers[2].id).values(cores_available=0))
+    assert user_plan.relocate(policy=PLACEMENT_POLICIES['first-fit']()) is None
+    assert user_plan.server_id == servers[2].id
+
+
+def test_drain_servers(session):
+    plan = factories.PlanFactory(is_public=True)
+    big_cpu = factories.CpuFactory(model='CPU 64', cores=plan.cpu.cores * 2)
+    drained = factories.ServerFactory(cpu=big_cpu, os=plan.os)
+    others = [factories.ServerFactory(cpu=plan.cpu, os=plan.os) for _ in range(2)]
+    card = factories.CreditCardFactory()
+    session.flush()
+    others[1].in_service = False
+    session.flush()
+    purchases = [Purchase(user_id=card.user_id, credit_card_id=card.id, plan_id=plan.id) for _ in range(2)]
+    allocate_purchases(purchases, policy=PLACEMENT_POLICIES['first-fit']())
+    session.flush()
+    assert {purchase.user_plan.server_id for purchase in purchases} == {drained.id}
+
+    result = drain_servers([drained.id])
+    session.flush()
+    session.expire_all()
+    assert [move.server_id for move in result.moved] == [others[0].id]
+    assert result.unplaced == [purchases[1].user_plan]
+    assert purchases[0].user_plan.server_id == others[0].id
+    assert (drained.cores_available, others[0].cores_available) == (plan.cpu.cores, 0)
+    assert not drained.in_service
+    assert plan.available_servers() is None
+    assert rebuild_server_availability(session) == 3
+    session.expire_all()
+    assert (drained.cores_available, others[0].cores_available) == (plan.cpu.cores, 0)
+
+
+def test_checkout_quantity_limits(session, app, monkeypatch):
+    plan = factories.PlanFactory(is_public=True)
+    factories.ServerFactory(cpu=plan.cpu, os=plan.os)
+    card = factories.CreditCardFactory()
+    card.users.roles.append(models.Role(name='end-user'))
+    session.commit()
+    view = [view for view in app.extensions['admin'][0]._views if view.endpoint == 'purchase'][0]
+    url = view.url + '/checkout/'
+    allocated = []
+    monkeypatch.setattr(end_user, 'allocate_purchases', lambda purchases, partial: allocated.append(purchases))
+
+    for quantity, message in [(100000000, 'Escolha de 0 a 10 unidades de cada plano.'),
+                              (-1, 'Escolha de 0 a 10 unidades de cada plano.')]:
+        data = {'credit_card': card.id, 'plan-%d' % plan.id: quantity}
+        with app.test_request_context(url, method='POST', data=data):
+            login_user(card.users)
+            view.checkout_view()
+            assert get_flashed_messages() == [message]
+    monkeypatch.setitem(app.config, 'CHECKOUT_MAX_TOTAL', 2)
+    with app.test_request_context(url, method='POST',
+                                  data={'credit_card': card.id, 'plan-%d' % plan.id: 3}):
+        login_user(card.users)
+        view.checkout_view()
+        assert get_flashed_messages() == ['Compre no máximo 2 planos de uma vez.']
+    assert allocated == []
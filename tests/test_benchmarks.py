@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+
+from benchmarks.fleet import populate
+from benchmarks.scenarios import available_servers, calculate_price, get_available_plans, search_plan
+from cloud_computing.model.models import Plan, Server, ServerGpu, PlanAvailability
+from cloud_computing.model.reconcile import reconcile_fleet
+
+
+def test_populate(session):
+    fleet = populate(session, servers=30, plans=12, users=5)
+    assert (len(fleet.servers), len(fleet.plans), len(fleet.users)) == (30, 12, 5)
+    assert Server.query.count() == 30
+    # os contadores gerados batem com os componentes instalados
+    assert reconcile_fleet(session) == []
+    plan = Plan.query.get(fleet.plans[0])
+    assert plan.demand_cores == plan.cpu.cores
+    assert plan.price == plan.calculate_price()
+    assert PlanAvailability.query.count() == 12
+    assert ServerGpu.query.count() > 0
+
+    # um segundo lote continua os ids do primeiro
+    more = populate(session, servers=5, plans=2, users=1, seed=1)
+    assert more.servers == list(range(fleet.servers[-1] + 1, fleet.servers[-1] + 6))
+    assert reconcile_fleet(session) == []
+
+
+def test_scenarios(session):
+    fleet = populate(session, servers=10, plans=6, users=3)
+    for scenario in (available_servers, calculate_price, get_available_plans, search_plan):
+        assert len(scenario(fleet, 3)) == 3
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+from cloud_computing.model.allocation import allocate_purchases
+from cloud_computing.model.consolidation import plan_consolidation, apply_consolidation
+from cloud_computing.model.models import Purchase
+from cloud_computing.model.placement import PLACEMENT_POLICIES
+from cloud_computing.model.reconcile import reconcile_fleet
+from . import factories
+
+
+def test_plan_consolidation(session):
+    plan = factories.PlanFactory(is_public=True)
+    big_cpu = factories.CpuFactory(model='CPU 64', cores=plan.cpu.cores * 2)
+    big_plan = factories.PlanFactory(is_public=True, cpu=big_cpu, os=plan.os)
+    servers = [factories.ServerFactory(cpu=big_cpu, os=plan.os) for _ in range(2)]
+    card = factories.CreditCardFactory()
+    session.flush()
+    purchases = [Purchase(user_id=card.user_id, credit_card_id=card.id, plan_id=plan.id) for _ in range(2)]
+    allocate_purchases(purchases, policy=PLACEMENT_POLICIES['worst-fit']())
+    session.flush()
+    assert {purchase.user_plan.server_id for purchase in purchases} == {server.id for server in servers}
+    assert big_plan.available_servers() is None
+
+    assert plan_consolidation(max_moves=0).moves == []
+    consolidation = plan_consolidation()
+    assert consolidation.target_plan == big_plan
+    assert consolidation.complete
+    assert len(consolidation.moves) == 1
+    move = consolidation.moves[0]
+    assert consolidation.target_server == move.user_plan.server_id
+    assert move.server_id != move.user_plan.server_id
+    # nada muda até a consolidação ser aplicada
+    assert big_plan.available_servers() is None
+
+    apply_consolidation(consolidation)
+    session.flush()
+    session.expire_all()
+    assert {purchase.user_plan.server_id for purchase in purchases} == {move.server_id}
+    assert [server.id for server in big_plan.available_servers()] == [consolidation.target_server]
+    assert reconcile_fleet(session) == []
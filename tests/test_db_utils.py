@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+from sqlalchemy import inspect
+
+from cloud_computing.model import models
+from cloud_computing.model.database import db
+from cloud_computing.utils.db_utils import upgrade_schema
+from . import factories
+
+
+def test_upgrade_schema(session):
+    server = factories.ServerFactory()
+    plan = factories.PlanFactory()
+    session.flush()
+    connection = session.connection(mapper=models.Server.__mapper__)
+    # tabela criada por uma versão sem a coluna e seus índices
+    connection.execute('ALTER TABLE server DROP COLUMN in_service')
+    connection.execute('DROP INDEX ix_server_capacity')
+    # também derruba o índice parcial ix_plan_custom_config_hash
+    connection.execute('ALTER TABLE plan DROP COLUMN is_custom')
+
+    upgrade_schema(connection, db.metadata)
+    assert connection.execute('SELECT in_service FROM server WHERE id = %s', server.id).scalar() is True
+    column = [column for column in inspect(connection).get_columns('server') if column['name'] == 'in_service'][0]
+    assert column['nullable'] is False
+    # default só do Python
+    assert connection.execute('SELECT is_custom FROM plan WHERE id = %s', plan.id).scalar() is False
+    assert 'ix_plan_custom_config_hash' in {index['name'] for index in inspect(connection).get_indexes('plan')}
+    assert 'ix_server_capacity' in {index['name'] for index in inspect(connection).get_indexes('server')}
+
+
+def test_upgrade_schema_backfill(session):
+    plan, user = factories.PlanFactory(), factories.UserFactory()
+    session.flush()
+    connection = session.connection(mapper=models.UserPlan.__mapper__)
+    # coluna adicionada sem o default por uma versão anterior
+    connection.execute('ALTER TABLE user_plan ALTER COLUMN expired DROP NOT NULL')
+    user_plan_id = connection.execute('INSERT INTO user_plan (user_id, plan_id, expired) VALUES (%s, %s, NULL) '
+                                      'RETURNING id', user.id, plan.id).scalar()
+
+    upgrade_schema(connection, db.metadata)
+    assert connection.execute('SELECT expired FROM user_plan WHERE id = %s', user_plan_id).scalar() is False
+    assert models.UserPlan.query.filter(models.UserPlan.expired.is_(False)).count() == 1
+
+
+def test_upgrade_schema_in_service(session):
+    server = factories.ServerFactory()
+    session.flush()
+    connection = session.connection(mapper=models.Server.__mapper__)
+    # servidores existentes deixados NULL por uma versão anterior
+    connection.execute('ALTER TABLE server ALTER COLUMN in_service DROP NOT NULL')
+    connection.execute('UPDATE server SET in_service = NULL')
+    assert models.fleet_index_rows(session)[0] == []
+
+    upgrade_schema(connection, db.metadata)
+    session.expire_all()
+    assert [row.id for row in models.fleet_index_rows(session)[0]] == [server.id]
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+from cloud_computing.model import models
+from cloud_computing.model.fleet_index import FleetIndex, PlanDemand
+from . import factories
+
+
+def make_index():
+    index = FleetIndex()
+    index.load([(1, 'Linux', 4, 16, 500, 0),
+                (2, 'Linux', 8, 32, 0, 200),
+                (3, 'Windows', 8, 32, 500, 200)],
+               [(2, 'GPU A', 2.0, 8),
+                (2, 'GPU B', 2.0, 4),
+                (3, 'GPU A', 2.0, 8)])
+    return index
+
+
+def test_fit_filters_by_capacity_and_os():
+    index = make_index()
+    assert index.fit(PlanDemand(4, 16, 0, 0, []), 'Linux') == [(1, {}), (2, {})]
+    assert index.fit(PlanDemand(6, 16, 0, 0, []), 'Linux') == [(2, {})]
+    assert index.fit(PlanDemand(4, 16, 100, 100, []), 'Linux') == []
+    assert index.fit(PlanDemand(1, 1, 0, 0, []), 'Other') == []
+
+
+def test_fit_gpus():
+    index = make_index()
+    assert index.fit(PlanDemand(1, 1, 0, 0, [(2.0, 8), (2.0, 4)]), 'Linux') == [(2, {'GPU A': 8, 'GPU B': 4})]
+    assert index.fit(PlanDemand(1, 1, 0, 0, [(2.0, 10)]), 'Linux') == []
+    assert index.fit(PlanDemand(1, 1, 0, 0, [(3.0, 1)]), 'Linux') == []
+
+
+def test_allocate_and_update():
+    index = make_index()
+    demand = PlanDemand(4, 16, 0, 0, [(2.0, 8)])
+    server_id, used_gpus = index.fit(demand, 'Linux', limit=1)[0]
+    index.allocate(index.rows[server_id], demand, used_gpus)
+    assert index.fit(demand, 'Linux') == []
+
+    index.update({2, 4}, [(4, 'Linux', 4, 16, 0, 0)], [(4, 'GPU A', 2.0, 8)])
+    assert index.fit(demand, 'Linux') == [(4, {'GPU A': 8})]
+    assert index.fit(PlanDemand(1, 1, 0, 0, []), 'Linux', server_id=2) == []
+
+
+def test_rows_of():
+    index = make_index()
+    index.update([0], [(0, 'Linux', 2, 8, 0, 0)], [])
+    assert index.rows_of([3, 0, 5, 1]).tolist() == [2, 3, -1, 0]
+    assert FleetIndex().rows_of([1]).tolist() == [-1]
+
+
+def test_available_servers(session):
+    plan = factories.PlanFactory()
+    factories.ServerFactory(cpu=plan.cpu, os=plan.os)
+    factories.ServerFactory(cpu=plan.cpu, os=plan.os)
+    session.flush()
+
+    servers = plan.available_servers()
+    assert len(servers) == 2
+    server, used_gpus, total_ram, total_hd, total_ssd = plan.available_servers(only_one=True)
+    assert server == servers[0]
+
+    servers[0].cores_available = 0
+    session.flush()
+    assert plan.available_servers() == servers[1:]
+    assert models.Plan.query.get(plan.id).available_servers(only_one=True, server_id=servers[0].id) is None
+
+
+def test_copy_is_independent():
+    index = FleetIndex()
+    index.load([(1, 'Linux', 4, 16, 0, 0)], [(1, 'GPU', 2.0, 8)])
+    snapshot = index.copy()
+    snapshot.allocate(snapshot.rows[1], PlanDemand(4, 16, 0, 0, [(2.0, 8)]), {'GPU': 8})
+    assert snapshot.fit(PlanDemand(1, 1, 0, 0, []), 'Linux') == []
+    assert index.fit(PlanDemand(1, 1, 0, 0, [(2.0, 8)]), 'Linux') == [(1, {'GPU': 8})]
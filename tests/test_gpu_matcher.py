@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+
+from cloud_computing.model.gpu_matcher import match_gpus
+
+
+def test_match_single_gpu_per_frequency():
+    server_gpus = {'A': (2.0, 16), 'B': (1.5, 8)}
+    assert match_gpus(server_gpus, [(2.0, 8), (2.0, 8), (1.5, 4)]) == {'A': 16, 'B': 4}
+    assert match_gpus(server_gpus, [(2.0, 8), (2.0, 12)]) is None
+    assert match_gpus(server_gpus, [(3.0, 1)]) is None
+    assert match_gpus(server_gpus, []) == {}
+
+
+def test_match_needs_exact_assignment():
+    # first-fit decreasing puts the 4 on the GPU 'A' and can't place the second 3
+    server_gpus = {'A': (2.0, 6), 'B': (2.0, 4)}
+    assert match_gpus(server_gpus, [(2.0, 3), (2.0, 4), (2.0, 3)]) == {'A': 6, 'B': 4}
+
+
+def test_match_does_not_split_a_plan_gpu():
+    server_gpus = {'A': (2.0, 4), 'B': (2.0, 4)}
+    assert match_gpus(server_gpus, [(2.0, 8)]) is None
+    assert match_gpus(server_gpus, [(2.0, 4), (2.0, 4)]) == {'A': 4, 'B': 4}
@@ -1,8 +1,21 @@
 # -*- coding: utf-8 -*-
+import datetime
+import json
+
+import pytest
+from flask import get_flashed_messages
+from sqlalchemy import event
+from wtforms import ValidationError
+
 from cloud_computing.model.models import ServerRam
 
 from cloud_computing.model import models
+from cloud_computing.model.database import db
 from tests.conftest import session
+from cloud_computing.controller.controller import Controller
+from cloud_computing.view.end_user import CustomPlan
+from cloud_computing.utils.page_cache import suggestion_cache
+from . import factories
 
 
 def test_user_model(user_data):
@@ -76,4 +89,352 @@ def test_purchase_model(purchase_data):
     assert purchase.user_plan.plan == purchase.plan
 
 
+def test_plan_demand(session):
+    plan = factories.PlanFactory()
+    ram = factories.RamFactory(model='RAM 4GB', capacity=4)
+    hd = factories.HdFactory(model='HD 100GB', capacity=100)
+    ssd = factories.HdFactory(model='SSD 50GB', capacity=50, is_ssd=True)
+    gpu = factories.GpuFactory(model='GPU 4GB', ram=4, frequency=2.0)
+    plan_hd = models.PlanHd(plan=plan, hd=hd, quantity=3)
+    session.add_all([models.PlanRam(plan=plan, ram=ram, quantity=2),
+                     plan_hd,
+                     models.PlanHd(plan=plan, hd=ssd, quantity=1),
+                     models.PlanGpu(plan=plan, gpu=gpu, quantity=2)])
+    session.flush()
+
+    assert plan.get_demand() == (plan.cpu.cores, 8, 300, 50, [(2.0, 8)])
+
+    session.delete(plan_hd)
+    ram.capacity = 8
+    session.flush()
+    assert (plan.demand_ram, plan.demand_hd, plan.demand_ssd) == (16, 0, 50)
+
+
+def test_plan_price(session):
+    plan = factories.PlanFactory(duration_months=2)
+    ram = factories.RamFactory(model='RAM 4GB', price=10)
+    hd = factories.HdFactory(model='HD 100GB', price=1)
+    gpu = factories.GpuFactory(model='GPU 4GB', price=100)
+    session.flush()
+    assert plan.price == pytest.approx(2 * plan.cpu.price)
+
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        session.add_all([models.PlanRam(plan=plan, ram=ram, quantity=2),
+                         models.PlanHd(plan=plan, hd=hd, quantity=3),
+                         models.PlanGpu(plan=plan, gpu=gpu, quantity=1)])
+        session.flush()
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+    # um único recálculo para os três componentes
+    price_updates = [statement for statement in statements
+                     if statement.startswith('UPDATE plan SET price')]
+    assert len(price_updates) == 1
+    assert plan.price == pytest.approx(2 * (plan.cpu.price + 2 * 10 + 3 * 1 + 100))
+    assert plan.calculate_price() == pytest.approx(plan.price)
+
+    plan.auto_price = False
+    plan.price = 7
+    session.flush()
+    assert plan.price == 7
+
+
+def test_component_reprice(session, app, monkeypatch):
+    ram = factories.RamFactory(model='RAM 4GB', price=10)
+    plan = factories.PlanFactory(duration_months=2)
+    fixed_plan = factories.PlanFactory(duration_months=1, auto_price=False)
+    session.add_all([models.PlanRam(plan=plan, ram=ram, quantity=2),
+                     models.PlanRam(plan=fixed_plan, ram=ram, quantity=1)])
+    session.flush()
+    fixed_plan.price = 1
+    session.flush()
+    old_price = plan.price
+
+    # o modo de teste mostra as diferenças sem gravar
+    changes = models.update_plan_price(session.connection(mapper=models.Plan.__mapper__), dry_run=True)
+    assert changes == []
+    session.execute(models.Ram.__table__.update().values(price=20))
+    changes = models.update_plan_price(session.connection(mapper=models.Plan.__mapper__), dry_run=True)
+    assert changes == [models.PriceChange(plan.id, plan.title, old_price, pytest.approx(old_price + 2 * 2 * 10))]
+    session.expire_all()
+    assert plan.price == old_price
+    session.execute(models.Ram.__table__.update().values(price=10))
+
+    ram.price = 15
+    session.flush()
+    assert plan.price == pytest.approx(old_price + 2 * 2 * 5)
+    assert fixed_plan.price == 1
+    assert session.info.pop('reprice_report') == (1, False)
+
+    # acima do limite o recálculo fica para depois do commit
+    started = []
+    monkeypatch.setitem(app.config, 'REPRICE_SYNC_LIMIT', 0)
+    monkeypatch.setattr(models, 'start_background_reprice', lambda app, components: started.append(components))
+    ram.price = 30
+    session.flush()
+    assert plan.price == pytest.approx(old_price + 2 * 2 * 5)
+    session.commit()
+    assert started == [{(models.Ram, 'RAM 4GB')}]
+    changes = models.reprice_components(started[0], session=session, batch_size=1)
+    assert [change.plan_id for change in changes] == [plan.id]
+    assert plan.price == pytest.approx(old_price + 2 * 2 * 20)
+
+
+def test_plan_availability(session):
+    plan = factories.PlanFactory(is_public=True)
+    other_plan = factories.PlanFactory(is_public=True)
+    session.flush()
+    assert plan.availability.available is False
+    assert Controller.get_available_plans() == []
+
+    server = factories.ServerFactory(cpu=plan.cpu, os=plan.os)
+    session.flush()
+    session.expire_all()
+    assert (plan.availability.available, plan.availability.server_count) == (True, 1)
+    assert other_plan.availability.available is False
+    assert Controller.get_available_plans() == [plan]
+
+    server.cores_available = 0
+    session.flush()
+    session.expire_all()
+    assert plan.availability.available is False
+
+
+def test_plan_availability_reads_database(session):
+    plan = factories.PlanFactory(is_public=True)
+    servers = [factories.ServerFactory(cpu=plan.cpu, os=plan.os) for _ in range(2)]
+    session.flush()
+    session.expire_all()
+    assert plan.availability.server_count == 2
+
+    # outro processo ocupou um servidor, o índice deste processo não sabe
+    session.execute(models.Server.__table__.update().where(models.Server.id == servers[1].id)
+                    .values(cores_available=0))
+    models.update_plan_availability(session, plan_ids=[plan.id])
+    session.expire_all()
+    assert (plan.availability.available, plan.availability.server_count) == (True, 1)
+
+
+def test_plan_server_count(session):
+    plan = factories.PlanFactory(is_public=True)
+    session.flush()
+    factories.ServerFactory(cpu=plan.cpu, os=plan.os)
+    factories.ServerFactory(cpu=plan.cpu, os=plan.os)
+    full_server = factories.ServerFactory(cpu=plan.cpu, os=plan.os)
+    session.flush()
+    full_server.ram_available = 0
+    session.flush()
+    session.expire_all()
+    counts = {p.id: p.server_count for p in Controller.get_plan_server_counts()}
+    assert counts[plan.id] == len(plan.available_servers())
+
+
+def test_server_inventory_counters(session):
+    server = factories.ServerFactory()
+    ram = factories.RamFactory(model='RAM 4GB')
+    ssd = factories.HdFactory(model='SSD 100GB', is_ssd=True)
+    gpu = factories.GpuFactory(model='GPU 4GB')
+    session.add_all([models.ServerRam(server=server, ram=ram, quantity=2),
+                     models.ServerHd(server=server, hd=ssd, quantity=3),
+                     models.ServerGpu(server=server, gpu=gpu, quantity=1)])
+    session.flush()
+    assert (server.ram_total, server.ram_available, server.ram_slot_available) == (8, 8, 8)
+    assert (server.ssd_total, server.ssd_available, server.hd_total, server.hd_slot_available) == (300, 300, 0, 97)
+    assert (ram.available, ssd.available, gpu.available, server.gpu_slot_available) == (8, 7, 9, 9)
+
+    server_ram = models.ServerRam.query.filter_by(server_id=server.id).one()
+    server_ram.quantity = 5
+    session.flush()
+    assert (server.ram_total, server.ram_slot_available, ram.available) == (20, 5, 5)
+
+    session.delete(models.ServerHd.query.filter_by(server_id=server.id).one())
+    session.delete(models.ServerGpu.query.filter_by(server_id=server.id).one())
+    session.flush()
+    assert (server.ssd_total, server.ssd_available, server.hd_slot_available, ssd.available) == (0, 0, 100, 10)
+    assert (server.gpu_slot_available, gpu.available) == (10, 10)
+
+
+def test_server_inventory_guards(session):
+    server = factories.ServerFactory(ram_max=8)
+    ram = factories.RamFactory(model='RAM 4GB', total=3)
+    session.add(models.ServerRam(server=server, ram=ram, quantity=3))
+    with pytest.raises(ValidationError) as error:
+        session.flush()
+    assert 'RAM máxima' in str(error.value)
+
+
+def test_plan_config_hash(session):
+    plan = factories.PlanFactory(duration_months=2, is_custom=True)
+    ram = factories.RamFactory(model='RAM 4GB')
+    hd = factories.HdFactory(model='HD 100GB')
+    session.add_all([models.PlanRam(plan=plan, ram=ram, quantity=2), models.PlanHd(plan=plan, hd=hd, quantity=1)])
+    session.flush()
+    assert plan.config_hash == plan.get_config_hash()
+    assert plan.config_hash == models.config_hash(plan.cpu_model, plan.os_name, 2,
+                                                  [('hd', 'HD 100GB', 1), ('ram', 'RAM 4GB', 1), ('ram', 'RAM 4GB', 1)])
+
+    # planos criados antes do config_hash, com a mesma configuração
+    duplicates = [factories.PlanFactory(cpu=plan.cpu, os=plan.os, duration_months=2, title='Customizado-%d' % n)
+                  for n in range(2)]
+    session.add_all([models.PlanRam(plan=duplicate, ram=ram, quantity=2) for duplicate in duplicates] +
+                    [models.PlanHd(plan=duplicate, hd=hd, quantity=1) for duplicate in duplicates])
+    other = factories.PlanFactory(cpu=plan.cpu, os=plan.os, duration_months=3, title='Customizado-3')
+    session.flush()
+    session.execute(models.Plan.__table__.update().values(config_hash=None))
+    card = factories.CreditCardFactory()
+    server = factories.ServerFactory()
+    session.flush()
+    hold = models.CapacityHold(plan_id=duplicates[1].id, user_id=card.user_id, server_id=server.id,
+                               expires_at=datetime.datetime.now())
+    session.add(hold)
+    session.flush()
+
+    assert models.merge_duplicate_plans(session) == 2
+    session.expire_all()
+    assert {found.id for found in models.Plan.query} == {plan.id, other.id}
+    assert hold.plan_id == plan.id
+    assert plan.config_hash == plan.get_config_hash()
+    assert other.is_custom is True
+
+
+CUSTOM_PLAN_FORM = {'duration_months': '2', 'cpu': 'Xeon', 'os': 'Linux',
+                    'plan_rams-0-ram': 'RAM 4GB', 'plan_rams-0-quantity': '2'}
+
+
+def test_custom_plan_reuse(session, app):
+    cpu = factories.CpuFactory(model='Xeon')
+    os = factories.OsFactory(name='Linux')
+    ram = factories.RamFactory(model='RAM 4GB')
+    session.commit()
+
+    view = CustomPlan(models.Plan, session, endpoint='custom-plan-test')
+    with app.test_request_context(method='POST', data=CUSTOM_PLAN_FORM):
+        plan = view.create_model(view.create_form())
+        pending = models.Os(name='BSD')
+        session.add(pending)
+        assert view.create_model(view.create_form()) is plan
+    # o plano reutilizado não descarta o resto da sessão
+    assert pending in session
+    assert plan.is_custom is True
+    assert [(plan_ram.ram, plan_ram.quantity) for plan_ram in plan.plan_rams] == [(ram, 2)]
+    assert models.Plan.query.count() == 1
+
+
+def test_concurrent_custom_plan_reuse(app, db):
+    session = db.create_scoped_session()
+    db.session = session
+    session.add_all([models.Cpu(model='Xeon', cores=4, frequency=2.0, price=1, total=10), models.Os(name='Linux'),
+                     models.Ram(model='RAM 4GB', capacity=4, price=1, total=10)])
+    session.commit()
+    view = CustomPlan(models.Plan, session, endpoint='custom-plan-concurrent-test')
+
+    inserted = []
+
+    def insert_concurrent_plan(flush_session, flush_context, instances):
+        # outra requisição grava a mesma configuração depois da busca
+        if inserted:
+            return
+        inserted.append(True)
+        with db.engine.begin() as connection:
+            connection.execute(models.Plan.__table__.insert().values(
+                id=1000, title='Customizado concorrente', price=0, duration_months=2, cpu_model='Xeon',
+                os_name='Linux', is_custom=True,
+                config_hash=models.config_hash('Xeon', 'Linux', 2, [('ram', 'RAM 4GB', 2)])))
+    event.listen(session(), 'before_flush', insert_concurrent_plan)
+    try:
+        with app.test_request_context(method='POST', data=CUSTOM_PLAN_FORM):
+            plan = view.create_model(view.create_form())
+            messages = get_flashed_messages(with_categories=True)
+            assert [category for category, message in messages] == ['info'], messages
+        assert plan.id == 1000
+        assert models.Plan.query.count() == 1
+    finally:
+        event.remove(session(), 'before_flush', insert_concurrent_plan)
+        session.remove()
+
+
+def test_search_plan(session, test_client):
+    gpu = factories.GpuFactory(model='Tesla 16GB')
+    plans = [factories.PlanFactory(is_public=True, title='Plano básico', shop_description='Servidores pequenos'),
+             factories.PlanFactory(is_public=True, title='Plano de aprendizado',
+                                   shop_description='Para treinar modelos em GPUs'),
+             factories.PlanFactory(is_public=False, title='Plano privado com GPU')]
+    session.add_all([models.PlanGpu(plan=plan, gpu=gpu, quantity=1) for plan in plans[1:]])
+    session.flush()
+
+    assert Controller.search_plan('planos').total == 2
+    # o título pesa mais que a descrição
+    assert [plan.title for plan in Controller.search_plan('básico servidor').items] == ['Plano básico']
+    assert [plan.title for plan in Controller.search_plan('tesla').items] == ['Plano de aprendizado']
+    page = Controller.search_plan('plano', page=2, per_page=1)
+    assert (page.total, page.pages, len(page.items)) == (2, 2, 1)
+
+    plans[0].title = 'Plano econômico'
+    session.flush()
+    assert Controller.search_plan('básico').total == 0
+
+    response = test_client.get('/search-results?search-box=aprendizado')
+    assert 'Plano de aprendizado' in response.get_data(as_text=True)
+
+
+def test_search_suggestions(session, test_client):
+    gpu = factories.GpuFactory(model='Tesla 16GB')
+    factories.GpuFactory(model='Tesla 32GB')
+    plans = [factories.PlanFactory(is_public=True, title='Treino com Tesla'),
+             factories.PlanFactory(is_public=True, title='Tesla dedicada'),
+             factories.PlanFactory(is_public=False, title='Tesla privada'),
+             factories.PlanFactory(is_public=True, title='100% Tesla')]
+    session.add_all([models.PlanGpu(plan=plans[0], gpu=gpu, quantity=1)])
+    session.commit()
+
+    suggestions, components = Controller.suggest('  TESLA ')
+    # os que começam com o termo primeiro, sem os planos privados
+    assert [title for title, slug_url in suggestions] == ['Tesla dedicada', '100% Tesla', 'Treino com Tesla']
+    # só os componentes de algum plano público
+    assert components == ['Tesla 16GB']
+    assert [title for title, slug_url in Controller.suggest('100%')[0]] == ['100% Tesla']
+    assert Controller.suggest('t') == ([], [])
+
+    response = test_client.get('/api/suggestions?q=dedic')
+    data = json.loads(response.get_data(as_text=True))
+    assert data['plans'] == [dict(title='Tesla dedicada', url='/' + plans[1].slug_url)]
+    hits = suggestion_cache.hits
+    test_client.get('/api/suggestions?q=dedic')
+    assert suggestion_cache.hits == hits + 1
+
+    models.Plan.query.get(plans[1].id).title = 'Dedicada'
+    session.commit()
+    assert Controller.suggest('dedic')[0][0][0] == 'Dedicada'
+
+
+def test_plan_detail(session, test_client):
+    plan = factories.PlanFactory(is_public=True, title='Plano completo')
+    gpus = [factories.GpuFactory(model='Tesla 16GB'), factories.GpuFactory(model='GTX 1080')]
+    session.add_all([models.PlanGpu(plan=plan, gpu=gpu, quantity=2) for gpu in gpus] +
+                    [models.PlanRam(plan=plan, ram=factories.RamFactory(model='RAM 8GB'), quantity=4),
+                     models.PlanHd(plan=plan, hd=factories.HdFactory(model='SSD 1TB', is_ssd=True), quantity=1)])
+    session.commit()
+    slug_url = plan.slug_url
+    session.expire_all()
+
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        detail = Controller.get_plan_detail(slug_url)
+        page = test_client.get('/' + slug_url).get_data(as_text=True)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+    # uma consulta para o DTO e outra para a página
+    assert len(statements) == 2
+    assert [gpu.model for gpu in detail.gpus] == ['GTX 1080', 'Tesla 16GB']
+    assert (detail.rams[0].quantity, detail.hds[0].is_ssd, detail.cpu.model) == (4, True, plan.cpu.model)
+    assert 'Tesla 16GB' in page and 'RAM 8GB' in page and 'SSD 1TB' in page
 
+    assert Controller.get_plan_detail('nao-existe') is None
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+import fnmatch
+import time
+
+from cloud_computing.utils.page_cache import LRUBackend, RedisBackend, PageCache, page_cache
+from cloud_computing.view import view
+from . import factories
+
+
+class FakeRedis:
+    """Stand-in for the redis client, with the commands used by RedisBackend."""
+
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value
+
+    def scan_iter(self, match):
+        return [key for key in self.values if fnmatch.fnmatch(key, match)]
+
+    def delete(self, *keys):
+        for key in keys:
+            self.values.pop(key, None)
+
+
+def test_lru_backend():
+    backend = LRUBackend(max_entries=2)
+    backend.set('a', '1')
+    backend.set('b', '2')
+    assert backend.get('a') == '1'
+    backend.set('c', '3')
+    # 'b' foi usada há mais tempo
+    assert (backend.get('a'), backend.get('b'), backend.get('c')) == ('1', None, '3')
+
+    backend = LRUBackend(ttl=0)
+    backend.set('a', '1')
+    time.sleep(0.001)
+    assert backend.get('a') is None
+
+
+def test_page_cache():
+    client = FakeRedis()
+    client.set('other', b'kept')
+    for backend in (LRUBackend(), RedisBackend(client)):
+        cache = PageCache(backend)
+        renders = []
+
+        def render():
+            renders.append(1)
+            return 'página'
+        assert cache.get_or_render('home:anonymous', render) == 'página'
+        assert cache.get_or_render('home:anonymous', render) == 'página'
+        assert (len(renders), cache.hits, cache.misses) == (1, 1, 1)
+        cache.invalidate()
+        cache.get_or_render('home:anonymous', render)
+        assert len(renders) == 2
+    assert client.get('other') == b'kept'
+
+
+def test_shop_pages_invalidation(session, test_client, monkeypatch):
+    monkeypatch.setattr(page_cache, 'backend', LRUBackend())
+    plan = factories.PlanFactory(is_public=True)
+    session.commit()
+
+    test_client.get('/')
+    test_client.get('/' + plan.slug_url)
+    hits = page_cache.hits
+    assert test_client.get('/' + plan.slug_url).status_code == 200
+    assert page_cache.hits == hits + 1
+
+    plan.title = 'Plano renomeado'
+    session.flush()
+    # só depois do commit
+    assert page_cache.backend.entries
+    session.commit()
+    assert not page_cache.backend.entries
+    assert 'Plano renomeado' in test_client.get('/' + plan.slug_url).get_data(as_text=True)
+
+
+def test_flashed_messages_are_not_cached(session, test_client, monkeypatch):
+    monkeypatch.setattr(page_cache, 'backend', LRUBackend())
+    plan = factories.PlanFactory(is_public=True)
+    session.commit()
+    slug_url = plan.slug_url
+    test_client.get('/' + slug_url)
+
+    with test_client.session_transaction() as flask_session:
+        flask_session['_flashes'] = [('error', 'Não existe servidor disponível')]
+    hits = page_cache.hits
+    assert 'Não existe servidor disponível' in test_client.get('/' + slug_url).get_data(as_text=True)
+    assert page_cache.hits == hits
+    # mostrada uma vez só
+    assert 'Não existe servidor disponível' not in test_client.get('/' + slug_url).get_data(as_text=True)
+    assert page_cache.hits == hits + 1
+
+
+class FakeUser:
+    is_anonymous = False
+
+    def __init__(self, *roles):
+        self.roles = roles
+
+    def has_role(self, role):
+        return role in self.roles
+
+
+def test_user_role(monkeypatch):
+    keys = set()
+    for user in (FakeUser('admin'), FakeUser('end-user'), FakeUser('admin', 'end-user'), FakeUser()):
+        monkeypatch.setattr(view, 'current_user', user)
+        keys.add(view.user_role())
+    # o admin que também é cliente vê o formulário de compra
+    assert keys == {'admin', 'end-user', 'admin+end-user', 'user'}
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from cloud_computing.model.fleet_index import FleetIndex, PlanDemand
+from cloud_computing.model.placement import get_placement_policy, PLACEMENT_POLICIES
+
+DEMAND = PlanDemand(2, 8, 0, 0, [])
+
+
+@pytest.fixture()
+def index():
+    index = FleetIndex()
+    index.load([(1, 'Linux', 8, 32, 0, 0),
+                (2, 'Linux', 2, 8, 0, 0),
+                (3, 'Linux', 32, 128, 0, 0)], [])
+    return index
+
+
+@pytest.mark.parametrize('name, order', [
+    ('first-fit', [1, 2, 3]),
+    ('best-fit', [2, 1, 3]),
+    ('worst-fit', [3, 1, 2]),
+])
+def test_policy_order(index, name, order):
+    fits = index.fit(DEMAND, 'Linux', policy=PLACEMENT_POLICIES[name]())
+    assert [server_id for server_id, _ in fits] == order
+
+
+def test_spread_avoids_servers_of_the_same_user(index):
+    fits = index.fit(DEMAND, 'Linux', policy=PLACEMENT_POLICIES['spread'](), tenants={3: 2, 1: 1})
+    assert [server_id for server_id, _ in fits] == [2, 1, 3]
+
+
+def test_policy_from_config(app):
+    assert get_placement_policy().name == app.config['PLACEMENT_POLICY']
+    with pytest.raises(ValueError):
+        get_placement_policy('unknown')
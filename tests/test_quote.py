@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+import pytest
+from sqlalchemy import event
+
+from cloud_computing.controller.controller import Controller
+from cloud_computing.model import models
+from cloud_computing.model.database import db
+from cloud_computing.model.quote import component_catalog
+from . import factories
+
+
+def test_quote_plan(session):
+    plan = factories.PlanFactory(duration_months=3)
+    ram = factories.RamFactory(model='RAM 4GB', price=10)
+    hd = factories.HdFactory(model='SSD 100GB', price=2, is_ssd=True)
+    session.add_all([models.PlanRam(plan=plan, ram=ram, quantity=2), models.PlanHd(plan=plan, hd=hd, quantity=1)])
+    factories.ServerFactory(cpu=plan.cpu, os=plan.os)
+    session.commit()
+    plan_count = models.Plan.query.count()
+
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        quote = Controller.quote_plan(plan.cpu_model, plan.os_name, 3, rams={'RAM 4GB': 2}, hds={'SSD 100GB': 1})
+        Controller.quote_plan(plan.cpu_model, plan.os_name, 3, rams={'RAM 4GB': 2}, hds={'SSD 100GB': 1})
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+    assert quote.price == pytest.approx(plan.calculate_price())
+    assert quote.monthly_price == pytest.approx(plan.calculate_price() / 3)
+    assert quote.demand == plan.get_demand()
+    # o servidor não tem RAM nem SSD
+    assert (quote.available, quote.server_count) == (False, 0)
+    assert all(statement.startswith('SELECT') for statement in statements)
+    assert models.Plan.query.count() == plan_count
+
+    # o catálogo é recarregado depois do commit de um novo preço
+    ram.price = 20
+    session.commit()
+    quote = Controller.quote_plan(plan.cpu_model, plan.os_name, 3)
+    assert quote.price == pytest.approx(3 * plan.cpu.price)
+    assert (quote.available, quote.server_count) == (True, 1)
+    assert Controller.quote_plan(plan.cpu_model, plan.os_name, 1, rams={'RAM 4GB': 1}).price == \
+        pytest.approx(plan.cpu.price + 20)
+
+    with pytest.raises(ValueError):
+        Controller.quote_plan(plan.cpu_model, plan.os_name, 1, gpus={'GPU 4GB': 1})
+    with pytest.raises(ValueError):
+        Controller.quote_plan(plan.cpu_model, 'Plan 9', 1)
+
+
+def test_quote_endpoint(session, test_client):
+    cpu = factories.CpuFactory(model='Xeon', price=5)
+    factories.RamFactory(model='RAM 4GB', price=10)
+    os = factories.OsFactory(name='Linux')
+    factories.ServerFactory(cpu=cpu, os=os)
+    session.commit()
+    component_catalog.invalidate()
+
+    response = test_client.get('/api/quote?cpu=Xeon&os=Linux&months=2&ram=RAM 4GB:1')
+    assert response.status_code == 200
+    data = json.loads(response.get_data(as_text=True))
+    assert data['price'] == pytest.approx(2 * (5 + 10))
+    assert data['demand']['ram'] == 4
+
+    response = test_client.get('/api/quote?cpu=Xeon&os=Linux&ram=RAM 4GB')
+    assert response.status_code == 400
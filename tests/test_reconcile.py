@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+from cloud_computing.model.allocation import allocate_purchases
+from cloud_computing.model.models import Server, ServerGpu, ServerRam, ServerHd, PlanGpu, Purchase, \
+    Allocation, rebuild_server_availability
+from cloud_computing.model.reconcile import reconcile_fleet, Drift
+from . import factories
+
+
+def test_reconcile_fleet(session):
+    plan = factories.PlanFactory(is_public=True)
+    gpu = factories.GpuFactory(model='GPU 4GB', ram=4, frequency=2.0)
+    ram = factories.RamFactory(model='RAM 4GB', capacity=4)
+    ssd = factories.HdFactory(model='SSD 100GB', capacity=100, is_ssd=True)
+    server = factories.ServerFactory(cpu=plan.cpu, os=plan.os)
+    session.add_all([PlanGpu(plan=plan, gpu=gpu, quantity=1),
+                     ServerGpu(server=server, gpu=gpu, quantity=2),
+                     ServerRam(server=server, ram=ram, quantity=2),
+                     ServerHd(server=server, hd=ssd, quantity=1)])
+    card = factories.CreditCardFactory()
+    session.flush()
+    allocate_purchases([Purchase(user_id=card.user_id, credit_card_id=card.id, plan_id=plan.id)])
+    session.flush()
+    assert reconcile_fleet(session) == []
+
+    session.execute(Server.__table__.update().values(cores_available=5, ram_total=0, hd_slot_available=None))
+    session.execute(ServerGpu.__table__.update().values(available_capacity=8))
+    drifts = reconcile_fleet(session)
+    assert drifts == [Drift(server.id, None, 'cores_available', 5, 0),
+                      Drift(server.id, None, 'ram_total', 0, 8),
+                      Drift(server.id, None, 'hd_slot_available', None, server.hd_slot_total - 1),
+                      Drift(server.id, gpu.model, 'available_capacity', 8, 4)]
+
+    assert reconcile_fleet(session, fix=True) == drifts
+    assert reconcile_fleet(session) == []
+    # the ledger agrees with the fixed counters
+    rebuild_server_availability(session)
+    assert reconcile_fleet(session) == []
+
+    session.execute(Allocation.__table__.delete())
+    assert reconcile_fleet(session, fix=True) == []
+    rebuild_server_availability(session)
+    assert reconcile_fleet(session) == []
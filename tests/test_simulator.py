@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+
+from cloud_computing.model.allocation import allocate_purchases
+from cloud_computing.model.fleet_index import PlanDemand
+from cloud_computing.model.models import Purchase
+from cloud_computing.model.placement import PLACEMENT_POLICIES
+from cloud_computing.model.simulator import FleetSnapshot, SimulatedPurchase, fleet_snapshot, purchase_stream, \
+    simulate
+from . import factories
+
+START = datetime.date(2018, 1, 1)
+SMALL = PlanDemand(4, 8, 0, 0, [])
+LARGE = PlanDemand(8, 8, 0, 0, [])
+
+
+def purchase(days, demand, months=1, lease=None, os_name='Linux'):
+    return SimulatedPurchase(START + datetime.timedelta(days=days), 1, os_name, demand, months, lease)
+
+
+def test_simulate():
+    snapshot = FleetSnapshot([(1, 'Linux', 8, 16, 0, 0), (2, 'Linux', 0, 8, 0, 0),
+                              (3, 'Debian', 8, 4, 0, 0), (4, 'Debian', 2, 16, 0, 0)], [],
+                             [(START + datetime.timedelta(days=10), 2, SMALL, {})])
+    stream = [purchase(0, SMALL, lease=1),
+              purchase(1, SMALL),
+              purchase(2, LARGE),
+              # a renovação mantém o plano no servidor
+              purchase(20, SMALL, lease=1),
+              purchase(40, LARGE),
+              purchase(45, SMALL, os_name='Windows'),
+              # há cores e RAM livres, mas não no mesmo servidor
+              purchase(46, SMALL, os_name='Debian')]
+    report = simulate(snapshot, stream, PLACEMENT_POLICIES['best-fit']())
+    assert (report.purchases, report.rejected, report.fragmented) == (7, 4, 1)
+    # nenhum servidor Windows, faltam todos os recursos do plano
+    assert report.exhausted == {'cores': START + datetime.timedelta(days=2),
+                                'ram': START + datetime.timedelta(days=45), 'hd': None, 'ssd': None, 'gpu': None}
+    assert 0 < report.utilization['cores'] < report.peak_utilization['cores'] < 1
+    assert report.utilization['gpu'] == 0
+
+
+def test_fleet_snapshot(session):
+    plan = factories.PlanFactory(is_public=True, duration_months=1)
+    server = factories.ServerFactory(cpu=plan.cpu, os=plan.os)
+    card = factories.CreditCardFactory()
+    session.flush()
+    purchases = [Purchase(user_id=card.user_id, credit_card_id=card.id, plan_id=plan.id)]
+    allocate_purchases(purchases)
+    session.flush()
+
+    snapshot = fleet_snapshot(session)
+    assert snapshot.server_rows == [(server.id, plan.os_name, 0, 0, 0, 0)]
+    assert [lease[1:] for lease in snapshot.leases] == [(server.id, plan.get_demand(), {})]
+    empty = fleet_snapshot(session, empty=True, clones={server.id: 1})
+    assert empty.server_rows == [(server.id, plan.os_name, plan.cpu.cores, 0, 0, 0),
+                                 (server.id + 1, plan.os_name, plan.cpu.cores, 0, 0, 0)]
+    assert empty.leases == []
+
+    stream = purchase_stream(session, start=START)
+    assert [(item.date, item.demand, item.lease) for item in stream] == \
+        [(START, plan.get_demand(), purchases[0].user_plan_id)]
+    report = simulate(empty, stream * 3, PLACEMENT_POLICIES['first-fit']())
+    # as compras repetidas do mesmo UserPlan são renovações
+    assert (report.purchases, report.rejected) == (3, 0)